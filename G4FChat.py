@@ -1,30 +1,40 @@
 # G4FChat.py
 
+import time
+STARTUP_STARTED = time.perf_counter()
 import uuid
 import g4f
 import json
 import logging
 import sys
-import time
 import inspect
 import os
 import re
 import textwrap
+import hashlib
+import gzip
+import copy
+import queue
+import asyncio
+import sqlite3
+import threading
+import atexit
 from threading import Lock
+from concurrent.futures import Future
 from datetime import datetime
+from collections import OrderedDict
+from contextlib import contextmanager
 from rich.console import Console
 from rich.panel import Panel
-from rich.progress import Progress, SpinnerColumn, TextColumn
-from rich.markdown import Markdown
+from rich.live import Live
+from rich.spinner import Spinner
+from rich.text import Text
 from rich.style import Style
-from pygments import highlight
-from pygments.lexers import get_lexer_by_name, TextLexer
-from pygments.formatters import TerminalFormatter
-from typing import Dict, List, Set, Tuple, Optional, Any, Union
+from typing import Dict, List, Set, Tuple, Optional, Any, Union, Callable, Awaitable, AsyncIterator
 
 # Import new AsyncClient if available
 try:
-    from g4f.client import Client as G4FClient
+    from g4f.client import AsyncClient as G4FAsyncClient
     USE_CLIENT_API = True
 except ImportError:
     USE_CLIENT_API = False
@@ -45,6 +55,21 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Startup timing: seconds spent in each phase, in order
+startup_timings: Dict[str, float] = {}
+
+def mark_startup(phase: str) -> None:
+    """Record the time spent since the previous startup phase"""
+    elapsed = time.perf_counter() - STARTUP_STARTED
+    startup_timings[phase] = elapsed - sum(startup_timings.values())
+
+def startup_report() -> str:
+    """One-line summary of startup phases"""
+    phases = ", ".join(f"{phase} {seconds:.3f}s" for phase, seconds in startup_timings.items())
+    return f"{phases} (total {sum(startup_timings.values()):.3f}s)"
+
+mark_startup("imports")
+
 # Initialize Rich console
 console = Console()
 error_style = Style(color="red", bold=True)
@@ -56,29 +81,356 @@ code_style = Style(color="magenta")
 MODEL_FILE = 'user_models.json'
 USER_CHATS_FILE = 'user_chats.json'
 LANG_FILE = 'user_lang.json'
+DEADLINE_FILE = 'user_deadlines.json'
 CONFIG_DIR = 'chat_config'
+JOURNAL_DIR = 'chat_journal'
+JOURNAL_INDEX_FILE = 'index.json'
+JOURNAL_COUNTERS_FILE = 'counters.json'
+JOURNAL_COMPACT_THRESHOLD = 32  # superseded records before a journal is compacted
+CHAT_DB_FILE = 'user_chats.db'
+CHAT_STORE_BACKEND = os.environ.get('G4FCHAT_STORE', 'journal')  # 'journal' or 'sqlite'
+PROVIDER_REGISTRY_FILE = 'provider_registry.json'
+PROVIDER_SCORES_FILE = 'provider_scores.json'
 
 # Ensure config directory exists
 os.makedirs(CONFIG_DIR, exist_ok=True)
 
 # Caching
 user_models_cache: Dict[str, str] = {}
-user_chats_cache: Dict[str, dict] = {}
+user_chats_cache: Optional[Dict[str, dict]] = None  # None until loaded; an empty dict is a valid cache
 user_lang_cache: Dict[str, str] = {}
+user_deadlines_cache: Optional[Dict[str, float]] = None
 active_providers: List[g4f.Provider.BaseProvider] = []
 provider_classes: Dict[str, g4f.Provider.BaseProvider] = {}
 
 # Global stats
-stats = {
-    'total_messages': 0,
-    'saved_code_blocks': 0,
-    'active_chats': 0,
-    'last_activity': time.time(),
-    'total_api_calls': 0
+class Metrics:
+    """Usage counters, updated as chats and messages are created and deleted.
+
+    Counters are saved with the chat store and loaded from it, so they are
+    never rebuilt by scanning histories; recount() compares them with the
+    store's own totals on demand.
+    """
+
+    COUNTERS = ('total_messages', 'saved_code_blocks', 'active_chats', 'total_api_calls')
+
+    def __init__(self):
+        self._lock = Lock()
+        self._values: Dict[str, float] = {name: 0 for name in self.COUNTERS}
+        self._values['last_activity'] = time.time()
+
+    def incr(self, name: str, amount: float = 1) -> None:
+        with self._lock:
+            self._values[name] = max(0, self._values.get(name, 0) + amount)
+
+    def set(self, name: str, value: float) -> None:
+        with self._lock:
+            self._values[name] = value
+
+    def snapshot(self) -> Dict[str, float]:
+        """Consistent copy of all counters"""
+        with self._lock:
+            return dict(self._values)
+
+    def restore(self, values: Dict[str, float]) -> None:
+        """Load persisted counters; unknown names are ignored"""
+        with self._lock:
+            for name, value in values.items():
+                if name in self._values:
+                    self._values[name] = value
+
+    def recount(self, store: "ChatStore", extra: Tuple[int, int] = (0, 0)) -> Dict[str, Tuple[float, float]]:
+        """Replace chat and message counters with the store totals plus extra (chats, messages), e.g. archived ones.
+        Returns {name: (counted, stored)} for drift"""
+        chats, messages = store.totals()
+        chats, messages = chats + extra[0], messages + extra[1]
+        drift = {}
+        with self._lock:
+            for name, stored in (('active_chats', chats), ('total_messages', messages)):
+                if self._values[name] != stored:
+                    drift[name] = (self._values[name], stored)
+                self._values[name] = stored
+        return drift
+
+metrics = Metrics()
+
+# Latency histograms: bucket upper bounds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)  # seconds
+ATTEMPT_BUCKETS = (1, 2, 3, 4, 5, 7, 10, 15, 20)
+
+# name: (type, help, buckets); exported with a "g4fchat_" prefix
+PERF_METRICS = {
+    'provider_ttfb_seconds': ('histogram', "Time to the first chunk of a streamed provider attempt", LATENCY_BUCKETS),
+    'provider_latency_seconds': ('histogram', "Duration of successful provider attempts", LATENCY_BUCKETS),
+    'provider_errors_total': ('counter', "Failed provider attempts by error kind", None),
+    'reply_attempts': ('histogram', "Provider attempts per successful reply", ATTEMPT_BUCKETS),
+    'completions_total': ('counter', "Completions by outcome: ok, cached, coalesced, partial or failed", None),
+    'turn_seconds': ('histogram', "Chat turns from the user message to the saved reply", LATENCY_BUCKETS),
+    'persist_seconds': ('histogram', "Background writes by target", LATENCY_BUCKETS),
+    'postprocess_seconds': ('histogram', "Reply post-processing steps", LATENCY_BUCKETS),
 }
 
+class Histogram:
+    """Fixed-bucket histogram, as in Prometheus"""
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last bucket is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        idx = 0
+        while idx < len(self.buckets) and value > self.buckets[idx]:
+            idx += 1
+        self.counts[idx] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Estimate a quantile by interpolating inside its bucket"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for idx, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                if idx == len(self.buckets):
+                    return self.buckets[-1]  # Above the largest bound
+                lower = self.buckets[idx - 1] if idx else 0.0
+                return lower + (self.buckets[idx] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+class PerfRecorder:
+    """Labelled histograms and counters for the metrics in PERF_METRICS"""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._series: Dict[str, Dict[Tuple[Tuple[str, str], ...], Any]] = {name: {} for name in PERF_METRICS}
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series[name]
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram(PERF_METRICS[name][2])
+            histogram.observe(value)
+
+    def count(self, name: str, amount: float = 1, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series[name]
+            series[key] = series.get(key, 0) + amount
+
+    @contextmanager
+    def timer(self, name: str, **labels: str):
+        """Observe the duration of a with block"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def series(self, name: str) -> Dict[Tuple[Tuple[str, str], ...], Any]:
+        """Copy of one metric: {labels: histogram or count}"""
+        with self._lock:
+            return {
+                key: copy.copy(value) if isinstance(value, Histogram) else value
+                for key, value in self._series[name].items()
+            }
+
+    def render_prometheus(self, gauges: Optional[Dict[str, float]] = None) -> str:
+        """All metrics in the Prometheus text exposition format"""
+        def escape(value: str) -> str:
+            return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+        def label_text(labels: Tuple[Tuple[str, str], ...], extra: str = "") -> str:
+            parts = [f'{key}="{escape(str(value))}"' for key, value in labels]
+            if extra:
+                parts.append(extra)
+            return "{" + ",".join(parts) + "}" if parts else ""
+
+        lines = []
+        for name, (kind, help_text, _) in PERF_METRICS.items():
+            full_name = f"g4fchat_{name}"
+            lines.append(f"# HELP {full_name} {help_text}")
+            lines.append(f"# TYPE {full_name} {kind}")
+            for labels, value in sorted(self.series(name).items()):
+                if kind == 'counter':
+                    lines.append(f"{full_name}{label_text(labels)} {value:g}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(list(value.buckets) + ['+Inf'], value.counts):
+                    cumulative += count
+                    le = bound if isinstance(bound, str) else f"{bound:g}"
+                    lines.append(f"{full_name}_bucket{label_text(labels, 'le=' + json.dumps(le))} {cumulative}")
+                lines.append(f"{full_name}_sum{label_text(labels)} {value.sum:g}")
+                lines.append(f"{full_name}_count{label_text(labels)} {value.count}")
+        for name, value in (gauges or {}).items():
+            lines.append(f"# TYPE g4fchat_{name} gauge")
+            lines.append(f"g4fchat_{name} {value:g}")
+        return "\n".join(lines) + "\n"
+
+perf = PerfRecorder()
+
 # Thread safety
 cache_lock = Lock()
+writer_lock = Lock()
+archive_lock = Lock()
+
+class LockRegistry:
+    """Locks created on first use, one per key"""
+
+    def __init__(self, factory: Callable[[], Any] = threading.RLock):
+        self._factory = factory
+        self._locks: Dict[Any, Any] = {}
+        self._lock = Lock()
+
+    def __call__(self, key: Any) -> Any:
+        with self._lock:
+            lock = self._locks.get(key)
+            if lock is None:
+                lock = self._locks[key] = self._factory()
+            return lock
+
+    def discard(self, key: Any) -> None:
+        with self._lock:
+            self._locks.pop(key, None)
+
+# Chat cache locking. A user lock guards the user's chat list and active chat,
+# a chat lock guards one chat's history and provider; take the user lock
+# first when both are needed. Turn locks keep one reply at a time per chat.
+user_locks = LockRegistry()
+chat_locks = LockRegistry()
+turn_locks = LockRegistry(asyncio.Lock)
+
+# Provider racing: RACE_TOP_K > 1 sends the message to several providers at once
+RACE_TOP_K = int(os.environ.get('G4FCHAT_RACE_K', '1'))
+RACE_HEDGE_DELAY = float(os.environ.get('G4FCHAT_RACE_HEDGE_DELAY', '2.0'))  # seconds before the next provider joins
+RACE_DEADLINE = float(os.environ.get('G4FCHAT_RACE_DEADLINE', '90'))  # seconds for the whole race
+
+# Request deadlines: one time budget per reply, shared by every provider attempt.
+# A user's /deadline setting comes first, then the longest matching model prefix, then the default.
+REQUEST_DEADLINE = float(os.environ.get('G4FCHAT_DEADLINE', '120'))  # seconds
+ATTEMPT_TIMEOUT = 60  # seconds one provider attempt may take at most
+MODEL_DEADLINES = {
+    'o1': 300,
+    'o3': 300,
+    'o4': 300,
+    'deepseek-r1': 300,
+    'qwq': 300,
+}
+# "prefix=seconds,..." overrides the table
+MODEL_DEADLINES.update({
+    prefix.strip().lower(): float(seconds)
+    for prefix, seconds in (item.split('=', 1) for item in os.environ.get('G4FCHAT_MODEL_DEADLINES', '').split(',')
+                            if '=' in item)
+})
+DEADLINE_LIMITS = (5, 3600)  # seconds allowed for /deadline
+
+# Context budgeting: history sent upstream is trimmed to the model's context window
+MODEL_CONTEXT_TOKENS = {
+    'gpt-3.5-turbo': 16385,
+    'gpt-4': 8192,
+    'gpt-4o': 128000,
+    'gpt-4.1': 128000,
+    'gpt-4-1': 128000,
+    'gpt-4.5': 128000,
+    'o1': 128000,
+    'o3': 128000,
+    'o4': 128000,
+    'claude': 200000,
+    'llama-2': 4096,
+    'llama-3-': 8192,
+    'llama-3.1': 128000,
+    'llama-3.2': 128000,
+    'llama-3.3': 128000,
+    'mistral': 32000,
+    'mixtral': 32000,
+    'qwen': 32000,
+    'deepseek': 64000,
+    'gemini': 128000,
+}
+DEFAULT_CONTEXT_TOKENS = 8192
+CONTEXT_TOKENS_OVERRIDE = int(os.environ.get('G4FCHAT_CONTEXT_TOKENS', '0'))  # 0 = per-model table
+CONTEXT_REPLY_RESERVE = 2048  # tokens left for the reply
+CONTEXT_KEEP_RECENT = 4  # newest messages never shortened
+CONTEXT_COLLAPSE_CHARS = 1500  # older messages are cut to this length
+CONTEXT_SUMMARY = os.environ.get('G4FCHAT_CONTEXT_SUMMARY', '1') != '0'
+CONTEXT_SUMMARY_TOKENS = 300
+MESSAGE_TOKEN_OVERHEAD = 4
+
+# Response cache (off by default)
+RESPONSE_CACHE_ENABLED = os.environ.get('G4FCHAT_CACHE', '0') == '1'
+RESPONSE_CACHE_DIR = 'response_cache'
+RESPONSE_CACHE_MEMORY_ITEMS = 256
+RESPONSE_CACHE_DISK_BYTES = 50 * 1024 * 1024
+RESPONSE_CACHE_TTL = float(os.environ.get('G4FCHAT_CACHE_TTL', str(24 * 3600)))  # seconds
+
+# Identical concurrent requests share one upstream completion
+COALESCE_REQUESTS = os.environ.get('G4FCHAT_COALESCE', '1') != '0'
+
+# Message search
+SEARCH_DB_FILE = 'search.db'
+SEARCH_RESULTS = 10
+SEARCH_SNIPPET_TOKENS = 12  # words around the match in a snippet
+
+# Archive of dormant chats
+ARCHIVE_DIR = 'chat_archive'
+ARCHIVE_INDEX_FILE = 'index.json'
+CHAT_ACTIVITY_FILE = 'chat_activity.json'
+ARCHIVE_AFTER_DAYS = float(os.environ.get('G4FCHAT_ARCHIVE_DAYS', '30'))  # unused chats are archived after this; 0 = never
+ARCHIVE_CHECK_INTERVAL = 3600  # seconds between archive passes
+
+# Pooled G4F clients
+CLIENT_POOL_SIZE = 32
+CLIENT_POOL_IDLE = 600  # seconds a client may stay unused
+CLIENT_POOL_MAX_ERRORS = 3  # consecutive errors before a client is replaced
+
+# Per-provider admission: a token bucket limits the request rate, and an AIMD limit caps
+# requests in flight (halved on rate limits and timeouts, raised by about one per full window of successes)
+PROVIDER_RATE = float(os.environ.get('G4FCHAT_PROVIDER_RATE', '2.0'))  # requests per second
+PROVIDER_BURST = 5  # tokens a provider may save up
+PROVIDER_CONCURRENCY_START = 8
+PROVIDER_CONCURRENCY_MAX = int(os.environ.get('G4FCHAT_PROVIDER_CONCURRENCY', '16'))
+PROVIDER_BACKOFF = 0.5  # factor applied to the concurrency limit when throttled
+PROVIDER_QUEUE_WAIT = float(os.environ.get('G4FCHAT_PROVIDER_QUEUE_WAIT', '2.0'))  # seconds before moving on
+PROVIDER_POLL_INTERVAL = 0.05  # seconds between admission checks while queued
+
+# Stream replies token by token instead of waiting behind a spinner
+STREAM_OUTPUT = os.environ.get('G4FCHAT_STREAM', '1') != '0'
+
+# Batch mode
+BATCH_CONCURRENCY = 4  # prompts in flight at once
+
+# HTTP server mode
+API_KEYS_FILE = 'api_keys.json'  # {"api key": "user id"}
+SERVER_HOST = '127.0.0.1'
+SERVER_PORT = 8080
+SERVER_SHUTDOWN_TIMEOUT = 15.0  # seconds in-flight requests may take to finish on shutdown
+
+# Write-behind persistence
+WRITE_BEHIND_DELAY = float(os.environ.get('G4FCHAT_WRITE_DELAY', '1.0'))  # seconds dirty state may wait
+
+# Chat histories kept in memory; least recently used ones are dropped beyond this
+HISTORY_CACHE_BYTES = int(float(os.environ.get('G4FCHAT_HISTORY_CACHE_MB', '64')) * 1024 * 1024)
+HISTORY_MESSAGE_OVERHEAD = 250  # approximate bytes per message besides its text
+
+# Provider health scoreboard
+SCOREBOARD_EWMA_ALPHA = 0.3  # weight of the newest latency sample
+SCOREBOARD_RECENT_ERRORS = 5
+SCOREBOARD_DEFAULT_LATENCY = 10.0  # seconds assumed for providers without samples
+SCOREBOARD_LATENCY_SCALE = 10.0  # latency at which a provider's score halves
+SCOREBOARD_SAVE_INTERVAL = 10.0
+CIRCUIT_FAILURE_THRESHOLD = 3  # consecutive failures that open a circuit
+CIRCUIT_COOLDOWN = 300  # seconds before an open circuit allows a probe
+
+# Model index
+MODEL_REJECT_THRESHOLD = 2  # consecutive "model not supported" failures before a provider is skipped for a model
+MODEL_REJECT_TTL = 86400  # seconds a provider stays skipped before it is tried for the model again
 
 # Provider management
 # Updated based on common provider names and potential instability
@@ -116,14 +468,23 @@ TRANSLATIONS = {
         'saving_code': "Saved code blocks",
         'generating': "Generating response...",
         'model_set': "Model set",
+        'deadline': "Reply time limit in seconds (off = model default)",
+        'deadline_current': "Reply time limit",
+        'deadline_user': "your setting",
+        'deadline_model': "default for",
+        'deadline_invalid': "Give a number of seconds between {} and {}, or off",
         'model_error': "Model not available",
         'chat_created': "New chat created",
         'chat_switched': "Switched to chat",
+        'chat_restored': "Chat restored from the archive",
+        'export': "Export a chat to a JSON file",
+        'chat_exported': "Chat exported to",
         'chat_not_found': "Chat not found",
         'chat_deleted': "Chat deleted",
         'no_chats': "No chats available",
         'your_chats': "Your Chats",
         'available_models': "Available models",
+        'provider_counts': "(n) = providers serving the model",
         'active_providers': "Active providers",
         'system_status_title': "System status",
         'exit_confirmation': "Exiting...",
@@ -132,6 +493,8 @@ TRANSLATIONS = {
         'main_error': "Error occurred",
         'code_saved': "Saved {} code block(s)",
         'stats_title': "Usage Statistics",
+        'stats_verified': "Counters match the store",
+        'stats_corrected': "Counters corrected from the store",
         'total_messages': "Total messages",
         'saved_blocks': "Saved code blocks",
         'active_chats': "Active chats",
@@ -149,7 +512,24 @@ TRANSLATIONS = {
         'timeout_error': "Request timed out. Trying another provider...",
         'no_response_error': "Received empty response. Trying another provider...",
         'using_client_api': "Using G4F Client API",
-        'using_legacy_api': "Using G4F Legacy API"
+        'using_legacy_api': "Using G4F Legacy API",
+        'response_cache': "Response cache",
+        'cache_hits': "hits",
+        'cache_misses': "misses",
+        'coalesced': "Coalesced requests",
+        'coalesced_joined': "joined",
+        'coalesced_upstream': "upstream",
+        'history_cache': "Chats in memory",
+        'search': "Search messages in all chats",
+        'search_title': "Search results",
+        'search_empty': "Nothing found",
+        'perf': "Show latency and error metrics",
+        'perf_title': "Performance",
+        'perf_empty': "No requests measured yet",
+        'perf_attempts': "Attempts per reply",
+        'perf_turns': "Turn time",
+        'perf_persistence': "Persistence",
+        'perf_postprocess': "Post-processing"
     },
     'ru': {
         'welcome': "Консольный AI Чат",
@@ -177,14 +557,23 @@ TRANSLATIONS = {
         'saving_code': "Сохраненные блоки кода",
         'generating': "Генерация ответа...",
         'model_set': "Модель установлена",
+        'deadline': "Лимит времени на ответ в секундах (off = по модели)",
+        'deadline_current': "Лимит времени на ответ",
+        'deadline_user': "ваша настройка",
+        'deadline_model': "по умолчанию для",
+        'deadline_invalid': "Укажите число секунд от {} до {} или off",
         'model_error': "Модель недоступна",
         'chat_created': "Новый чат создан",
         'chat_switched': "Переключено на чат",
+        'chat_restored': "Чат восстановлен из архива",
+        'export': "Экспортировать чат в JSON-файл",
+        'chat_exported': "Чат экспортирован в",
         'chat_not_found': "Чат не найден",
         'chat_deleted': "Чат удален",
         'no_chats': "Чаты отсутствуют",
         'your_chats': "Ваши чаты",
         'available_models': "Доступные модели",
+        'provider_counts': "(n) = провайдеры с поддержкой модели",
         'active_providers': "Активные провайдеры",
         'system_status_title': "Статус системы",
         'exit_confirmation': "Выход...",
@@ -193,6 +582,8 @@ TRANSLATIONS = {
         'main_error': "Ошибка выполнения",
         'code_saved': "Сохранено блоков кода: {}",
         'stats_title': "Статистика использования",
+        'stats_verified': "Счётчики совпадают с хранилищем",
+        'stats_corrected': "Счётчики исправлены по хранилищу",
         'total_messages': "Всего сообщений",
         'saved_blocks': "Сохранено блоков кода",
         'active_chats': "Активных чатов",
@@ -210,7 +601,24 @@ TRANSLATIONS = {
         'timeout_error': "Время запроса истекло. Пробуем другого провайдера...",
         'no_response_error': "Получен пустой ответ. Пробуем другого провайдера...",
         'using_client_api': "Используется G4F Client API",
-        'using_legacy_api': "Используется G4F Legacy API"
+        'using_legacy_api': "Используется G4F Legacy API",
+        'response_cache': "Кэш ответов",
+        'cache_hits': "попаданий",
+        'cache_misses': "промахов",
+        'coalesced': "Объединённые запросы",
+        'coalesced_joined': "присоединились",
+        'coalesced_upstream': "к провайдерам",
+        'history_cache': "Чатов в памяти",
+        'search': "Искать сообщения во всех чатах",
+        'search_title': "Результаты поиска",
+        'search_empty': "Ничего не найдено",
+        'perf': "Показать задержки и ошибки",
+        'perf_title': "Производительность",
+        'perf_empty': "Запросов ещё не было",
+        'perf_attempts': "Попыток на ответ",
+        'perf_turns': "Время хода",
+        'perf_persistence': "Сохранение",
+        'perf_postprocess': "Постобработка"
     }
 }
 
@@ -230,7 +638,7 @@ def save_user_lang(user_id: str, lang: str) -> None:
     user_id = str(user_id)
     with cache_lock:
         user_lang_cache[user_id] = lang
-        save_lang_cache()
+    save_lang_cache()
 
 def load_lang_cache() -> None:
     """Load language cache from file"""
@@ -249,20 +657,79 @@ def load_lang_cache() -> None:
 def save_lang_cache() -> None:
     """Save language cache to file"""
     try:
+        with cache_lock:
+            data = dict(user_lang_cache)
         lang_file = os.path.join(CONFIG_DIR, LANG_FILE)
-        with open(lang_file, 'w', encoding='utf-8') as f:
-            json.dump(user_lang_cache, f, ensure_ascii=False, indent=2)
+        get_writer().schedule(lang_file, lambda: atomic_write_json(lang_file, data))
     except Exception as e:
         logger.error(f"Error saving language: {e}")
 
-def get_all_providers() -> List[g4f.Provider.BaseProvider]:
-    """Get all available providers"""
+def scan_providers() -> List[g4f.Provider.BaseProvider]:
+    """Find all provider classes in g4f.Provider"""
     providers = []
     for _, obj in inspect.getmembers(g4f.Provider):
         if inspect.isclass(obj) and issubclass(obj, g4f.Provider.BaseProvider) and obj != g4f.Provider.BaseProvider:
             providers.append(obj)
     return providers
 
+provider_registry: Optional[dict] = None
+
+def load_provider_registry() -> Optional[dict]:
+    """Read the cached provider registry if it was written for the installed g4f version"""
+    global provider_registry
+    if provider_registry is not None:
+        return provider_registry
+    registry_file = os.path.join(CONFIG_DIR, PROVIDER_REGISTRY_FILE)
+    try:
+        if os.path.exists(registry_file):
+            with open(registry_file, 'r', encoding='utf-8') as f:
+                registry = json.load(f)
+            if registry.get("g4f_version") == G4F_VERSION:
+                provider_registry = registry
+                return registry
+    except Exception as e:
+        logger.warning(f"Provider registry load error: {e}")
+    return None
+
+def save_provider_registry(registry: dict) -> None:
+    """Write the provider registry cache"""
+    global provider_registry
+    try:
+        registry["g4f_version"] = G4F_VERSION
+        provider_registry = registry
+        snapshot = json.loads(json.dumps(registry))
+        registry_file = os.path.join(CONFIG_DIR, PROVIDER_REGISTRY_FILE)
+        get_writer().schedule(registry_file, lambda: atomic_write_json(registry_file, snapshot))
+    except Exception as e:
+        logger.error(f"Provider registry save error: {e}")
+
+def get_all_providers() -> List[Tuple[g4f.Provider.BaseProvider, bool]]:
+    """Get all providers with their working flags, from the registry cache when possible"""
+    registry = load_provider_registry()
+    if registry is not None and registry.get("providers"):
+        providers = []
+        for entry in registry.get("providers", []):
+            provider = getattr(g4f.Provider, entry["name"], None)
+            if provider is None:
+                break
+            providers.append((provider, entry["working"]))
+        else:
+            return providers
+        logger.info("Provider registry is stale, rescanning")
+    providers = []
+    for provider in scan_providers():
+        try:
+            # Use getattr for safer check if 'working' attribute might not exist
+            working = bool(getattr(provider, 'working', True))
+        except Exception as e:
+            logger.warning(f"Provider error {provider.__name__}: {str(e)[:100]}")
+            working = False
+        providers.append((provider, working))
+    registry = registry or {}
+    registry["providers"] = [{"name": provider.__name__, "working": working} for provider, working in providers]
+    save_provider_registry(registry)
+    return providers
+
 def init_providers() -> List[g4f.Provider.BaseProvider]:
     """Initialize and cache providers"""
     global active_providers, provider_classes
@@ -274,36 +741,341 @@ def init_providers() -> List[g4f.Provider.BaseProvider]:
         active_providers = []
         provider_classes = {}
         # Prioritize backup providers
-        for provider in all_providers:
+        for provider, working in all_providers:
             provider_name = provider.__name__
-            if provider_name in BACKUP_PROVIDERS and provider_name not in BLACKLISTED_PROVIDERS:
-                try:
-                    # Use hasattr for safer check if 'working' attribute might not exist
-                    if getattr(provider, 'working', True):
-                        active_providers.append(provider)
-                        provider_classes[provider_name] = provider
-                        logger.info(f"Added backup provider: {provider_name}")
-                except Exception as e:
-                    logger.warning(f"Backup provider error {provider_name}: {str(e)[:100]}")
+            if provider_name in BACKUP_PROVIDERS and provider_name not in BLACKLISTED_PROVIDERS and working:
+                active_providers.append(provider)
+                provider_classes[provider_name] = provider
+                logger.info(f"Added backup provider: {provider_name}")
         # Add other working providers
-        for provider in all_providers:
+        for provider, working in all_providers:
             provider_name = provider.__name__
             if (provider_name not in BLACKLISTED_PROVIDERS and
                 provider_name not in BACKUP_PROVIDERS and
-                provider not in active_providers):
-                try:
-                    if getattr(provider, 'working', True):
-                        active_providers.append(provider)
-                        provider_classes[provider_name] = provider
-                        logger.info(f"Added provider: {provider_name}")
-                except Exception as e:
-                    logger.warning(f"Provider error {provider_name}: {str(e)[:100]}")
+                provider not in provider_classes.values() and working):
+                active_providers.append(provider)
+                provider_classes[provider_name] = provider
         if not active_providers:
             logger.error("No providers available! Using fallback")
             # Consider adding a more robust fallback or raising an error
         logger.info(f"Active providers: {len(active_providers)}")
         return active_providers
 
+def classify_error(error: BaseException) -> str:
+    """Map a provider exception to a short error kind"""
+    text = f"{type(error).__name__} {error}".lower()
+    if isinstance(error, (TimeoutError, asyncio.TimeoutError)) or 'timeout' in text or 'timed out' in text:
+        return 'timeout'
+    if '429' in text or 'rate limit' in text or 'too many requests' in text:
+        return 'rate_limit'
+    if 'model' in text and ('not supported' in text or 'not found' in text or 'unknown' in text or 'invalid' in text):
+        return 'model_not_supported'
+    if '401' in text or '403' in text or 'auth' in text or 'api key' in text or 'cloudflare' in text:
+        return 'auth'
+    return 'other'
+
+def is_connection_error(error: BaseException) -> bool:
+    """Whether a provider error, or one it was raised from, broke the connection: socket errors
+    and the connection errors of aiohttp and curl_cffi, but not timeouts"""
+    while error is not None:
+        if not isinstance(error, TimeoutError):
+            names = {cls.__name__ for cls in type(error).__mro__}
+            if isinstance(error, OSError) or names & {'ConnectionError', 'ClientConnectionError'}:
+                return True
+        error = error.__cause__ or error.__context__
+    return False
+
+class ProviderScoreboard:
+    """Per-(provider, model) health: success rate, EWMA latency, recent errors and a circuit breaker.
+
+    Circuit states: "closed" (in use), "open" (skipped until the cooldown
+    passes) and "half_open" (one probe request allowed; success closes the
+    circuit, failure opens it again).
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._records: Dict[str, dict] = {}
+        self._lock = Lock()
+        self._dirty = False
+        self._last_save = 0.0
+        self.load()
+
+    @staticmethod
+    def _key(provider_name: str, model_name: str) -> str:
+        return f"{provider_name}|{model_name}"
+
+    def _record(self, provider_name: str, model_name: str) -> dict:
+        key = self._key(provider_name, model_name)
+        if key not in self._records:
+            self._records[key] = {
+                "successes": 0,
+                "failures": 0,
+                "consecutive_failures": 0,
+                "ewma_latency": None,
+                "errors": [],
+                "state": "closed",
+                "opened_at": 0.0,
+                "probing": False
+            }
+        return self._records[key]
+
+    def load(self) -> None:
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    self._records = json.load(f)
+                for record in self._records.values():
+                    record["probing"] = False
+        except Exception as e:
+            logger.error(f"Provider scores load error: {e}")
+            self._records = {}
+
+    def save(self, force: bool = False) -> None:
+        """Write scores to disk, at most once per SCOREBOARD_SAVE_INTERVAL unless forced"""
+        with self._lock:
+            if not self._dirty or (not force and time.time() - self._last_save < SCOREBOARD_SAVE_INTERVAL):
+                return
+            data = json.loads(json.dumps(self._records))
+            self._dirty = False
+            self._last_save = time.time()
+        get_writer().schedule(self.path, lambda: atomic_write_json(self.path, data))
+
+    def record_success(self, provider_name: str, model_name: str, latency: float) -> None:
+        with self._lock:
+            record = self._record(provider_name, model_name)
+            record["successes"] += 1
+            record["consecutive_failures"] = 0
+            previous = record["ewma_latency"]
+            record["ewma_latency"] = latency if previous is None else (
+                SCOREBOARD_EWMA_ALPHA * latency + (1 - SCOREBOARD_EWMA_ALPHA) * previous
+            )
+            if record["state"] != "closed":
+                logger.info(f"Circuit closed: {provider_name} ({model_name})")
+            record["state"] = "closed"
+            record["probing"] = False
+            self._dirty = True
+        self.save()
+
+    def record_failure(self, provider_name: str, model_name: str, error_kind: str) -> None:
+        with self._lock:
+            record = self._record(provider_name, model_name)
+            record["failures"] += 1
+            record["consecutive_failures"] += 1
+            record["errors"] = (record["errors"] + [error_kind])[-SCOREBOARD_RECENT_ERRORS:]
+            if record["state"] == "half_open" or record["consecutive_failures"] >= CIRCUIT_FAILURE_THRESHOLD:
+                if record["state"] != "open":
+                    logger.info(f"Circuit opened: {provider_name} ({model_name}) after {error_kind}")
+                record["state"] = "open"
+                record["opened_at"] = time.time()
+            record["probing"] = False
+            self._dirty = True
+        self.save()
+
+    def allow(self, provider_name: str, model_name: str) -> bool:
+        """Whether a request may go to the provider now. Claims the probe of a half-open circuit."""
+        with self._lock:
+            record = self._records.get(self._key(provider_name, model_name))
+            if record is None or record["state"] == "closed":
+                return True
+            if record["state"] == "open":
+                if time.time() - record["opened_at"] < CIRCUIT_COOLDOWN:
+                    return False
+                record["state"] = "half_open"
+            if record["probing"]:
+                return False
+            record["probing"] = True
+            return True
+
+    def release_probe(self, provider_name: str, model_name: str) -> None:
+        """Give back a half-open probe whose request was cancelled"""
+        with self._lock:
+            record = self._records.get(self._key(provider_name, model_name))
+            if record is not None:
+                record["probing"] = False
+
+    def is_open(self, provider_name: str, model_name: str) -> bool:
+        """Whether the circuit is open and still cooling down"""
+        with self._lock:
+            record = self._records.get(self._key(provider_name, model_name))
+            return bool(record and record["state"] == "open" and time.time() - record["opened_at"] < CIRCUIT_COOLDOWN)
+
+    def score(self, provider_name: str, model_name: str) -> float:
+        """Higher is better: smoothed success rate discounted by EWMA latency"""
+        with self._lock:
+            record = self._records.get(self._key(provider_name, model_name))
+            if record is None:
+                return 0.5 / (1 + SCOREBOARD_DEFAULT_LATENCY / SCOREBOARD_LATENCY_SCALE)
+            success_rate = (record["successes"] + 1) / (record["successes"] + record["failures"] + 2)
+            latency = record["ewma_latency"] if record["ewma_latency"] is not None else SCOREBOARD_DEFAULT_LATENCY
+            return success_rate / (1 + latency / SCOREBOARD_LATENCY_SCALE)
+
+    def order(self, providers: List[g4f.Provider.BaseProvider], model_name: str) -> List[g4f.Provider.BaseProvider]:
+        """Providers by descending score, open circuits last; ties keep the given order"""
+        return sorted(
+            providers,
+            key=lambda provider: (
+                self.is_open(provider.__name__, model_name),
+                -self.score(provider.__name__, model_name)
+            )
+        )
+
+    def describe(self, provider_name: str, model_name: str) -> str:
+        """Short human-readable health summary"""
+        with self._lock:
+            record = self._records.get(self._key(provider_name, model_name))
+            if record is None:
+                return "new"
+            total = record["successes"] + record["failures"]
+            rate = record["successes"] / total * 100 if total else 0
+            latency = f"{record['ewma_latency']:.1f}s" if record["ewma_latency"] is not None else "-"
+            return f"{rate:.0f}% ok, {latency}, {record['state']}"
+
+provider_scoreboard: Optional[ProviderScoreboard] = None
+
+def get_scoreboard() -> ProviderScoreboard:
+    """Get the provider scoreboard, loading it on first use"""
+    global provider_scoreboard
+    with cache_lock:
+        if provider_scoreboard is None:
+            provider_scoreboard = ProviderScoreboard(os.path.join(CONFIG_DIR, PROVIDER_SCORES_FILE))
+        return provider_scoreboard
+
+def normalize_model_name(model_name: str) -> str:
+    return str(model_name).strip().lower()
+
+def declared_models(provider: g4f.Provider.BaseProvider) -> dict:
+    """Models a provider class declares, without any network calls.
+    "complete" means the provider lists its models, so others are assumed unsupported."""
+    def names(value: Any) -> Set[str]:
+        if not value:
+            return set()
+        if isinstance(value, str):
+            return {normalize_model_name(value)}
+        try:
+            return {normalize_model_name(name) for name in value if isinstance(name, str)}
+        except TypeError:
+            return set()
+    listed = names(getattr(provider, 'models', None))
+    served = set(listed) | names(getattr(provider, 'default_model', None))
+    aliases = getattr(provider, 'model_aliases', None)
+    if isinstance(aliases, dict):
+        served |= names(aliases.keys()) | names(aliases.values())
+    image_models = names(getattr(provider, 'image_models', None))
+    text_models = served - image_models
+    return {
+        "models": sorted(served),
+        "complete": bool(listed),
+        "image_only": bool(image_models) and not text_models
+    }
+
+class ModelIndex:
+    """Model-to-provider capability index: declared models from the provider
+    registry plus what was learned from requests at runtime.
+
+    A provider "serves" a model it declares or has answered for, and "may
+    serve" one when it keeps no complete model list. Providers that are
+    image-only, list their models without this one, or failed with "model not
+    supported" MODEL_REJECT_THRESHOLD times in a row are skipped. A rejection
+    lasts MODEL_REJECT_TTL; then the provider may serve the model again and
+    its scoreboard circuit decides when it is probed.
+    """
+
+    def __init__(self, providers: List[g4f.Provider.BaseProvider]):
+        self._lock = Lock()
+        self._registry = load_provider_registry() or {}
+        self._declared: Dict[str, dict] = self._registry.setdefault("models", {})
+        # learned[provider][model] is True when observed working, or {"failures": n, "at": time}
+        # after "model not supported" failures; older registries stored False
+        self._learned: Dict[str, Dict[str, Any]] = self._registry.setdefault("learned_models", {})
+        missing = [provider for provider in providers if provider.__name__ not in self._declared]
+        for provider in missing:
+            self._declared[provider.__name__] = declared_models(provider)
+        self._served: Dict[str, Set[str]] = {
+            name: set(entry["models"]) for name, entry in self._declared.items()
+        }
+        if missing:
+            self._save()
+
+    def _save(self) -> None:
+        with self._lock:
+            registry = json.loads(json.dumps(self._registry))
+        save_provider_registry(registry)
+
+    def _learned_state(self, provider_name: str, model: str) -> Optional[bool]:
+        """True if observed working, False while rejected, None if unknown or the rejection expired"""
+        learned = self._learned.get(provider_name, {}).get(model)
+        if learned is True:
+            return True
+        if (isinstance(learned, dict) and learned.get("failures", 0) >= MODEL_REJECT_THRESHOLD
+                and time.time() - learned.get("at", 0) < MODEL_REJECT_TTL):
+            return False
+        return None
+
+    def serves(self, provider_name: str, model_name: str) -> bool:
+        """Whether the provider declares the model or has answered for it"""
+        model = normalize_model_name(model_name)
+        with self._lock:
+            learned = self._learned_state(provider_name, model)
+            if learned is not None:
+                return learned
+            return model in self._served.get(provider_name, ())
+
+    def may_serve(self, provider_name: str, model_name: str) -> bool:
+        """Whether the provider is worth trying for the model at all"""
+        model = normalize_model_name(model_name)
+        with self._lock:
+            learned = self._learned_state(provider_name, model)
+            if learned is not None:
+                return learned
+            entry = self._declared.get(provider_name)
+            if entry is None:
+                return True
+            if model in self._served.get(provider_name, ()):
+                return True
+            return not entry["complete"] and not entry["image_only"]
+
+    def candidates(self, providers: List[g4f.Provider.BaseProvider],
+                   model_name: str) -> List[g4f.Provider.BaseProvider]:
+        """Providers known to serve the model, then those that may; each group keeps the given order"""
+        known = [provider for provider in providers if self.serves(provider.__name__, model_name)]
+        likely = [provider for provider in providers
+                  if provider not in known and self.may_serve(provider.__name__, model_name)]
+        return known + likely
+
+    def learn(self, provider_name: str, model_name: str, supported: bool) -> None:
+        """Record an observed answer or "model not supported" failure"""
+        model = normalize_model_name(model_name)
+        with self._lock:
+            learned = self._learned.setdefault(provider_name, {})
+            previous = learned.get(model)
+            if supported:
+                if previous is True:
+                    return
+                learned[model] = True
+            else:
+                failures = previous.get("failures", 0) + 1 if isinstance(previous, dict) else 1
+                learned[model] = {"failures": failures, "at": time.time()}
+                if failures < MODEL_REJECT_THRESHOLD:
+                    return
+        logger.info(f"Model index: {provider_name} {'serves' if supported else 'does not serve'} {model_name}")
+        self._save()
+
+    def provider_count(self, model_name: str, providers: List[g4f.Provider.BaseProvider]) -> int:
+        """Number of the given providers known to serve the model"""
+        return sum(1 for provider in providers if self.serves(provider.__name__, model_name))
+
+model_index: Optional[ModelIndex] = None
+
+def get_model_index() -> ModelIndex:
+    """Get the model capability index, building it on first use"""
+    global model_index
+    providers = init_providers()
+    with cache_lock:
+        if model_index is None:
+            model_index = ModelIndex(providers)
+        return model_index
+
 def load_user_models() -> Dict[str, str]:
     """Load user models with caching"""
     global user_models_cache
@@ -327,58 +1099,1462 @@ def save_user_models(data: Dict[str, str]) -> None:
     global user_models_cache
     with cache_lock:
         user_models_cache = data
+        snapshot = dict(data)
+    model_file = os.path.join(CONFIG_DIR, MODEL_FILE)
+    get_writer().schedule(model_file, lambda: atomic_write_json(model_file, snapshot))
+
+def load_user_deadlines() -> Dict[str, float]:
+    """Per-user reply time limits set with /deadline"""
+    global user_deadlines_cache
+    with cache_lock:
+        if user_deadlines_cache is not None:
+            return user_deadlines_cache
+        user_deadlines_cache = {}
         try:
-            model_file = os.path.join(CONFIG_DIR, MODEL_FILE)
-            with open(model_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+            deadline_file = os.path.join(CONFIG_DIR, DEADLINE_FILE)
+            if os.path.exists(deadline_file):
+                with open(deadline_file, 'r', encoding='utf-8') as f:
+                    user_deadlines_cache = json.load(f)
         except Exception as e:
-            logger.error(f"Error saving models: {e}")
+            logger.error(f"Deadline load error: {e}")
+        return user_deadlines_cache
+
+def save_user_deadline(user_id: str, seconds: Optional[float]) -> None:
+    """Set a user's reply time limit, or with None go back to the model's"""
+    deadlines = load_user_deadlines()
+    with cache_lock:
+        if seconds is None:
+            deadlines.pop(str(user_id), None)
+        else:
+            deadlines[str(user_id)] = seconds
+        snapshot = dict(deadlines)
+    deadline_file = os.path.join(CONFIG_DIR, DEADLINE_FILE)
+    get_writer().schedule(deadline_file, lambda: atomic_write_json(deadline_file, snapshot))
+
+def model_deadline(model_name: str) -> float:
+    """Reply time limit for a model: the longest matching MODEL_DEADLINES prefix, else REQUEST_DEADLINE"""
+    matches = [prefix for prefix in MODEL_DEADLINES if model_name.lower().startswith(prefix)]
+    return float(MODEL_DEADLINES[max(matches, key=len)]) if matches else REQUEST_DEADLINE
+
+def deadline_seconds(user_id: Optional[str], model_name: str) -> float:
+    """Reply time limit for a user and model"""
+    if user_id is not None:
+        seconds = load_user_deadlines().get(str(user_id))
+        if seconds:
+            return float(seconds)
+    return model_deadline(model_name)
+
+def atomic_write_json(path: str, data: Any, indent: Optional[int] = 2) -> None:
+    """Write JSON through a temp file and rename it over the target"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=indent)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def atomic_write_text(path: str, text: str) -> None:
+    """Write text through a temp file and rename it over the target"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+class WriteBehind:
+    """Background writer for persisted state.
+
+    Writes are queued by key; queuing a key that is still pending replaces
+    its write, so only the newest state reaches the disk. Pending writes run
+    on one thread WRITE_BEHIND_DELAY seconds after the first was queued, or
+    at once on flush() and close(). After close() writes run inline.
+    """
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self._pending: "OrderedDict[str, Callable[[], None]]" = OrderedDict()
+        self._cond = threading.Condition()
+        self._due: Optional[float] = None
+        self._queued = 0
+        self._written = 0
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+
+    def schedule(self, key: str, write: Callable[[], None]) -> None:
+        """Queue write() under key, replacing a pending write of the same key"""
+        with self._cond:
+            if not self._closed:
+                self._pending[key] = write
+                self._queued += 1
+                if self._due is None:
+                    self._due = time.monotonic() + self.delay
+                    self._cond.notify_all()
+                return
+        self._write(key, write)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Write everything queued so far and wait for it; False on timeout"""
+        with self._cond:
+            target = self._queued
+            if self._written >= target:
+                return True
+            self._due = time.monotonic()
+            self._cond.notify_all()
+            return self._cond.wait_for(lambda: self._written >= target, timeout)
+
+    def close(self) -> None:
+        """Flush pending writes and stop the writer thread"""
+        with self._cond:
+            self._closed = True
+            self._due = time.monotonic()
+            self._cond.notify_all()
+        self._thread.join()
+
+    @property
+    def pending(self) -> int:
+        with self._cond:
+            return len(self._pending)
+
+    @staticmethod
+    def _write(key: str, write: Callable[[], None]) -> None:
+        started = time.perf_counter()
+        try:
+            write()
+        except Exception as e:
+            logger.error(f"Write-behind error: {e}")
+        perf.observe('persist_seconds', time.perf_counter() - started, target=persist_target(key))
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._pending or time.monotonic() < self._due:
+                    if self._closed and not self._pending:
+                        return
+                    self._cond.wait(self._due - time.monotonic() if self._pending else None)
+                batch = list(self._pending.items())
+                self._pending.clear()
+                written = self._queued
+                self._due = None
+            for key, write in batch:
+                self._write(key, write)
+            with self._cond:
+                self._written = written
+                self._cond.notify_all()
+
+def persist_target(key: str) -> str:
+    """Metric label for a write-behind key: "chats", "metrics", "code" or the file name"""
+    if os.path.basename(os.path.dirname(key)) == "saved_code":
+        return "code"
+    return os.path.splitext(os.path.basename(key))[0]
+
+write_behind: Optional[WriteBehind] = None
+
+def get_writer() -> WriteBehind:
+    """Get the write-behind writer, starting it on first use"""
+    global write_behind
+    with writer_lock:
+        if write_behind is None:
+            write_behind = WriteBehind(WRITE_BEHIND_DELAY)
+            atexit.register(write_behind.close)
+        return write_behind
+
+def flush_writes(timeout: Optional[float] = None) -> bool:
+    """Write all pending state to disk now"""
+    return get_writer().flush(timeout)
+
+def safe_file_name(name: str) -> str:
+    """Turn a user or chat id into a file name"""
+    name = str(name)
+    if re.fullmatch(r'[\w.-]{1,64}', name) and not name.startswith('.'):
+        return name
+    return hashlib.sha1(name.encode('utf-8')).hexdigest()
+
+class ChatStore:
+    """Base chat store.
+
+    Keeps an in-memory mirror of chat metadata (message count, provider,
+    creation time, active chat) so that syncing the chat cache only writes
+    what changed, and metadata lookups never touch the disk. Backends
+    implement the underscore-prefixed write primitives and load_history.
+    """
+
+    def __init__(self):
+        # user_id -> chat_id -> {"messages": n, "provider": ..., "created": ...}
+        self._meta: Dict[str, Dict[str, dict]] = {}
+        self._active: Dict[str, Optional[str]] = {}
+
+    # Backend primitives
+    def load(self) -> Dict[str, dict]:
+        """Load users and chats. Chats may omit "history" until load_history is called"""
+        raise NotImplementedError
+
+    def load_history(self, user_id: str, chat_id: str) -> List[dict]:
+        """Load one chat history"""
+        raise NotImplementedError
+
+    def _write_chat(self, user_id: str, chat_id: str, chat_data: dict) -> None:
+        raise NotImplementedError
+
+    def _append_messages(self, user_id: str, chat_id: str, start: int, messages: List[dict]) -> None:
+        raise NotImplementedError
+
+    def _set_provider(self, user_id: str, chat_id: str, provider: Optional[str]) -> None:
+        raise NotImplementedError
+
+    def _set_active(self, user_id: str, chat_id: Optional[str]) -> None:
+        raise NotImplementedError
+
+    def _delete_chat(self, user_id: str, chat_id: str) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        """Finish pending background work"""
+
+    def load_counters(self) -> Optional[Dict[str, float]]:
+        """Persisted usage counters, or None if none were saved"""
+        return None
+
+    def save_counters(self, counters: Dict[str, float]) -> None:
+        """Persist usage counters"""
+
+    # Metadata queries
+    def list_chat_meta(self, user_id: str) -> Dict[str, dict]:
+        """Chat metadata for a user, in creation order"""
+        # list() copies the items at once, as the write-behind thread may be syncing
+        return {chat_id: dict(meta) for chat_id, meta in list(self._meta.get(user_id, {}).items())}
+
+    def chat_exists(self, user_id: str, chat_id: str) -> bool:
+        return chat_id in self._meta.get(user_id, {})
+
+    def get_active(self, user_id: str) -> Optional[str]:
+        return self._active.get(user_id)
+
+    def totals(self) -> Tuple[int, int]:
+        """Total (chats, messages) across all users"""
+        chats = sum(len(user_meta) for user_meta in self._meta.values())
+        messages = sum(meta["messages"] for user_meta in self._meta.values() for meta in user_meta.values())
+        return chats, messages
+
+    # Writes
+    def write_chat(self, user_id: str, chat_id: str, chat_data: dict) -> None:
+        """Persist a whole chat, replacing any previous copy"""
+        self._write_chat(user_id, chat_id, chat_data)
+        self._meta.setdefault(user_id, {})[chat_id] = {
+            "messages": len(chat_data.get("history", [])),
+            "provider": chat_data.get("provider"),
+            "created": chat_data.get("created")
+        }
+
+    def append_messages(self, user_id: str, chat_id: str, messages: List[dict]) -> None:
+        """Persist messages appended to a chat"""
+        meta = self._meta[user_id][chat_id]
+        self._append_messages(user_id, chat_id, meta["messages"], messages)
+        meta["messages"] += len(messages)
+
+    def set_provider(self, user_id: str, chat_id: str, provider: Optional[str]) -> None:
+        """Persist the chat provider"""
+        self._set_provider(user_id, chat_id, provider)
+        self._meta[user_id][chat_id]["provider"] = provider
+
+    def set_active(self, user_id: str, chat_id: Optional[str]) -> None:
+        """Persist the user's active chat"""
+        self._set_active(user_id, chat_id)
+        self._active[user_id] = chat_id
+
+    def delete_chat(self, user_id: str, chat_id: str) -> None:
+        """Remove a chat"""
+        self._delete_chat(user_id, chat_id)
+        self._meta.get(user_id, {}).pop(chat_id, None)
+
+    def last_modified(self, user_id: str, chat_id: str) -> Optional[float]:
+        """When the chat was last written, if the backend knows"""
+        return None
+
+    def message_count(self, user_id: str, chat_id: str) -> Optional[int]:
+        """Messages persisted for a chat, or None if the chat was never written"""
+        meta = self._meta.get(user_id, {}).get(chat_id)
+        return meta["messages"] if meta else None
+
+    def remember(self, data: Dict[str, dict], counts: Dict[Tuple[str, str], int]) -> None:
+        """Record data, whose chats have counts[(user_id, chat_id)] messages, as already persisted"""
+        for user_id, user_data in data.items():
+            self._active[user_id] = user_data.get("active")
+            user_meta = self._meta.setdefault(user_id, {})
+            for chat_id, chat_data in user_data.get("chats", {}).items():
+                user_meta[chat_id] = {
+                    "messages": counts.get((user_id, chat_id), 0),
+                    "provider": chat_data.get("provider"),
+                    "created": chat_data.get("created")
+                }
+
+    def sync(self, data: Dict[str, dict]) -> None:
+        """Persist the difference between data and the last synced state.
+        Histories are append-only; a shorter history is rewritten as a whole.
+        Chats whose history was never loaded only sync their provider."""
+        for user_id, user_data in data.items():
+            user_meta = self._meta.get(user_id, {})
+            for chat_id, chat_data in user_data.get("chats", {}).items():
+                meta = user_meta.get(chat_id)
+                history = chat_data.get("history")
+                if meta is None or (history is not None and len(history) < meta["messages"]):
+                    chat_data.setdefault("history", [])
+                    self.write_chat(user_id, chat_id, chat_data)
+                    continue
+                if history is not None and len(history) > meta["messages"]:
+                    self.append_messages(user_id, chat_id, history[meta["messages"]:])
+                if chat_data.get("provider") != meta["provider"]:
+                    self.set_provider(user_id, chat_id, chat_data.get("provider"))
+            active = user_data.get("active")
+            if user_id not in self._active or self._active[user_id] != active:
+                self.set_active(user_id, active)
+        for user_id, user_meta in self._meta.items():
+            chats = data.get(user_id, {}).get("chats", {})
+            for chat_id in [cid for cid in user_meta if cid not in chats]:
+                self.delete_chat(user_id, chat_id)
+
+    def import_legacy(self) -> Dict[str, dict]:
+        """Import chats from the legacy user_chats.json file, if any"""
+        legacy_file = os.path.join(CONFIG_DIR, USER_CHATS_FILE)
+        if not os.path.exists(legacy_file):
+            return {}
+        with open(legacy_file, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        self.import_chats(data)
+        logger.info(f"Migrated {sum(len(u.get('chats', {})) for u in data.values())} chats from {legacy_file}")
+        return data
+
+    def import_chats(self, data: Dict[str, dict]) -> None:
+        """Write every chat in data"""
+        for user_id, user_data in data.items():
+            for chat_id, chat_data in user_data.get("chats", {}).items():
+                chat_data.setdefault("history", [])
+                self.write_chat(user_id, chat_id, chat_data)
+            self.set_active(user_id, user_data.get("active"))
+
+class JournalChatStore(ChatStore):
+    """Append-only per-chat journals with background compaction.
+
+    Layout under the journal directory:
+      index.json              - {user_id: {"dir": ..., "active": ..., "chats": {file name: metadata}}}
+      <user>/<chat>.jsonl     - one JSON record per line: "meta", "msg" or "provider"
+
+    The index caches each journal's chat id, message count, provider and
+    creation time with the file size and mtime they were read at, so loading
+    only replays journals that changed since; histories are read per chat.
+    The cache is refreshed on load, compaction and close, never per write,
+    so a sync only touches the journals of the chats it changed.
+    """
+
+    def __init__(self, root: str):
+        super().__init__()
+        self.root = root
+        self.index_path = os.path.join(root, JOURNAL_INDEX_FILE)
+        self.counters_path = os.path.join(root, JOURNAL_COUNTERS_FILE)
+        self._index: Dict[str, dict] = {}
+        self._stale: Dict[Tuple[str, str], int] = {}
+        self._pending: Set[Tuple[str, str]] = set()
+        self._changed: Set[Tuple[str, str]] = set()  # chats whose index metadata is out of date
+        self._io_lock = threading.RLock()
+        self._compact_queue: "queue.Queue[Optional[Tuple[str, str]]]" = queue.Queue()
+        self._compactor: Optional[threading.Thread] = None
+        os.makedirs(root, exist_ok=True)
+
+    def _chat_path(self, user_id: str, chat_id: str) -> str:
+        user_dir = self._index.get(user_id, {}).get("dir") or safe_file_name(user_id)
+        return os.path.join(self.root, user_dir, f"{safe_file_name(chat_id)}.jsonl")
+
+    def _ensure_user(self, user_id: str) -> None:
+        if user_id not in self._index:
+            self._index[user_id] = {"dir": safe_file_name(user_id), "active": None}
+            os.makedirs(os.path.join(self.root, self._index[user_id]["dir"]), exist_ok=True)
+            atomic_write_json(self.index_path, self._index)
+
+    def _snapshot_records(self, chat_id: str, chat_data: dict) -> List[dict]:
+        records = [{
+            "op": "meta",
+            "chat_id": chat_id,
+            "created": chat_data.get("created"),
+            "provider": chat_data.get("provider")
+        }]
+        records.extend({"op": "msg", "msg": msg} for msg in chat_data.get("history", []))
+        return records
+
+    def _write_records(self, path: str, records: List[dict]) -> None:
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def _append_records(self, path: str, records: List[dict]) -> None:
+        with open(path, 'a', encoding='utf-8') as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _read_chat(self, path: str) -> Tuple[Optional[str], dict, int, bool]:
+        """Replay a journal. Returns (chat_id, chat_data, stale_records, torn_tail)"""
+        chat_id = None
+        chat_data = {"history": [], "provider": None, "created": None}
+        stale = 0
+        torn = False
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # A crash mid-append leaves a partial last line
+                    torn = True
+                    break
+                op = record.get("op")
+                if op == "msg":
+                    chat_data["history"].append(record["msg"])
+                elif op == "provider":
+                    chat_data["provider"] = record.get("provider")
+                    stale += 1
+                elif op == "meta":
+                    chat_id = record.get("chat_id")
+                    chat_data["created"] = record.get("created")
+                    chat_data["provider"] = record.get("provider")
+        return chat_id, chat_data, stale, torn
+
+    def load(self) -> Dict[str, dict]:
+        with self._io_lock:
+            if not os.path.exists(self.index_path):
+                data = self.import_legacy()
+                for user_id, user_data in data.items():
+                    for chat_data in user_data.get("chats", {}).values():
+                        chat_data.pop("history", None)
+                self._save_index()
+                return data
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                self._index = json.load(f)
+            data = {}
+            counts = {}
+            replayed = 0
+            for user_id, entry in self._index.items():
+                user_dir = os.path.join(self.root, entry.get("dir") or safe_file_name(user_id))
+                cached = entry.setdefault("chats", {})
+                chats = {}
+                if os.path.isdir(user_dir):
+                    for file_name in sorted(os.listdir(user_dir)):
+                        if not file_name.endswith(".jsonl"):
+                            continue
+                        path = os.path.join(user_dir, file_name)
+                        stat = os.stat(path)
+                        meta = cached.get(file_name)
+                        if meta and meta.get("size") == stat.st_size and meta.get("mtime_ns") == stat.st_mtime_ns:
+                            chat_id = meta["chat_id"]
+                            chats[chat_id] = {"provider": meta.get("provider"), "created": meta.get("created")}
+                            counts[(user_id, chat_id)] = meta["messages"]
+                            if meta.get("stale"):
+                                self._stale[(user_id, chat_id)] = meta["stale"]
+                            continue
+                        chat_id, chat_data, stale, torn = self._read_chat(path)
+                        chat_id = chat_id or file_name[:-len(".jsonl")]
+                        replayed += 1
+                        if torn:
+                            logger.warning(f"Truncated journal tail in {path}, compacting")
+                            self._write_records(path, self._snapshot_records(chat_id, chat_data))
+                            stale = 0
+                        counts[(user_id, chat_id)] = len(chat_data.pop("history"))
+                        chats[chat_id] = chat_data
+                        if stale:
+                            self._stale[(user_id, chat_id)] = stale
+                        self._changed.add((user_id, chat_id))
+                # Drop metadata of journals removed behind our back
+                for file_name in [name for name in cached if not os.path.exists(os.path.join(user_dir, name))]:
+                    del cached[file_name]
+                # Keep creation order, as the legacy JSON file did
+                chats = dict(sorted(chats.items(), key=lambda item: item[1].get("created") or 0))
+                data[user_id] = {"chats": chats, "active": entry.get("active")}
+            self.remember(data, counts)
+            if replayed:
+                logger.info(f"Replayed {replayed} changed journals")
+                self._save_index()
+            return data
+
+    def _save_index(self) -> None:
+        """Refresh the cached metadata of changed chats and write the index"""
+        with self._io_lock:
+            for user_id, chat_id in self._changed:
+                entry = self._index.get(user_id)
+                if entry is None:
+                    continue
+                path = self._chat_path(user_id, chat_id)
+                file_name = os.path.basename(path)
+                meta = self._meta.get(user_id, {}).get(chat_id)
+                if meta is None or not os.path.exists(path):
+                    entry.setdefault("chats", {}).pop(file_name, None)
+                    continue
+                stat = os.stat(path)
+                entry.setdefault("chats", {})[file_name] = {
+                    "chat_id": chat_id,
+                    "messages": meta["messages"],
+                    "provider": meta["provider"],
+                    "created": meta["created"],
+                    "stale": self._stale.get((user_id, chat_id), 0),
+                    "size": stat.st_size,
+                    "mtime_ns": stat.st_mtime_ns
+                }
+            self._changed.clear()
+            atomic_write_json(self.index_path, self._index)
+
+    def load_history(self, user_id: str, chat_id: str) -> List[dict]:
+        with self._io_lock:
+            path = self._chat_path(user_id, chat_id)
+            if not os.path.exists(path):
+                return []
+            return self._read_chat(path)[1]["history"]
+
+    def last_modified(self, user_id: str, chat_id: str) -> Optional[float]:
+        try:
+            return os.path.getmtime(self._chat_path(user_id, chat_id))
+        except OSError:
+            return None
+
+    def _write_chat(self, user_id: str, chat_id: str, chat_data: dict) -> None:
+        with self._io_lock:
+            self._ensure_user(user_id)
+            self._write_records(self._chat_path(user_id, chat_id), self._snapshot_records(chat_id, chat_data))
+            self._stale.pop((user_id, chat_id), None)
+            self._changed.add((user_id, chat_id))
+
+    def _append_messages(self, user_id: str, chat_id: str, start: int, messages: List[dict]) -> None:
+        with self._io_lock:
+            self._append_records(self._chat_path(user_id, chat_id), [{"op": "msg", "msg": msg} for msg in messages])
+            self._changed.add((user_id, chat_id))
+
+    def _set_provider(self, user_id: str, chat_id: str, provider: Optional[str]) -> None:
+        with self._io_lock:
+            self._append_records(self._chat_path(user_id, chat_id), [{"op": "provider", "provider": provider}])
+            self._changed.add((user_id, chat_id))
+            stale = self._stale.get((user_id, chat_id), 0) + 1
+            self._stale[(user_id, chat_id)] = stale
+        if stale >= JOURNAL_COMPACT_THRESHOLD:
+            self._schedule_compaction(user_id, chat_id)
+
+    def _set_active(self, user_id: str, chat_id: Optional[str]) -> None:
+        with self._io_lock:
+            self._ensure_user(user_id)
+            self._index[user_id]["active"] = chat_id
+            atomic_write_json(self.index_path, self._index)
+
+    def _delete_chat(self, user_id: str, chat_id: str) -> None:
+        with self._io_lock:
+            path = self._chat_path(user_id, chat_id)
+            if os.path.exists(path):
+                os.remove(path)
+            self._stale.pop((user_id, chat_id), None)
+            self._changed.add((user_id, chat_id))
+
+    def compact(self, user_id: str, chat_id: str) -> None:
+        """Rewrite a chat journal as a single snapshot"""
+        with self._io_lock:
+            path = self._chat_path(user_id, chat_id)
+            if not os.path.exists(path):
+                return
+            stored_id, chat_data, _, _ = self._read_chat(path)
+            self._write_records(path, self._snapshot_records(stored_id or chat_id, chat_data))
+            self._stale.pop((user_id, chat_id), None)
+            self._changed.add((user_id, chat_id))
+            self._save_index()
+        logger.info(f"Compacted journal {path}")
+
+    def _schedule_compaction(self, user_id: str, chat_id: str) -> None:
+        with self._io_lock:
+            if (user_id, chat_id) in self._pending:
+                return
+            self._pending.add((user_id, chat_id))
+        if self._compactor is None or not self._compactor.is_alive():
+            self._compactor = threading.Thread(target=self._compaction_worker, name="journal-compactor", daemon=True)
+            self._compactor.start()
+        self._compact_queue.put((user_id, chat_id))
+
+    def _compaction_worker(self) -> None:
+        while True:
+            item = self._compact_queue.get()
+            try:
+                if item is None:
+                    return
+                self.compact(*item)
+            except Exception as e:
+                logger.error(f"Journal compaction error: {e}")
+            finally:
+                if item is not None:
+                    with self._io_lock:
+                        self._pending.discard(item)
+                self._compact_queue.task_done()
+
+    def load_counters(self) -> Optional[Dict[str, float]]:
+        try:
+            if os.path.exists(self.counters_path):
+                with open(self.counters_path, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+        except Exception as e:
+            logger.error(f"Counters load error: {e}")
+        return None
+
+    def save_counters(self, counters: Dict[str, float]) -> None:
+        atomic_write_json(self.counters_path, counters)
+
+    def close(self) -> None:
+        if self._compactor is not None and self._compactor.is_alive():
+            self._compact_queue.put(None)
+            self._compactor.join()
+        with self._io_lock:
+            if self._changed:
+                self._save_index()
+
+class SQLiteChatStore(ChatStore):
+    """SQLite chat store. Loads only chat metadata; histories are read per chat"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id TEXT PRIMARY KEY,
+            active_chat TEXT
+        );
+        CREATE TABLE IF NOT EXISTS chats (
+            user_id TEXT NOT NULL,
+            chat_id TEXT NOT NULL,
+            provider TEXT,
+            created REAL,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            modified REAL,
+            PRIMARY KEY (user_id, chat_id)
+        );
+        CREATE TABLE IF NOT EXISTS messages (
+            user_id TEXT NOT NULL,
+            chat_id TEXT NOT NULL,
+            ordinal INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            PRIMARY KEY (user_id, chat_id, ordinal)
+        );
+        CREATE INDEX IF NOT EXISTS idx_chats_user ON chats (user_id, created);
+        CREATE TABLE IF NOT EXISTS counters (
+            name TEXT PRIMARY KEY,
+            value REAL NOT NULL
+        );
+    """
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self._db_lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self.SCHEMA)
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(chats)")]
+        if "modified" not in columns:
+            # Databases from before last-write times: count every chat as written now,
+            # so the archiver does not take chats that are still in use
+            with self._transaction():
+                self._conn.execute("ALTER TABLE chats ADD COLUMN modified REAL")
+                self._conn.execute("UPDATE chats SET modified = ?", (time.time(),))
+
+    def _transaction(self):
+        return _SQLiteTransaction(self._conn, self._db_lock)
+
+    def load(self) -> Dict[str, dict]:
+        with self._db_lock:
+            if self._conn.execute("SELECT 1 FROM users LIMIT 1").fetchone() is None:
+                journal_index = os.path.join(CONFIG_DIR, JOURNAL_DIR, JOURNAL_INDEX_FILE)
+                if os.path.exists(journal_index):
+                    journal = JournalChatStore(os.path.dirname(journal_index))
+                    data = journal.load()
+                    for user_id, user_data in data.items():
+                        for chat_id, chat_data in user_data["chats"].items():
+                            chat_data["history"] = journal.load_history(user_id, chat_id)
+                    self.import_chats(data)
+                    logger.info(f"Migrated chats from {journal_index}")
+                else:
+                    self.import_legacy()
+            data = {}
+            for user_id, active in self._conn.execute("SELECT user_id, active_chat FROM users"):
+                data[user_id] = {"chats": {}, "active": active}
+                self._active[user_id] = active
+            rows = self._conn.execute(
+                "SELECT user_id, chat_id, provider, created, message_count FROM chats ORDER BY user_id, created"
+            )
+            for user_id, chat_id, provider, created, count in rows:
+                user_data = data.setdefault(user_id, {"chats": {}, "active": None})
+                user_data["chats"][chat_id] = {"provider": provider, "created": created}
+                self._meta.setdefault(user_id, {})[chat_id] = {
+                    "messages": count, "provider": provider, "created": created
+                }
+            return data
+
+    def load_history(self, user_id: str, chat_id: str) -> List[dict]:
+        with self._db_lock:
+            rows = self._conn.execute(
+                "SELECT role, content FROM messages WHERE user_id = ? AND chat_id = ? ORDER BY ordinal",
+                (user_id, chat_id)
+            ).fetchall()
+        return [{"role": role, "content": content} for role, content in rows]
+
+    def list_chat_meta(self, user_id: str) -> Dict[str, dict]:
+        with self._db_lock:
+            rows = self._conn.execute(
+                "SELECT chat_id, provider, created, message_count FROM chats WHERE user_id = ? ORDER BY created",
+                (user_id,)
+            ).fetchall()
+        return {
+            chat_id: {"messages": count, "provider": provider, "created": created}
+            for chat_id, provider, created, count in rows
+        }
+
+    def chat_exists(self, user_id: str, chat_id: str) -> bool:
+        with self._db_lock:
+            return self._conn.execute(
+                "SELECT 1 FROM chats WHERE user_id = ? AND chat_id = ?", (user_id, chat_id)
+            ).fetchone() is not None
+
+    def get_active(self, user_id: str) -> Optional[str]:
+        with self._db_lock:
+            row = self._conn.execute("SELECT active_chat FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        return row[0] if row else None
+
+    def last_modified(self, user_id: str, chat_id: str) -> Optional[float]:
+        with self._db_lock:
+            row = self._conn.execute(
+                "SELECT modified FROM chats WHERE user_id = ? AND chat_id = ?", (user_id, chat_id)
+            ).fetchone()
+        return row[0] if row else None
+
+    def _ensure_user(self, user_id: str) -> None:
+        self._conn.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,))
+
+    def _insert_messages(self, user_id: str, chat_id: str, start: int, messages: List[dict]) -> None:
+        self._conn.executemany(
+            "INSERT INTO messages (user_id, chat_id, ordinal, role, content) VALUES (?, ?, ?, ?, ?)",
+            [(user_id, chat_id, start + i, msg.get("role", ""), msg.get("content", "")) for i, msg in enumerate(messages)]
+        )
+
+    def _write_chat(self, user_id: str, chat_id: str, chat_data: dict) -> None:
+        history = chat_data.get("history", [])
+        with self._transaction():
+            self._ensure_user(user_id)
+            self._conn.execute("DELETE FROM messages WHERE user_id = ? AND chat_id = ?", (user_id, chat_id))
+            self._conn.execute(
+                "INSERT OR REPLACE INTO chats (user_id, chat_id, provider, created, message_count, modified) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (user_id, chat_id, chat_data.get("provider"), chat_data.get("created"), len(history), time.time())
+            )
+            self._insert_messages(user_id, chat_id, 0, history)
+
+    def _append_messages(self, user_id: str, chat_id: str, start: int, messages: List[dict]) -> None:
+        with self._transaction():
+            self._insert_messages(user_id, chat_id, start, messages)
+            self._conn.execute(
+                "UPDATE chats SET message_count = ?, modified = ? WHERE user_id = ? AND chat_id = ?",
+                (start + len(messages), time.time(), user_id, chat_id)
+            )
+
+    def _set_provider(self, user_id: str, chat_id: str, provider: Optional[str]) -> None:
+        with self._transaction():
+            self._conn.execute(
+                "UPDATE chats SET provider = ?, modified = ? WHERE user_id = ? AND chat_id = ?",
+                (provider, time.time(), user_id, chat_id)
+            )
+
+    def _set_active(self, user_id: str, chat_id: Optional[str]) -> None:
+        with self._transaction():
+            self._conn.execute(
+                "INSERT INTO users (user_id, active_chat) VALUES (?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET active_chat = excluded.active_chat",
+                (user_id, chat_id)
+            )
+
+    def _delete_chat(self, user_id: str, chat_id: str) -> None:
+        with self._transaction():
+            self._conn.execute("DELETE FROM messages WHERE user_id = ? AND chat_id = ?", (user_id, chat_id))
+            self._conn.execute("DELETE FROM chats WHERE user_id = ? AND chat_id = ?", (user_id, chat_id))
+
+    def load_counters(self) -> Optional[Dict[str, float]]:
+        with self._db_lock:
+            rows = self._conn.execute("SELECT name, value FROM counters").fetchall()
+        return {name: value for name, value in rows} or None
+
+    def save_counters(self, counters: Dict[str, float]) -> None:
+        with self._transaction():
+            self._conn.executemany(
+                "INSERT INTO counters (name, value) VALUES (?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET value = excluded.value",
+                list(counters.items())
+            )
+
+    def close(self) -> None:
+        with self._db_lock:
+            self._conn.close()
+
+class _SQLiteTransaction:
+    """BEGIN/COMMIT around a block, rolling back on error"""
+
+    def __init__(self, conn: sqlite3.Connection, lock: threading.RLock):
+        self.conn = conn
+        self.lock = lock
+
+    def __enter__(self):
+        self.lock.acquire()
+        self.conn.execute("BEGIN")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        finally:
+            self.lock.release()
+        return False
+
+CHAT_STORES = {
+    'journal': lambda: JournalChatStore(os.path.join(CONFIG_DIR, JOURNAL_DIR)),
+    'sqlite': lambda: SQLiteChatStore(os.path.join(CONFIG_DIR, CHAT_DB_FILE)),
+}
+
+chat_store: Optional[ChatStore] = None
+
+def get_chat_store() -> ChatStore:
+    """Get the chat store, creating it on first use"""
+    global chat_store
+    if chat_store is None:
+        backend = CHAT_STORE_BACKEND if CHAT_STORE_BACKEND in CHAT_STORES else 'journal'
+        chat_store = CHAT_STORES[backend]()
+        logger.info(f"Chat store: {backend}")
+    return chat_store
+
+# Snippet highlight markers, replaced by markup for display
+SEARCH_MARK_START = "\x02"
+SEARCH_MARK_END = "\x03"
+
+class SearchIndex:
+    """Full-text index of chat messages in SQLite (FTS5 when available).
+
+    Kept up to date from the chat snapshots the write-behind thread syncs:
+    appended messages are added, rewritten chats re-indexed and deleted
+    chats removed. catch_up() indexes whatever the store holds but the
+    index missed, e.g. chats written before the index existed.
+    System messages are not indexed.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        try:
+            self._conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS message_text USING fts5("
+                "content, user_id UNINDEXED, chat_id UNINDEXED, ordinal UNINDEXED, role UNINDEXED, "
+                "tokenize='unicode61 remove_diacritics 2')"
+            )
+            self.fts = True
+        except sqlite3.OperationalError:
+            logger.warning("SQLite has no FTS5, search falls back to substring matching")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS message_text "
+                "(content TEXT, user_id TEXT, chat_id TEXT, ordinal INTEGER, role TEXT)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_message_text_user ON message_text (user_id)")
+            self.fts = False
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS indexed_chats "
+            "(user_id TEXT, chat_id TEXT, messages INTEGER NOT NULL, PRIMARY KEY (user_id, chat_id))"
+        )
+        # (user_id, chat_id) -> messages indexed, system messages included
+        self._counts: Dict[Tuple[str, str], int] = {
+            (user_id, chat_id): count
+            for user_id, chat_id, count in self._conn.execute("SELECT user_id, chat_id, messages FROM indexed_chats")
+        }
+
+    def _add(self, user_id: str, chat_id: str, start: int, messages: List[dict]) -> None:
+        self._conn.executemany(
+            "INSERT INTO message_text (content, user_id, chat_id, ordinal, role) VALUES (?, ?, ?, ?, ?)",
+            [(str(msg.get("content", "")), user_id, chat_id, start + i, msg.get("role", ""))
+             for i, msg in enumerate(messages) if msg.get("role") != "system"]
+        )
+        count = start + len(messages)
+        self._conn.execute(
+            "INSERT INTO indexed_chats (user_id, chat_id, messages) VALUES (?, ?, ?) "
+            "ON CONFLICT(user_id, chat_id) DO UPDATE SET messages = excluded.messages",
+            (user_id, chat_id, count)
+        )
+        self._counts[(user_id, chat_id)] = count
+
+    def _remove(self, user_id: str, chat_id: str) -> None:
+        self._conn.execute("DELETE FROM message_text WHERE user_id = ? AND chat_id = ?", (user_id, chat_id))
+        self._conn.execute("DELETE FROM indexed_chats WHERE user_id = ? AND chat_id = ?", (user_id, chat_id))
+        self._counts.pop((user_id, chat_id), None)
+
+    def _update(self, user_id: str, chat_id: str, history: List[dict]) -> None:
+        indexed = self._counts.get((user_id, chat_id), 0)
+        if len(history) == indexed:
+            return
+        if len(history) < indexed:
+            # Histories only grow; a shorter one was rewritten
+            self._remove(user_id, chat_id)
+            indexed = 0
+        self._add(user_id, chat_id, indexed, history[indexed:])
+
+    def sync(self, snapshot: Dict[str, dict], keep: Set[Tuple[str, str]] = frozenset()) -> None:
+        """Index the messages added to the chats of a snapshot and drop deleted chats, except those in keep.
+        Chats whose history is not in memory are left as they are"""
+        with self._lock, _SQLiteTransaction(self._conn, self._lock):
+            for user_id, user_data in snapshot.items():
+                chats = user_data.get("chats", {})
+                for chat_id, chat_data in chats.items():
+                    if "history" in chat_data:
+                        self._update(user_id, chat_id, chat_data["history"])
+                for key in [key for key in self._counts
+                            if key[0] == user_id and key[1] not in chats and key not in keep]:
+                    self._remove(*key)
+
+    def catch_up(self, user_id: str, store: "ChatStore", keep: Set[Tuple[str, str]] = frozenset()) -> int:
+        """Index the user's chats whose stored message count differs from the index; returns how many.
+        Indexed chats missing from the store are dropped unless they are in keep"""
+        stored = store.list_chat_meta(user_id)
+        changed = 0
+        with self._lock, _SQLiteTransaction(self._conn, self._lock):
+            for chat_id, meta in stored.items():
+                if self._counts.get((user_id, chat_id)) != meta["messages"]:
+                    self._update(user_id, chat_id, store.load_history(user_id, chat_id))
+                    changed += 1
+            for key in [key for key in self._counts
+                        if key[0] == user_id and key[1] not in stored and key not in keep]:
+                self._remove(*key)
+                changed += 1
+        return changed
+
+    def search(self, user_id: str, query: str, limit: int = SEARCH_RESULTS) -> List[dict]:
+        """Best matching messages of one user: [{"chat_id", "ordinal", "role", "snippet", "score"}].
+        Every word of the query must occur; the last one may be a prefix"""
+        words = re.findall(r'\w+', query.lower())
+        if not words:
+            return []
+        with self._lock:
+            if self.fts:
+                match = " ".join(f'"{word}"' for word in words[:-1]) + f' "{words[-1]}"*'
+                rows = self._conn.execute(
+                    "SELECT chat_id, ordinal, role, "
+                    f"snippet(message_text, 0, ?, ?, '…', {SEARCH_SNIPPET_TOKENS}), bm25(message_text) "
+                    "FROM message_text WHERE message_text MATCH ? AND user_id = ? "
+                    "ORDER BY bm25(message_text), ordinal DESC LIMIT ?",
+                    (SEARCH_MARK_START, SEARCH_MARK_END, match.strip(), user_id, limit)
+                ).fetchall()
+            else:
+                conditions = " AND ".join("instr(lower(content), ?) > 0" for _ in words)
+                rows = [
+                    (chat_id, ordinal, role, self._fallback_snippet(content, words[0]), 0.0)
+                    for chat_id, ordinal, role, content in self._conn.execute(
+                        f"SELECT chat_id, ordinal, role, content FROM message_text WHERE user_id = ? AND {conditions} "
+                        "ORDER BY ordinal DESC LIMIT ?",
+                        (user_id, *words, limit)
+                    )
+                ]
+        return [
+            {"chat_id": chat_id, "ordinal": ordinal, "role": role, "snippet": snippet, "score": float(f"{-score:.4g}")}
+            for chat_id, ordinal, role, snippet, score in rows
+        ]
+
+    @staticmethod
+    def _fallback_snippet(content: str, word: str) -> str:
+        idx = content.lower().find(word)
+        start = max(0, idx - 60)
+        return (("…" if start else "") + content[start:idx] + SEARCH_MARK_START + content[idx:idx + len(word)] +
+                SEARCH_MARK_END + content[idx + len(word):idx + len(word) + 60] + "…")
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+search_index: Optional[SearchIndex] = None
+
+def get_search_index() -> SearchIndex:
+    """Get the message search index, opening it on first use"""
+    global search_index
+    with cache_lock:
+        if search_index is None:
+            search_index = SearchIndex(os.path.join(CONFIG_DIR, SEARCH_DB_FILE))
+        return search_index
+
+def close_search_index() -> None:
+    global search_index
+    with cache_lock:
+        if search_index is not None:
+            search_index.close()
+            search_index = None
+
+def search_messages(user_id: str, query: str, limit: int = SEARCH_RESULTS) -> List[dict]:
+    """Search a user's messages, first indexing anything not yet indexed"""
+    flush_writes()
+    index = get_search_index()
+    index.catch_up(str(user_id), get_chat_store(), get_chat_archive().keys())
+    return index.search(str(user_id), query, limit)
+
+class ChatArchive:
+    """Compressed storage for chats that have not been used for a while.
+
+    Each chat is one gzip-compressed JSON file, so reading a chat never
+    decompresses the others; index.json holds every archived chat's
+    metadata, so listings do not open the files at all.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self.index_path = os.path.join(root, ARCHIVE_INDEX_FILE)
+        self._lock = threading.RLock()
+        # user_id -> chat_id -> {"messages", "provider", "created", "archived", "bytes"}
+        self._index: Dict[str, Dict[str, dict]] = {}
+        try:
+            if os.path.exists(self.index_path):
+                with open(self.index_path, 'r', encoding='utf-8') as f:
+                    self._index = json.load(f)
+        except Exception as e:
+            logger.error(f"Archive index load error: {e}")
+
+    def _path(self, user_id: str, chat_id: str) -> str:
+        return os.path.join(self.root, safe_file_name(user_id), f"{safe_file_name(chat_id)}.json.gz")
+
+    def list_chat_meta(self, user_id: str) -> Dict[str, dict]:
+        with self._lock:
+            return {chat_id: dict(meta) for chat_id, meta in self._index.get(user_id, {}).items()}
+
+    def contains(self, user_id: str, chat_id: str) -> bool:
+        with self._lock:
+            return chat_id in self._index.get(user_id, {})
+
+    def keys(self) -> Set[Tuple[str, str]]:
+        with self._lock:
+            return {(user_id, chat_id) for user_id, chats in self._index.items() for chat_id in chats}
+
+    def totals(self) -> Tuple[int, int]:
+        """Archived (chats, messages)"""
+        with self._lock:
+            metas = [meta for chats in self._index.values() for meta in chats.values()]
+        return len(metas), sum(meta["messages"] for meta in metas)
+
+    def add(self, user_id: str, chat_id: str, chat_data: dict, history: List[dict], save: bool = True) -> None:
+        """Write a chat to the archive; the caller removes it from the chat store afterwards"""
+        path = self._path(user_id, chat_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        record = {
+            "chat_id": chat_id,
+            "provider": chat_data.get("provider"),
+            "created": chat_data.get("created"),
+            "history": history
+        }
+        tmp_path = f"{path}.tmp"
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+            json.dump(record, f, ensure_ascii=False)
+        with open(tmp_path, 'rb') as f:
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._index.setdefault(user_id, {})[chat_id] = {
+                "messages": len(history),
+                "provider": chat_data.get("provider"),
+                "created": chat_data.get("created"),
+                "archived": time.time(),
+                "bytes": os.path.getsize(path)
+            }
+        if save:
+            self.save()
+
+    def read(self, user_id: str, chat_id: str) -> Optional[dict]:
+        """An archived chat: {"chat_id", "provider", "created", "history"}, or None"""
+        if not self.contains(user_id, chat_id):
+            return None
+        with gzip.open(self._path(user_id, chat_id), 'rt', encoding='utf-8') as f:
+            return json.load(f)
+
+    def remove(self, user_id: str, chat_id: str, save: bool = True) -> None:
+        with self._lock:
+            self._index.get(user_id, {}).pop(chat_id, None)
+            if user_id in self._index and not self._index[user_id]:
+                del self._index[user_id]
+        try:
+            os.remove(self._path(user_id, chat_id))
+        except FileNotFoundError:
+            pass
+        if save:
+            self.save()
+
+    def drop_duplicates(self, chats: Dict[str, dict]) -> int:
+        """Remove archived chats that are also in chats, e.g. after a restore or an archive pass was cut short"""
+        duplicates = [key for key in self.keys() if key[1] in chats.get(key[0], {}).get("chats", {})]
+        for user_id, chat_id in duplicates:
+            self.remove(user_id, chat_id, save=False)
+        if duplicates:
+            logger.info(f"Dropped {len(duplicates)} archived chats that are also in the chat store")
+            self.save()
+        return len(duplicates)
+
+    def save(self) -> None:
+        with self._lock:
+            data = json.loads(json.dumps(self._index))
+        os.makedirs(self.root, exist_ok=True)
+        atomic_write_json(self.index_path, data)
+
+chat_archive: Optional[ChatArchive] = None
+
+def get_chat_archive() -> ChatArchive:
+    """Get the chat archive, loading its index on first use"""
+    global chat_archive
+    with archive_lock:
+        if chat_archive is None:
+            chat_archive = ChatArchive(os.path.join(CONFIG_DIR, ARCHIVE_DIR))
+        return chat_archive
+
+chat_activity: Optional[Dict[str, Dict[str, float]]] = None
+
+def load_chat_activity() -> Dict[str, Dict[str, float]]:
+    """When each chat was last activated or written to: {user_id: {chat_id: timestamp}}"""
+    global chat_activity
+    with archive_lock:
+        if chat_activity is None:
+            chat_activity = {}
+            activity_file = os.path.join(CONFIG_DIR, CHAT_ACTIVITY_FILE)
+            try:
+                if os.path.exists(activity_file):
+                    with open(activity_file, 'r', encoding='utf-8') as f:
+                        chat_activity = json.load(f)
+            except Exception as e:
+                logger.error(f"Chat activity load error: {e}")
+        return chat_activity
+
+def touch_chat(user_id: str, chat_id: str, forget: bool = False) -> None:
+    """Record that a chat was used now, or with forget drop its record"""
+    activity = load_chat_activity()
+    with archive_lock:
+        if forget:
+            activity.get(user_id, {}).pop(chat_id, None)
+        else:
+            activity.setdefault(user_id, {})[chat_id] = time.time()
+        data = {uid: dict(chats) for uid, chats in activity.items()}
+    activity_file = os.path.join(CONFIG_DIR, CHAT_ACTIVITY_FILE)
+    get_writer().schedule(activity_file, lambda: atomic_write_json(activity_file, data, indent=None))
+
+def chat_last_used(user_id: str, chat_id: str, chat_data: dict) -> float:
+    """Last use of a chat; chats used before activity was recorded fall back to their last write"""
+    used = load_chat_activity().get(user_id, {}).get(chat_id)
+    if used is None:
+        used = get_chat_store().last_modified(user_id, chat_id) or chat_data.get("created") or 0.0
+    return used
+
+def archive_dormant_chats(days: float = ARCHIVE_AFTER_DAYS) -> int:
+    """Move chats unused for days into the archive, except active chats and chats with a reply in flight.
+    Returns how many were moved"""
+    if days <= 0:
+        return 0
+    cutoff = time.time() - days * 86400
+    flush_writes()  # The store must hold every message before it is copied
+    store = get_chat_store()
+    archive = get_chat_archive()
+    all_chats = load_user_chats()
+    with cache_lock:
+        users = list(all_chats.items())
+    moved = 0
+    for user_id, user_data in users:
+        with user_locks(user_id):
+            candidates = [(chat_id, dict(chat_data)) for chat_id, chat_data in user_data.get("chats", {}).items()
+                          if chat_id != user_data.get("active")]
+        for chat_id, chat_data in candidates:
+            key = (user_id, chat_id)
+            if chat_last_used(user_id, chat_id, chat_data) >= cutoff or turn_locks(key).locked():
+                continue
+            history = store.load_history(user_id, chat_id)
+            try:
+                archive.add(user_id, chat_id, chat_data, history, save=False)
+            except Exception as e:
+                logger.error(f"Archive error for {chat_id}: {e}")
+                continue
+            with user_locks(user_id):
+                current = user_data["chats"].get(chat_id)
+                with chat_locks(key):
+                    unchanged = current is not None and len(current.get("history", history)) == len(history)
+                    if unchanged and user_data.get("active") != chat_id:
+                        del user_data["chats"][chat_id]
+                    else:
+                        unchanged = False
+            if not unchanged:
+                # Used while it was being archived
+                archive.remove(user_id, chat_id, save=False)
+                continue
+            chat_locks.discard(key)
+            forget_history(key)
+            moved += 1
+    if moved:
+        # The archive is complete before the chats leave the store; a chat in both is kept in the store
+        archive.save()
+        save_user_chats(all_chats)
+        logger.info(f"Archived {moved} chats unused for {days:g} days")
+    return moved
+
+def start_chat_archiver() -> Optional[threading.Thread]:
+    """Archive dormant chats now and every ARCHIVE_CHECK_INTERVAL seconds on a daemon thread"""
+    if ARCHIVE_AFTER_DAYS <= 0:
+        return None
+    def run() -> None:
+        while True:
+            try:
+                archive_dormant_chats()
+            except Exception as e:
+                logger.error(f"Archive pass error: {e}")
+            time.sleep(ARCHIVE_CHECK_INTERVAL)
+    thread = threading.Thread(target=run, name="chat-archiver", daemon=True)
+    thread.start()
+    return thread
+
+def restore_chat(user_id: str, chat_id: str) -> bool:
+    """Move an archived chat back into the chat store; False if it is not archived"""
+    archive = get_chat_archive()
+    record = archive.read(user_id, chat_id)
+    if record is None:
+        return False
+    user_chats = get_user_chats(user_id)
+    history = record["history"]
+    with user_locks(user_id):
+        if chat_id not in user_chats["chats"]:
+            user_chats["chats"][chat_id] = {
+                "history": history,
+                "provider": record.get("provider"),
+                "created": record.get("created")
+            }
+            history_lru.track((user_id, chat_id), history_size(history))
+    touch_chat(user_id, chat_id)
+    save_user_chats(load_user_chats())
+    # Drop the archived copy only once the store has the chat
+    flush_writes()
+    archive.remove(user_id, chat_id)
+    logger.info(f"Restored chat {chat_id} from the archive")
+    return True
+
+def export_chat(user_id: str, chat_id: str) -> Optional[dict]:
+    """A whole chat, hot or archived: {"id", "provider", "created", "archived", "messages"}; None if unknown"""
+    user_id = str(user_id)
+    user_chats = get_user_chats(user_id)
+    with user_locks(user_id):
+        chat_data = user_chats["chats"].get(chat_id)
+    if chat_data is not None:
+        history = get_chat_history(user_id, chat_id)
+        with chat_locks((user_id, chat_id)):
+            messages = list(history)
+        return {"id": chat_id, "provider": chat_data.get("provider"), "created": chat_data.get("created"),
+                "archived": False, "messages": messages}
+    record = get_chat_archive().read(user_id, chat_id)
+    if record is None:
+        return None
+    return {"id": chat_id, "provider": record.get("provider"), "created": record.get("created"),
+            "archived": True, "messages": record["history"]}
+
+def get_user_chats(user_id: str) -> dict:
+    """The user's entry in the chat cache, created if missing"""
+    chats = load_user_chats()
+    with cache_lock:
+        user_chats = chats.setdefault(user_id, {})
+    with user_locks(user_id):
+        user_chats.setdefault("chats", {})
+        user_chats.setdefault("active", None)
+    return user_chats
+
+def history_size(messages: List[dict]) -> int:
+    """Approximate memory used by messages"""
+    return sum(len(str(msg.get("content", ""))) + HISTORY_MESSAGE_OVERHEAD for msg in messages)
+
+class HistoryLRU:
+    """Sizes of the chat histories held in memory, least recently used first"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._sizes: "OrderedDict[Tuple[str, str], int]" = OrderedDict()
+        self._lock = Lock()
+        self.total = 0
+        self.loads = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._sizes)
+
+    def track(self, key: Tuple[str, str], size: int) -> None:
+        """Record a history that was just loaded or created"""
+        with self._lock:
+            self.total += size - self._sizes.pop(key, 0)
+            self._sizes[key] = size
+
+    def touch(self, key: Tuple[str, str], grow: int = 0) -> None:
+        """Mark a history as used, adding grow bytes to it"""
+        with self._lock:
+            if key in self._sizes:
+                self._sizes[key] += grow
+                self.total += grow
+                self._sizes.move_to_end(key)
+
+    def discard(self, key: Tuple[str, str]) -> None:
+        with self._lock:
+            self.total -= self._sizes.pop(key, 0)
+
+    def over_budget(self) -> bool:
+        with self._lock:
+            return self.total > self.max_bytes
+
+    def victims(self) -> List[Tuple[str, str]]:
+        """Oldest histories to drop to get under the budget; the newest one is always kept"""
+        with self._lock:
+            excess = self.total - self.max_bytes
+            victims = []
+            for key, size in list(self._sizes.items())[:-1]:
+                if excess <= 0:
+                    break
+                victims.append(key)
+                excess -= size
+            return victims
+
+history_lru = HistoryLRU(HISTORY_CACHE_BYTES)
+
+def forget_history(key: Tuple[str, str]) -> None:
+    """Stop tracking a history that left memory, dropping its context summary too"""
+    history_lru.discard(key)
+    context_summaries.pop(key, None)
+
+def cached_history(user_id: str, chat_id: str, chat_data: dict) -> List[dict]:
+    """The history of chat_data, loading it from the store if it is not in memory.
+    Call with the chat lock held"""
+    history = chat_data.get("history")
+    if history is None:
+        history = chat_data["history"] = get_chat_store().load_history(user_id, chat_id)
+        history_lru.track((user_id, chat_id), history_size(history))
+        history_lru.loads += 1
+    else:
+        history_lru.touch((user_id, chat_id))
+    return history
+
+def evict_histories() -> int:
+    """Drop least recently used histories from memory while over HISTORY_CACHE_BYTES.
+    Only histories the store already holds in full are dropped; returns how many were"""
+    if not history_lru.over_budget():
+        return 0
+    store = get_chat_store()
+    evicted = 0
+    for user_id, chat_id in history_lru.victims():
+        key = (user_id, chat_id)
+        if turn_locks(key).locked():
+            continue  # A reply is being generated
+        user_chats = load_user_chats().get(user_id, {})
+        with user_locks(user_id):
+            chat_data = user_chats.get("chats", {}).get(chat_id)
+        if chat_data is None:
+            forget_history(key)
+            continue
+        with chat_locks(key):
+            history = chat_data.get("history")
+            if history is not None and store.message_count(user_id, chat_id) != len(history):
+                continue  # Not written yet; it can go after the next sync
+            chat_data.pop("history", None)
+        forget_history(key)
+        evicted += 1
+    history_lru.evictions += evicted
+    return evicted
+
+def get_chat_history(user_id: str, chat_id: str) -> List[dict]:
+    """Get a chat history from the cache, loading it from the store if needed.
+    The list is shared; change it only while holding the chat lock, through append_chat_messages"""
+    user_chats = get_user_chats(user_id)
+    with user_locks(user_id):
+        chat_data = user_chats["chats"].setdefault(chat_id, {})
+    with chat_locks((user_id, chat_id)):
+        history = cached_history(user_id, chat_id, chat_data)
+    evict_histories()
+    return history
+
+def append_chat_messages(user_id: str, chat_id: str, messages: List[dict]) -> List[dict]:
+    """Append messages to a chat history; returns a copy of the whole history"""
+    user_chats = get_user_chats(user_id)
+    with user_locks(user_id):
+        chat_data = user_chats["chats"].setdefault(chat_id, {})
+    with chat_locks((user_id, chat_id)):
+        # Looked up under the lock, so an eviction cannot detach the list being extended
+        history = cached_history(user_id, chat_id, chat_data)
+        history.extend(messages)
+        history_lru.touch((user_id, chat_id), history_size(messages))
+        metrics.incr('total_messages', len(messages))
+        result = list(history)
+    evict_histories()
+    return result
 
 def load_user_chats() -> Dict[str, dict]:
     """Load user chats with caching"""
-    global user_chats_cache, stats
+    global user_chats_cache
     with cache_lock:
-        if user_chats_cache:
+        if user_chats_cache is not None:
             return user_chats_cache
         try:
-            chat_file = os.path.join(CONFIG_DIR, USER_CHATS_FILE)
-            if os.path.exists(chat_file):
-                with open(chat_file, 'r', encoding='utf-8') as f:
-                    user_chats_cache = json.load(f)
-                # Update stats
-                stats['active_chats'] = 0
-                for user_data in user_chats_cache.values():
-                    chats = user_data.get("chats", {})
-                    stats['active_chats'] += len(chats)
-                    for chat_data in chats.values():
-                        stats['total_messages'] += len(chat_data.get("history", []))
+            store = get_chat_store()
+            user_chats_cache = store.load()
+            archive = get_chat_archive()
+            archive.drop_duplicates(user_chats_cache)
+            counters = store.load_counters()
+            if counters is None:
+                # First run with this store: count once, then keep counting incrementally
+                metrics.recount(store, archive.totals())
             else:
-                user_chats_cache = {}
+                metrics.restore(counters)
         except Exception as e:
             logger.error(f"Chat load error: {e}")
             user_chats_cache = {}
         return user_chats_cache
 
+def snapshot_chats(data: Dict[str, dict]) -> Dict[str, dict]:
+    """Copy of the chat cache that later turns cannot change. Messages are shared, lists are not.
+    Each user is copied under its lock, so a user's chats are consistent with each other"""
+    snapshot = {}
+    with cache_lock:
+        users = list(data.items())
+    for user_id, user_data in users:
+        chats = {}
+        with user_locks(user_id):
+            for chat_id, chat_data in user_data.get("chats", {}).items():
+                with chat_locks((user_id, chat_id)):
+                    chat_copy = dict(chat_data)
+                    if "history" in chat_copy:
+                        chat_copy["history"] = list(chat_copy["history"])
+                chats[chat_id] = chat_copy
+            snapshot[user_id] = {"chats": chats, "active": user_data.get("active")}
+    return snapshot
+
+def sync_chats(snapshot: Dict[str, dict]) -> None:
+    """Write a chat snapshot to the store; runs on the write-behind thread"""
+    try:
+        get_chat_store().sync(snapshot)
+    except Exception as e:
+        logger.error(f"Error saving chats: {e}")
+    try:
+        get_search_index().sync(snapshot, get_chat_archive().keys())
+    except Exception as e:
+        logger.error(f"Search index error: {e}")
+    # Histories that were waiting to be written can be dropped now
+    evict_histories()
+
+def save_metrics() -> None:
+    """Save the usage counters with the chat store in the background"""
+    get_writer().schedule("metrics", lambda: get_chat_store().save_counters(metrics.snapshot()))
+
 def save_user_chats(data: Dict[str, dict]) -> None:
-    """Save user chats"""
-    global user_chats_cache, stats
+    """Save user chats in the background"""
+    global user_chats_cache
     with cache_lock:
         user_chats_cache = data
-        # Update stats
-        stats['active_chats'] = 0
-        stats['total_messages'] = 0
-        for user_data in data.values():
-            chats = user_data.get("chats", {})
-            stats['active_chats'] += len(chats)
-            for chat_data in chats.values():
-                stats['total_messages'] += len(chat_data.get("history", []))
-        stats['last_activity'] = time.time()
-        try:
-            chat_file = os.path.join(CONFIG_DIR, USER_CHATS_FILE)
-            with open(chat_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            logger.error(f"Error saving chats: {e}")
+    metrics.set('last_activity', time.time())
+    # The snapshot is taken on the write-behind thread when the write runs, so callers on
+    # the event loop never copy every user's chats, and saves in one batch share one copy
+    get_writer().schedule("chats", lambda: sync_chats(snapshot_chats(data)))
+    save_metrics()
 
 def get_supported_models():
     """Define supported models by provider. Keeping original structure, adding new models."""
@@ -535,156 +2711,1173 @@ def get_supported_models():
     }
     return full_models
 
-def save_code_blocks(response_text: str, chat_id: str, lang: str = 'en') -> str:
-    """Save code blocks from response and return cleaned text"""
-    # Corrected regex pattern using raw string concatenation
-    code_pattern = r'```(\w+)?\n([\s\S]*?)\n```'
-    matches = re.findall(code_pattern, response_text)
-    if not matches:
-        return response_text
-    saved_files = []
-    code_dir = os.path.join(CONFIG_DIR, "saved_code")
-    os.makedirs(code_dir, exist_ok=True)
-    for idx, (lang_ext, code) in enumerate(matches):
-        if not lang_ext:
-            lang_ext = 'txt'
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"code_{chat_id}_{timestamp}_{idx}.{lang_ext}"
-        filepath = os.path.join(code_dir, filename)
-        try:
-            with open(filepath, 'w', encoding='utf-8') as f:
-                f.write(code)
-            saved_files.append(filepath)
-        except Exception as e:
-            logger.error(f"Code save error: {e}")
-    if saved_files:
-        stats['saved_code_blocks'] += len(saved_files)
-        console.print(f"\n[green]💾 {tr('saved_code_location', lang)}[/]")
-        for file in saved_files:
-            console.print(f"  → [link=file://{os.path.abspath(file)}]{os.path.basename(file)}[/]")
-        console.print(f"[dim]{tr('code_saved', lang).format(len(saved_files))}[/]")
-    # Remove code blocks from response
-    return re.sub(code_pattern, '', response_text)
+# Response markup: thinking tags (opener -> closer, depth) and code fences
+THINKING_TAGS = {
+    '<thinking>': ('</thinking>', 1),
+    '[reasoning]': ('[/reasoning]', 2),
+    '<analysis>': ('</analysis>', 3)
+}
+THINKING_STYLES = {1: "dim", 2: "cyan", 3: "bright_white"}
+THINKING_PREFIXES = {1: "└─○ ", 2: "   └─▶ ", 3: "      └─★ "}
+CODE_FENCE = '```'
+RESPONSE_OPENERS = list(THINKING_TAGS) + [CODE_FENCE]
+CODE_INFO_PATTERN = re.compile(r'\w*')
+
+class Segment:
+    """Piece of a model response: "text", "thinking" (extra = depth) or "code" (extra = language)"""
+    __slots__ = ('kind', 'content', 'extra', 'done', 'opener')
+
+    def __init__(self, kind: str, extra: Any = None, opener: str = ""):
+        self.kind = kind
+        self.content = ""
+        self.extra = extra
+        self.done = False
+        self.opener = opener
+
+class ResponseTokenizer:
+    """Incremental splitter of a model response into text, thinking and fenced code segments.
+    Markers split across chunks are held back until they can be recognized."""
+
+    def __init__(self):
+        self.segments: List[Segment] = []
+        self._buffer = ""
+        self._closer: Optional[str] = None
+
+    def feed(self, chunk: str) -> None:
+        self._buffer += chunk
+        self._scan(final=False)
+
+    def close(self) -> List[Segment]:
+        """Flush buffered text. An unterminated block is turned back into plain text."""
+        self._scan(final=True)
+        if self._closer is not None and self.segments:
+            segment = self.segments[-1]
+            segment.content = segment.opener + segment.content
+            segment.kind, segment.extra = "text", None
+            self._closer = None
+        if self.segments:
+            self.segments[-1].done = True
+        return self.segments
+
+    def _emit(self, kind: str, text: str) -> None:
+        if not text:
+            return
+        if not self.segments or self.segments[-1].done or self.segments[-1].kind != kind:
+            self._open(Segment(kind))
+        self.segments[-1].content += text
+
+    def _open(self, segment: Segment) -> None:
+        if self.segments:
+            self.segments[-1].done = True
+        self.segments.append(segment)
+
+    @staticmethod
+    def _held_back(text: str, markers: List[str]) -> int:
+        """Length of the longest suffix of text that may be the start of a marker"""
+        for size in range(min(len(text), max(len(m) for m in markers) - 1), 0, -1):
+            suffix = text[-size:]
+            if any(marker.startswith(suffix) for marker in markers):
+                return size
+        return 0
+
+    def _scan(self, final: bool) -> None:
+        while self._buffer:
+            buffer = self._buffer
+            if self._closer is not None:
+                end = buffer.find(self._closer)
+                if end < 0:
+                    keep = 0 if final else self._held_back(buffer, [self._closer])
+                    self.segments[-1].content += buffer[:len(buffer) - keep]
+                    self._buffer = buffer[len(buffer) - keep:]
+                    return
+                self.segments[-1].content += buffer[:end]
+                self.segments[-1].done = True
+                self._buffer = buffer[end + len(self._closer):]
+                self._closer = None
+                continue
+            # Find the earliest block opener
+            start, opener = -1, None
+            for marker in RESPONSE_OPENERS:
+                idx = buffer.find(marker)
+                if idx >= 0 and (start < 0 or idx < start):
+                    start, opener = idx, marker
+            if opener is None:
+                keep = 0 if final else self._held_back(buffer, RESPONSE_OPENERS)
+                self._emit("text", buffer[:len(buffer) - keep])
+                self._buffer = buffer[len(buffer) - keep:]
+                return
+            self._emit("text", buffer[:start])
+            rest = buffer[start + len(opener):]
+            if opener == CODE_FENCE:
+                newline = rest.find("\n")
+                if newline < 0:
+                    if final:
+                        self._emit("text", buffer[start:])
+                        self._buffer = ""
+                    else:
+                        self._buffer = buffer[start:]
+                    return
+                info = rest[:newline]
+                if not CODE_INFO_PATTERN.fullmatch(info):
+                    self._emit("text", opener)
+                    self._buffer = rest
+                    continue
+                self._open(Segment("code", info or None, opener + rest[:newline + 1]))
+                self._closer = "\n" + CODE_FENCE
+                self._buffer = rest[newline + 1:]
+            else:
+                closer, depth = THINKING_TAGS[opener]
+                self._open(Segment("thinking", depth, opener))
+                self._closer = closer
+                self._buffer = rest
+
+def tokenize_response(text: str) -> List[Segment]:
+    """Split a complete response into segments"""
+    tokenizer = ResponseTokenizer()
+    tokenizer.feed(text)
+    return tokenizer.close()
+
+def as_segments(response: Union[str, List[Segment]]) -> List[Segment]:
+    return tokenize_response(response) if isinstance(response, str) else response
+
+lexer_cache: Dict[str, Any] = {}
+terminal_formatter = None
+
+def get_lexer(language: Optional[str]) -> Any:
+    """Pygments lexer for a code fence language, cached per language"""
+    key = (language or 'text').lower()
+    lexer = lexer_cache.get(key)
+    if lexer is None:
+        from pygments.lexers import get_lexer_by_name, TextLexer
+        try:
+            lexer = get_lexer_by_name(key, stripall=True)
+        except Exception:
+            lexer = TextLexer()
+        lexer_cache[key] = lexer
+    return lexer
+
+def get_formatter() -> Any:
+    """Shared pygments terminal formatter"""
+    global terminal_formatter
+    if terminal_formatter is None:
+        from pygments.formatters import TerminalFormatter
+        terminal_formatter = TerminalFormatter()
+    return terminal_formatter
+
+def highlight_segment(segment: Segment) -> str:
+    """Syntax-highlight a code segment for the terminal"""
+    from pygments import highlight
+    return highlight(segment.content, get_lexer(segment.extra), get_formatter())
+
+def save_code_blocks(response: Union[str, List[Segment]], chat_id: str, lang: str = 'en') -> List[Segment]:
+    """Save code blocks from response and return the remaining segments"""
+    segments = as_segments(response)
+    code_segments = [segment for segment in segments if segment.kind == "code"]
+    if not code_segments:
+        return segments
+    saved_files = []
+    code_dir = os.path.join(CONFIG_DIR, "saved_code")
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    def write_code(filepath: str, code: str) -> None:
+        try:
+            os.makedirs(code_dir, exist_ok=True)
+            atomic_write_text(filepath, code)
+        except Exception as e:
+            logger.error(f"Code save error: {e}")
+    writer = get_writer()
+    for idx, segment in enumerate(code_segments):
+        lang_ext = segment.extra or 'txt'
+        filename = f"code_{chat_id}_{timestamp}_{idx}.{lang_ext}"
+        filepath = os.path.join(code_dir, filename)
+        writer.schedule(filepath, lambda filepath=filepath, code=segment.content: write_code(filepath, code))
+        saved_files.append(filepath)
+    if saved_files:
+        metrics.incr('saved_code_blocks', len(saved_files))
+        save_metrics()
+        console.print(f"\n[green]💾 {tr('saved_code_location', lang)}[/]")
+        for file in saved_files:
+            console.print(f"  → [link=file://{os.path.abspath(file)}]{os.path.basename(file)}[/]")
+        console.print(f"[dim]{tr('code_saved', lang).format(len(saved_files))}[/]")
+    # Remove code blocks from response
+    return [segment for segment in segments if segment.kind != "code"]
+
+def highlight_code(response: Union[str, List[Segment]]) -> str:
+    """Syntax highlighting for code blocks"""
+    parts = []
+    for segment in as_segments(response):
+        if segment.kind == "code":
+            parts.append(highlight_segment(segment))
+        elif segment.kind == "thinking":
+            parts.append(segment.opener + segment.content + THINKING_TAGS[segment.opener][0])
+        else:
+            parts.append(segment.content)
+    return "".join(parts)
+
+class StreamRenderer:
+    """Rich renderable showing a streaming response as it arrives"""
+
+    def __init__(self, lang: str = 'en'):
+        self.lang = lang
+        self._lock = Lock()
+        self._tokenizer = ResponseTokenizer()
+        self._rendered: Dict[int, Any] = {}
+
+    @property
+    def has_output(self) -> bool:
+        return bool(self._tokenizer.segments)
+
+    @property
+    def segments(self) -> List[Segment]:
+        with self._lock:
+            return list(self._tokenizer.segments)
+
+    def feed(self, chunk: str) -> None:
+        with self._lock:
+            self._tokenizer.feed(chunk)
+
+    def finish(self) -> None:
+        with self._lock:
+            self._tokenizer.close()
+
+    def reset(self) -> None:
+        """Drop partial output, e.g. before retrying with another provider"""
+        with self._lock:
+            self._tokenizer = ResponseTokenizer()
+            self._rendered.clear()
+
+    @staticmethod
+    def _render(segment: Segment) -> Any:
+        if segment.kind == "thinking":
+            style = THINKING_STYLES.get(segment.extra, "dim")
+            return Text(THINKING_PREFIXES.get(segment.extra, "") + segment.content.strip(), style=style)
+        if segment.kind == "code":
+            return Text.from_ansi(highlight_segment(segment))
+        return Text(segment.content)
+
+    def __rich_console__(self, console, options):
+        with self._lock:
+            segments = list(self._tokenizer.segments)
+            if not segments:
+                yield Spinner("dots", text=Text(tr('generating', self.lang), style="bold blue"))
+                return
+            for idx, segment in enumerate(segments):
+                if idx in self._rendered:
+                    yield self._rendered[idx]
+                    continue
+                renderable = self._render(segment)
+                if segment.done:
+                    self._rendered[idx] = renderable
+                yield renderable
+
+class ClientPool:
+    """Per-provider G4F clients shared across chats and users.
+
+    Clients are kept for reuse (with whatever session state the provider
+    holds), evicted after CLIENT_POOL_IDLE seconds without use or when the
+    pool is full (least recently used first), and dropped after
+    CLIENT_POOL_MAX_ERRORS consecutive errors, or at once after an auth or
+    connection error, so the next request starts fresh.
+    """
+
+    def __init__(self, max_size: int, idle_timeout: float, max_errors: int):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.max_errors = max_errors
+        self._entries: "OrderedDict[str, dict]" = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def acquire(self, provider: g4f.Provider.BaseProvider) -> Any:
+        """Get the pooled client for a provider, creating it if needed"""
+        name = provider.__name__
+        now = time.monotonic()
+        with self._lock:
+            self._evict_idle(now)
+            entry = self._entries.get(name)
+            if entry is not None and entry["provider"] is provider:
+                self._entries.move_to_end(name)
+                self.hits += 1
+            else:
+                entry = {"client": G4FAsyncClient(provider=provider), "provider": provider, "errors": 0}
+                self._entries[name] = entry
+                self.misses += 1
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+            entry["last_used"] = now
+            return entry["client"]
+
+    def _evict_idle(self, now: float) -> None:
+        for name in [n for n, e in self._entries.items() if now - e["last_used"] > self.idle_timeout]:
+            del self._entries[name]
+
+    def report_success(self, provider_name: str) -> None:
+        with self._lock:
+            entry = self._entries.get(provider_name)
+            if entry is not None:
+                entry["errors"] = 0
+
+    def report_error(self, provider_name: str) -> None:
+        """Count an error; the client is invalidated after too many in a row"""
+        with self._lock:
+            entry = self._entries.get(provider_name)
+            if entry is None:
+                return
+            entry["errors"] += 1
+            if entry["errors"] >= self.max_errors:
+                del self._entries[provider_name]
+                logger.info(f"Dropped pooled client for {provider_name} after {entry['errors']} errors")
+
+    def invalidate(self, provider_name: str, reason: str) -> None:
+        """Drop a provider's pooled client, whose session may be broken"""
+        with self._lock:
+            if self._entries.pop(provider_name, None) is not None:
+                logger.info(f"Dropped pooled client for {provider_name} after {reason}")
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+client_pool = ClientPool(CLIENT_POOL_SIZE, CLIENT_POOL_IDLE, CLIENT_POOL_MAX_ERRORS)
+
+class ProviderThrottled(Exception):
+    """No request slot for a provider freed up within PROVIDER_QUEUE_WAIT"""
+
+class ProviderLimiter:
+    """Per-provider token bucket and adaptive (AIMD) concurrency limit.
+
+    A request needs a token and a free slot. Tokens refill at `rate` per
+    second up to `burst`. The slot limit is halved on rate limit and timeout
+    errors, down to one, and grows by 1/limit per success, up to max_limit.
+    A rate limit error also empties the bucket. Requests that find no slot
+    wait up to PROVIDER_QUEUE_WAIT seconds before the next provider is tried.
+    """
+
+    def __init__(self, rate: float, burst: int, start_limit: int, max_limit: int):
+        self.rate = rate
+        self.burst = burst
+        self.start_limit = start_limit
+        self.max_limit = max_limit
+        self._entries: Dict[str, dict] = {}
+        self._lock = Lock()
+        self.throttled = 0
+
+    def _entry(self, provider_name: str, now: float) -> dict:
+        entry = self._entries.get(provider_name)
+        if entry is None:
+            entry = {"tokens": float(self.burst), "refilled": now, "limit": float(self.start_limit), "in_flight": 0,
+                     "waiters": []}
+            self._entries[provider_name] = entry
+        elapsed = now - entry["refilled"]
+        entry["tokens"] = min(float(self.burst), entry["tokens"] + elapsed * self.rate)
+        entry["refilled"] = now
+        return entry
+
+    def try_acquire(self, provider_name: str, waiter: Optional[asyncio.Future] = None) -> float:
+        """Take a slot and a token; returns 0 on success, else the seconds worth waiting before retrying.
+        When all slots are taken, waiter is resolved as soon as one is released."""
+        with self._lock:
+            entry = self._entry(provider_name, time.monotonic())
+            if entry["in_flight"] >= int(entry["limit"]):
+                if waiter is not None:
+                    entry["waiters"].append(waiter)
+                return PROVIDER_POLL_INTERVAL * 10
+            if entry["tokens"] < 1:
+                return max(PROVIDER_POLL_INTERVAL, (1 - entry["tokens"]) / self.rate)
+            entry["tokens"] -= 1
+            entry["in_flight"] += 1
+            return 0.0
+
+    async def acquire(self, provider_name: str, timeout: float) -> None:
+        """Wait up to timeout seconds for a request slot; raises ProviderThrottled"""
+        loop = asyncio.get_running_loop()
+        deadline = time.monotonic() + timeout
+        while True:
+            waiter = loop.create_future()
+            wait = self.try_acquire(provider_name, waiter)
+            if not wait:
+                return
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                with self._lock:
+                    self.throttled += 1
+                raise ProviderThrottled(f"{provider_name} is throttled, no request slot within {timeout:g}s")
+            try:
+                await asyncio.wait_for(waiter, min(wait, remaining))
+            except (TimeoutError, asyncio.TimeoutError):
+                pass
+
+    def release(self, provider_name: str, error_kind: Optional[str] = None) -> None:
+        """Free a slot and adapt the limit to the outcome: None for success, else an error kind"""
+        with self._lock:
+            entry = self._entry(provider_name, time.monotonic())
+            entry["in_flight"] = max(0, entry["in_flight"] - 1)
+            waiters, entry["waiters"] = entry["waiters"], []
+            if error_kind is None:
+                entry["limit"] = min(float(self.max_limit), entry["limit"] + 1 / entry["limit"])
+            elif error_kind in ('rate_limit', 'timeout'):
+                previous = int(entry["limit"])
+                entry["limit"] = max(1.0, entry["limit"] * PROVIDER_BACKOFF)
+                if error_kind == 'rate_limit':
+                    entry["tokens"] = 0.0
+                if int(entry["limit"]) < previous:
+                    logger.info(f"Concurrency limit for {provider_name} lowered to {int(entry['limit'])} ({error_kind})")
+        # Queued requests compete for the freed slot
+        for waiter in waiters:
+            waiter.get_loop().call_soon_threadsafe(lambda w=waiter: w.done() or w.set_result(None))
+
+    def describe(self, provider_name: str) -> str:
+        """Short summary of a provider's limits"""
+        with self._lock:
+            entry = self._entry(provider_name, time.monotonic())
+            return f"{entry['in_flight']}/{int(entry['limit'])} in flight, {entry['tokens']:.1f} tokens"
+
+provider_limiter = ProviderLimiter(PROVIDER_RATE, PROVIDER_BURST, PROVIDER_CONCURRENCY_START, PROVIDER_CONCURRENCY_MAX)
+
+class Deadline:
+    """Time budget of one request, shared by every provider attempt made for it"""
+    __slots__ = ('seconds', 'expires')
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.expires = time.monotonic() + seconds
+
+    @classmethod
+    def for_request(cls, user_id: Optional[str], model_name: str) -> "Deadline":
+        return cls(deadline_seconds(user_id, model_name))
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return time.monotonic() >= self.expires
+
+    def budget(self, cap: float) -> float:
+        """Time for one step: the remaining budget, at most cap"""
+        return min(cap, self.remaining())
+
+class AttemptTimeout(asyncio.TimeoutError):
+    """A provider attempt ran out of time; partial holds the text streamed before that"""
 
-def highlight_code(text: str) -> str:
-    """Syntax highlighting for code blocks"""
-    # Corrected regex pattern using raw string concatenation
-    code_pattern = r'```(\w+)?\n([\s\S]*?)\n```'
-    def replacer(match):
-        lang = match.group(1) or 'text'
-        code = match.group(2)
-        try:
-            lexer = get_lexer_by_name(lang, stripall=True)
-        except:
-            lexer = TextLexer()
-        formatter = TerminalFormatter()
-        return highlight(code, lexer, formatter)
-    return re.sub(code_pattern, replacer, text)
+    def __init__(self, message: str, partial: str = ""):
+        super().__init__(message)
+        self.partial = partial
 
-def generate_response(user_id: str, chat_id: str, messages: list) -> str:
-    """Enhanced response generator with provider fallback"""
-    user_models = load_user_models()
-    model_name = user_models.get(user_id, 'gpt-4o')
-    lang = get_user_lang(user_id)
-    all_chats = load_user_chats()
-    user_chats = all_chats.get(user_id, {})
-    chat_data = user_chats.get("chats", {}).get(chat_id, {})
-    saved_provider = chat_data.get("provider")
-    providers = init_providers()
-    provider_errors = []
-    timeout_duration = 60 # seconds
+class DeadlineExceeded(AttemptTimeout):
+    """The request's deadline ran out during a provider attempt"""
+
+async def stream_provider(provider: g4f.Provider.BaseProvider, model_name: str, messages: list,
+                          timeout: float) -> AsyncIterator[str]:
+    """Request a streamed completion from one provider, yielding text chunks"""
+    if USE_CLIENT_API:
+        client = client_pool.acquire(provider)
+        response = client.chat.completions.create(
+            model=model_name,
+            messages=messages,
+            timeout=timeout,
+            stream=True
+        )
+        async for chunk in response:
+            choices = getattr(chunk, 'choices', None)
+            content = choices[0].delta.content if choices else None
+            if content:
+                yield content
+        return
+    response = g4f.ChatCompletion.create_async(
+        model=model_name,
+        messages=messages,
+        provider=provider,
+        timeout=timeout,
+        stream=True
+    )
+    async for chunk in response:
+        # The legacy generator also yields non-text events
+        if isinstance(chunk, str) and chunk:
+            yield chunk
+
+async def call_provider(provider: g4f.Provider.BaseProvider, model_name: str, messages: list, timeout: float,
+                        on_chunk: Optional[Callable[[str], None]] = None) -> str:
+    """Request a single completion from one provider, streaming it to on_chunk if given.
+    After timeout seconds the request is cancelled and abandoned without waiting for it, since some
+    providers block in threads or ignore cancellation; AttemptTimeout carries any streamed text."""
+    parts: List[str] = []
+    abandoned = []
+
+    async def request() -> str:
+        if on_chunk is not None:
+            async for content in stream_provider(provider, model_name, messages, timeout):
+                if abandoned:
+                    break
+                parts.append(content)
+                on_chunk(content)
+            return "".join(parts)
+        if USE_CLIENT_API:
+            # Use new Client API if available
+            client = client_pool.acquire(provider)
+            response = await client.chat.completions.create(
+                model=model_name,
+                messages=messages,
+                timeout=timeout
+            )
+            return response.choices[0].message.content
+        # Fallback to legacy API
+        return await g4f.ChatCompletion.create_async(
+            model=model_name,
+            messages=messages,
+            provider=provider,
+            timeout=timeout
+        )
+    task = asyncio.ensure_future(request())
+    try:
+        done, _ = await asyncio.wait({task}, timeout=timeout)
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+    if not done:
+        abandoned.append(True)
+        task.cancel()
+        # Retrieve the outcome whenever the abandoned request ends, so it is not reported as lost
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        raise AttemptTimeout(f"no answer within {timeout:.1f}s", "".join(parts))
+    return task.result()
+
+async def attempt_provider(provider: g4f.Provider.BaseProvider, model_name: str, messages: list,
+                           deadline: Deadline, on_chunk: Optional[Callable[[str], None]] = None) -> str:
+    """Call a provider once it admits the request (see ProviderLimiter), within the request's deadline
+    and at most ATTEMPT_TIMEOUT seconds, and record the outcome on the scoreboard and in the perf metrics"""
+    scoreboard = get_scoreboard()
+    try:
+        await provider_limiter.acquire(provider.__name__, deadline.budget(PROVIDER_QUEUE_WAIT))
+    except BaseException as e:
+        # Not the provider's fault; a reserved circuit probe goes to the next request
+        scoreboard.release_probe(provider.__name__, model_name)
+        if isinstance(e, ProviderThrottled):
+            perf.count('provider_errors_total', provider=provider.__name__, model=model_name, kind='throttled')
+        raise
+    started = time.monotonic()
+    # Time spent queued counts against the deadline
+    timeout = deadline.budget(ATTEMPT_TIMEOUT)
+    if on_chunk is not None:
+        forward = on_chunk
+        first_chunk = []
+
+        def on_chunk(content: str) -> None:
+            if not first_chunk:
+                first_chunk.append(True)
+                perf.observe('provider_ttfb_seconds', time.monotonic() - started,
+                             provider=provider.__name__, model=model_name)
+            forward(content)
+    try:
+        full_response = await call_provider(provider, model_name, messages, timeout, on_chunk)
+    except asyncio.CancelledError:
+        scoreboard.release_probe(provider.__name__, model_name)
+        provider_limiter.release(provider.__name__, 'cancelled')
+        raise
+    except Exception as e:
+        if isinstance(e, AttemptTimeout) and deadline.expired:
+            # Cut short by the request's deadline rather than by the provider
+            scoreboard.release_probe(provider.__name__, model_name)
+            provider_limiter.release(provider.__name__, 'cancelled')
+            perf.count('provider_errors_total', provider=provider.__name__, model=model_name, kind='deadline')
+            raise DeadlineExceeded(f"deadline of {deadline.seconds:g}s exceeded", e.partial) from e
+        error_kind = classify_error(e)
+        scoreboard.record_failure(provider.__name__, model_name, error_kind)
+        if error_kind == 'auth' or is_connection_error(e):
+            client_pool.invalidate(provider.__name__, 'an auth error' if error_kind == 'auth' else 'a connection error')
+        else:
+            client_pool.report_error(provider.__name__)
+        provider_limiter.release(provider.__name__, error_kind)
+        perf.count('provider_errors_total', provider=provider.__name__, model=model_name, kind=error_kind)
+        if error_kind == 'model_not_supported':
+            get_model_index().learn(provider.__name__, model_name, False)
+        raise
+    provider_limiter.release(provider.__name__, None if full_response and full_response.strip() else 'empty')
+    if full_response and full_response.strip():
+        latency = time.monotonic() - started
+        scoreboard.record_success(provider.__name__, model_name, latency)
+        client_pool.report_success(provider.__name__)
+        perf.observe('provider_latency_seconds', latency, provider=provider.__name__, model=model_name)
+        get_model_index().learn(provider.__name__, model_name, True)
+    else:
+        scoreboard.record_failure(provider.__name__, model_name, 'empty')
+        client_pool.report_error(provider.__name__)
+        perf.count('provider_errors_total', provider=provider.__name__, model=model_name, kind='empty')
+    return full_response
+
+async def race_providers(candidates: List[g4f.Provider.BaseProvider], model_name: str, messages: list,
+                         lang: str, provider_errors: List[str],
+                         deadline: Deadline) -> Tuple[Optional[str], Optional[str]]:
+    """Race up to RACE_TOP_K providers; returns (provider_name, response) of the first non-empty answer.
+    A new provider is started every RACE_HEDGE_DELAY seconds, or at once when one fails.
+    The race ends after RACE_DEADLINE seconds or when the request's deadline passes, whichever is first."""
+    loop = asyncio.get_running_loop()
+    scoreboard = get_scoreboard()
+    race = Deadline(min(RACE_DEADLINE, deadline.remaining()))
+    waiting = list(candidates)
+    pending: Dict[asyncio.Task, str] = {}
+    next_launch = loop.time()
+    try:
+        while (pending or waiting) and not race.expired:
+            now = loop.time()
+            can_launch = bool(waiting) and len(pending) < RACE_TOP_K
+            if can_launch and now >= next_launch:
+                provider = waiting.pop(0)
+                if not scoreboard.allow(provider.__name__, model_name):
+                    continue
+                logger.info(f"Racing provider: {provider.__name__}")
+                task = asyncio.ensure_future(attempt_provider(provider, model_name, messages, race))
+                pending[task] = provider.__name__
+                next_launch = now + RACE_HEDGE_DELAY
+                continue
+            timeout = race.remaining()
+            if can_launch:
+                timeout = min(timeout, next_launch - now)
+            if not pending:
+                await asyncio.sleep(max(0.0, timeout))
+                continue
+            done, _ = await asyncio.wait(pending, timeout=max(0.0, timeout), return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                provider_name = pending.pop(task)
+                try:
+                    full_response = task.result()
+                    if full_response and full_response.strip():
+                        logger.info(f"Race won by {provider_name}")
+                        return provider_name, full_response
+                    error_msg = f"{provider_name}: {tr('no_response_error', lang)}"
+                except (TimeoutError, asyncio.TimeoutError):
+                    error_msg = f"{provider_name}: {tr('timeout_error', lang)}"
+                except Exception as e:
+                    error_msg = f"{provider_name}: {str(e)[:100]}"
+                provider_errors.append(error_msg)
+                logger.warning(f"Racing provider error: {error_msg}")
+                next_launch = loop.time()
+        if pending or waiting:
+            provider_errors.append(f"Deadline of {race.seconds:g}s exceeded")
+        return None, None
+    finally:
+        # Cancel the losers
+        for task in pending:
+            task.cancel()
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count: ~4 ASCII characters or ~2 other characters per token"""
+    ascii_chars = len(text.encode('ascii', 'ignore'))
+    return ascii_chars // 4 + (len(text) - ascii_chars) // 2 + 1
+
+def message_tokens(message: dict) -> int:
+    return estimate_tokens(str(message.get("content", ""))) + MESSAGE_TOKEN_OVERHEAD
+
+def get_context_budget(model_name: str) -> int:
+    """Prompt token budget for a model: its context window minus room for the reply"""
+    if CONTEXT_TOKENS_OVERRIDE:
+        window = CONTEXT_TOKENS_OVERRIDE
+    else:
+        matches = [prefix for prefix in MODEL_CONTEXT_TOKENS if model_name.lower().startswith(prefix)]
+        window = MODEL_CONTEXT_TOKENS[max(matches, key=len)] if matches else DEFAULT_CONTEXT_TOKENS
+    return max(window - CONTEXT_REPLY_RESERVE, window // 2)
+
+def collapse_old_turns(head: List[dict], body: List[dict], budget: int, state: dict) -> List[dict]:
+    """Shorten long messages outside the most recent turns"""
+    cutoff = max(0, len(body) - CONTEXT_KEEP_RECENT)
+    collapsed = []
+    for idx, msg in enumerate(body):
+        content = str(msg.get("content", ""))
+        if idx < cutoff and len(content) > CONTEXT_COLLAPSE_CHARS:
+            msg = dict(msg, content=content[:CONTEXT_COLLAPSE_CHARS] + " …[truncated]")
+        collapsed.append(msg)
+    return collapsed
+
+def drop_old_turns(head: List[dict], body: List[dict], budget: int, state: dict) -> List[dict]:
+    """Keep the newest messages that fit, always including the last one"""
+    available = budget - sum(message_tokens(m) for m in head)
+    if CONTEXT_SUMMARY:
+        available -= CONTEXT_SUMMARY_TOKENS
+    kept = []
+    for msg in reversed(body):
+        cost = message_tokens(msg)
+        if kept and cost > available:
+            break
+        kept.append(msg)
+        available -= cost
+    state["dropped"] = body[:len(body) - len(kept)]
+    return list(reversed(kept))
+
+def summarize_dropped_turns(head: List[dict], body: List[dict], budget: int, state: dict) -> List[dict]:
+    """Put a short extractive summary of the dropped turns in front of the kept ones"""
+    dropped = state.get("dropped")
+    if not CONTEXT_SUMMARY or not dropped:
+        return body
+    cache_key = state.get("chat_key")
+    cached = context_summaries.get(cache_key)
+    if cached and cached[0] == len(dropped):
+        summary = cached[1]
+    else:
+        lines = []
+        remaining = CONTEXT_SUMMARY_TOKENS
+        for msg in dropped:
+            if msg.get("role") not in ("user", "assistant"):
+                continue
+            first_line = str(msg.get("content", "")).strip().split("\n", 1)[0][:200]
+            line = f"- {msg['role']}: {first_line}"
+            remaining -= estimate_tokens(line)
+            if remaining < 0:
+                break
+            lines.append(line)
+        summary = "Summary of earlier messages in this conversation:\n" + "\n".join(lines)
+        if cache_key is not None:
+            context_summaries[cache_key] = (len(dropped), summary)
+    return [{"role": "system", "content": summary}] + body
+
+# Applied in order until the conversation fits the budget
+CONTEXT_STRATEGIES = [collapse_old_turns, drop_old_turns, summarize_dropped_turns]
+
+# (user_id, chat_id) -> (dropped message count, summary text)
+context_summaries: Dict[Tuple[str, str], Tuple[int, str]] = {}
+
+def build_context(messages: List[dict], model_name: str, chat_key: Optional[Tuple[str, str]] = None) -> List[dict]:
+    """Budgeted view of a conversation to send upstream; the stored history is left untouched"""
+    budget = get_context_budget(model_name)
+    total = sum(message_tokens(m) for m in messages)
+    if total <= budget:
+        return messages
+    split = 0
+    while split < len(messages) and messages[split].get("role") == "system":
+        split += 1
+    head, body = messages[:split], messages[split:]
+    state = {"chat_key": chat_key}
+    for strategy in CONTEXT_STRATEGIES:
+        body = strategy(head, body, budget, state)
+        # Turns were dropped: let the later strategies make up for them
+        if not state.get("dropped") and sum(message_tokens(m) for m in head + body) <= budget:
+            break
+    context = head + body
+    logger.info(f"Context trimmed for {model_name}: {len(messages)} -> {len(context)} messages, "
+                f"~{total} -> ~{sum(message_tokens(m) for m in context)} tokens (budget {budget})")
+    return context
+
+class ResponseCache:
+    """Two-tier response cache keyed by model and normalized conversation.
+
+    The memory tier is an LRU of RESPONSE_CACHE_MEMORY_ITEMS entries; the disk
+    tier keeps one JSON file per entry and drops the least recently used
+    files once it grows past RESPONSE_CACHE_DISK_BYTES. Entries expire after
+    RESPONSE_CACHE_TTL seconds in both tiers.
+    """
+
+    def __init__(self, root: str, memory_items: int, disk_bytes: int, ttl: float):
+        self.root = root
+        self.memory_items = memory_items
+        self.disk_bytes = disk_bytes
+        self.ttl = ttl
+        self._memory: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._disk: "OrderedDict[str, int]" = OrderedDict()  # key -> file size, oldest access first
+        self._disk_total = 0
+        self._lock = Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        os.makedirs(root, exist_ok=True)
+        self._scan_disk()
+
+    @staticmethod
+    def make_key(model_name: str, messages: list) -> str:
+        """Hash of the model and the messages with whitespace normalized"""
+        normalized = [
+            [str(msg.get("role", "")).lower(), " ".join(str(msg.get("content", "")).split())]
+            for msg in messages
+        ]
+        payload = json.dumps([model_name, normalized], ensure_ascii=False, separators=(',', ':'))
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, f"{key}.json")
+
+    def _scan_disk(self) -> None:
+        entries = []
+        for file_name in os.listdir(self.root):
+            if file_name.endswith(".json"):
+                stat = os.stat(os.path.join(self.root, file_name))
+                entries.append((stat.st_mtime, file_name[:-len(".json")], stat.st_size))
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_total += size
+
+    def get(self, model_name: str, messages: list) -> Optional[str]:
+        key = self.make_key(model_name, messages)
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if now - entry[0] < self.ttl:
+                    self._memory.move_to_end(key)
+                    self.memory_hits += 1
+                    return entry[1]
+                del self._memory[key]
+            if key in self._disk:
+                try:
+                    with open(self._path(key), 'r', encoding='utf-8') as f:
+                        record = json.load(f)
+                    if now - record["created"] < self.ttl:
+                        os.utime(self._path(key))
+                        self._disk.move_to_end(key)
+                        self._remember(key, record["created"], record["response"])
+                        self.disk_hits += 1
+                        return record["response"]
+                except Exception as e:
+                    logger.warning(f"Response cache read error: {e}")
+                self._drop_disk(key)
+            self.misses += 1
+            return None
+
+    def put(self, model_name: str, messages: list, response: str) -> None:
+        key = self.make_key(model_name, messages)
+        created = time.time()
+        record = {"created": created, "model": model_name, "response": response}
+        with self._lock:
+            self._remember(key, created, response)
+            try:
+                atomic_write_json(self._path(key), record, indent=None)
+                size = os.path.getsize(self._path(key))
+            except Exception as e:
+                logger.error(f"Response cache write error: {e}")
+                return
+            self._disk_total += size - self._disk.pop(key, 0)
+            self._disk[key] = size
+            while self._disk_total > self.disk_bytes and len(self._disk) > 1:
+                self._drop_disk(next(iter(self._disk)))
 
-    # Try saved provider first
-    if saved_provider and saved_provider in provider_classes:
+    def _remember(self, key: str, created: float, response: str) -> None:
+        self._memory[key] = (created, response)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    def _drop_disk(self, key: str) -> None:
+        self._disk_total -= self._disk.pop(key, 0)
         try:
-            provider = provider_classes[saved_provider]
-            logger.info(f"Trying saved provider: {saved_provider}")
-            if USE_CLIENT_API:
-                # Use new Client API if available
-                client = G4FClient(provider=provider)
-                response = client.chat.completions.create(
-                    model=model_name,
-                    messages=messages,
-                    timeout=timeout_duration
-                )
-                full_response = response.choices[0].message.content
-            else:
-                # Fallback to legacy API
-                response = g4f.ChatCompletion.create(
-                    model=model_name,
-                    messages=messages,
-                    provider=provider,
-                    timeout=timeout_duration
-                )
-                full_response = "".join(response)
-
-            if full_response and full_response.strip():
-                stats['total_api_calls'] += 1
-                return full_response[:15000]  # Limit response size
-            else:
-                raise ValueError(tr('no_response_error', lang))
-        except TimeoutError:
-            error_msg = f"{saved_provider}: {tr('timeout_error', lang)}"
-            provider_errors.append(error_msg)
-            logger.warning(f"Saved provider timeout: {error_msg}")
-        except Exception as e:
-            error_msg = f"{saved_provider}: {str(e)[:100]}"
-            provider_errors.append(error_msg)
-            logger.warning(f"Saved provider error: {error_msg}")
-
-    # Try all available providers
-    for provider in providers:
-        provider_name = provider.__name__
-        if provider_name == saved_provider:
-            continue
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+response_cache: Optional[ResponseCache] = None
+
+def get_response_cache() -> Optional[ResponseCache]:
+    """Get the response cache, or None when it is disabled"""
+    global response_cache
+    if not RESPONSE_CACHE_ENABLED:
+        return None
+    with cache_lock:
+        if response_cache is None:
+            response_cache = ResponseCache(
+                os.path.join(CONFIG_DIR, RESPONSE_CACHE_DIR),
+                RESPONSE_CACHE_MEMORY_ITEMS,
+                RESPONSE_CACHE_DISK_BYTES,
+                RESPONSE_CACHE_TTL
+            )
+        return response_cache
+
+def remember_chat_provider(user_id: str, chat_id: str, provider_name: str) -> None:
+    """Save the provider that answered in a chat"""
+    user_chats = get_user_chats(user_id)
+    with user_locks(user_id):
+        chat_data = user_chats["chats"].get(chat_id)
+    if chat_data is None:
+        return  # Deleted while the reply was generated
+    with chat_locks((user_id, chat_id)):
+        chat_data["provider"] = provider_name
+    save_user_chats(load_user_chats())
+
+class Completion:
+    """Outcome of a completion: the answering provider and text, or the errors of every attempt"""
+    __slots__ = ('model', 'provider', 'text', 'errors', 'tried', 'cached', 'coalesced', 'partial')
+
+    def __init__(self, model: str):
+        self.model = model
+        self.provider: Optional[str] = None
+        self.text: Optional[str] = None
+        self.errors: List[str] = []
+        self.tried = 0
+        self.cached = False
+        self.coalesced = False  # shared with a concurrent identical request
+        self.partial = False  # cut short by the deadline
+
+class Flight:
+    """One upstream completion shared by concurrent identical requests.
+    It stands in for a StreamRenderer, passing streamed chunks to every caller and replaying
+    them to callers that join late."""
+
+    def __init__(self, streamed: bool):
+        self.streamed = streamed
+        self.task: Optional[asyncio.Task] = None
+        self.chunks: List[str] = []
+        self.listeners: List[Any] = []
+        self.broken: Dict[int, Exception] = {}
+        self.callers = 0
+
+    def join(self, renderer: Optional[Any]) -> None:
+        self.callers += 1
+        if renderer is not None:
+            for chunk in self.chunks:
+                renderer.feed(chunk)
+            self.listeners.append(renderer)
+
+    def leave(self, renderer: Optional[Any]) -> None:
+        """Detach a caller; the upstream request is cancelled when nobody waits for it"""
+        self.callers -= 1
+        if renderer in self.listeners:
+            self.listeners.remove(renderer)
+        if self.callers <= 0 and self.task is not None and not self.task.done():
+            self.task.cancel()
+
+    def feed(self, chunk: str) -> None:
+        self.chunks.append(chunk)
+        for listener in self.listeners:
+            listener.feed(chunk)
+
+    def reset(self) -> None:
+        """Drop partial output. A caller that cannot take it back is detached with its error,
+        and the request only fails once no caller is left."""
+        self.chunks.clear()
+        for listener in list(self.listeners):
+            try:
+                listener.reset()
+            except StreamInterrupted as e:
+                self.listeners.remove(listener)
+                self.broken[id(listener)] = e
+        if self.broken and self.callers <= len(self.broken):
+            raise next(iter(self.broken.values()))
+
+class SingleFlight:
+    """Runs one upstream completion per key at a time; concurrent callers with the same key wait
+    for it and share its result, or its stream when the first caller streams"""
+
+    def __init__(self):
+        self._flights: Dict[str, Flight] = {}
+        self.started = 0
+        self.coalesced = 0
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._flights)
+
+    async def run(self, key: str, renderer: Optional[Any], work: Callable[[Optional[Flight]], Awaitable[Completion]],
+                  timeout: Optional[float] = None) -> Completion:
+        """Await work(flight) for key, or join the run already in flight.
+        A caller that joins waits at most timeout seconds, then raises asyncio.TimeoutError."""
+        flight = self._flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = Flight(renderer is not None)
+            self._flights[key] = flight
+            flight.task = asyncio.ensure_future(work(flight if flight.streamed else None))
+            flight.task.add_done_callback(lambda _: self._forget(key, flight))
+            self.started += 1
+        else:
+            self.coalesced += 1
+        flight.join(renderer)
         try:
-            logger.info(f"Trying provider: {provider_name}")
-            if USE_CLIENT_API:
-                client = G4FClient(provider=provider)
-                response = client.chat.completions.create(
-                    model=model_name,
-                    messages=messages,
-                    timeout=timeout_duration
-                )
-                full_response = response.choices[0].message.content
-            else:
-                response = g4f.ChatCompletion.create(
-                    model=model_name,
-                    messages=messages,
-                    provider=provider,
-                    timeout=timeout_duration
-                )
-                full_response = "".join(response)
-
-            if full_response and full_response.strip():
-                # Save successful provider
-                chat_data["provider"] = provider_name
-                user_chats.setdefault("chats", {})[chat_id] = chat_data
-                all_chats[user_id] = user_chats
-                save_user_chats(all_chats)
-                stats['total_api_calls'] += 1
-                return full_response
-            else:
-                raise ValueError(tr('no_response_error', lang))
-        except TimeoutError:
-            error_msg = f"{provider_name}: {tr('timeout_error', lang)}"
-            provider_errors.append(error_msg)
-            logger.warning(f"Provider timeout: {error_msg}")
-        except Exception as e:
-            error_msg = f"{provider_name}: {str(e)[:100]}"
-            provider_errors.append(error_msg)
-            logger.warning(f"Provider error: {error_msg}")
-            time.sleep(0.3)  # Brief delay between attempts
+            # Shielded so that one caller giving up does not cancel the others
+            result = await asyncio.wait_for(asyncio.shield(flight.task), None if leader else timeout)
+        finally:
+            flight.leave(renderer)
+        error = flight.broken.get(id(renderer))
+        if error is not None:
+            raise error
+        if leader:
+            return result
+        shared = copy.copy(result)
+        shared.errors = list(result.errors)
+        shared.coalesced = True
+        if renderer is not None and not flight.streamed and shared.text is not None:
+            renderer.feed(shared.text)
+        perf.count('completions_total', model=shared.model, outcome='coalesced')
+        return shared
+
+    def _forget(self, key: str, flight: Flight) -> None:
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+single_flight = SingleFlight()
+
+async def complete_async(model_name: str, messages: list, lang: str = 'en', saved_provider: Optional[str] = None,
+                         renderer: Optional[StreamRenderer] = None,
+                         context_key: Optional[Tuple[str, str]] = None,
+                         deadline: Optional[Deadline] = None) -> Completion:
+    """Provider fallback for one completion, independent of any chat.
+    The saved provider is tried first; with a renderer, replies are streamed into it.
+    Concurrent requests for the same model and context share one upstream completion.
+    Everything is done within the deadline, by default the model's (see deadline_seconds)."""
+    if deadline is None:
+        deadline = Deadline.for_request(None, model_name)
+    result = Completion(model_name)
+    scoreboard = get_scoreboard()
+    index = get_model_index()
+    # Healthiest providers first, limited to those that serve the model
+    providers = index.candidates(scoreboard.order(init_providers(), model_name), model_name)
+    if not providers:
+        logger.warning(f"No provider is known to serve {model_name}, trying all")
+        providers = scoreboard.order(init_providers(), model_name)
+    if saved_provider and not index.may_serve(saved_provider, model_name):
+        saved_provider = None
+    # Send only what fits the model's context window
+    messages = build_context(messages, model_name, context_key)
+
+    # Answer repeated prompts from the cache
+    cache = get_response_cache()
+    if cache:
+        # A memory miss reads the disk tier, so keep it off the event loop like cache.put
+        cached = await asyncio.get_running_loop().run_in_executor(None, cache.get, model_name, messages)
+        if cached is not None:
+            logger.info("Response cache hit")
+            if renderer:
+                renderer.feed(cached)
+            result.text, result.cached = cached, True
+            return record_completion(result)
+
+    def work(flight_renderer: Optional[Any]) -> Awaitable[Completion]:
+        return fetch_completion(model_name, messages, lang, saved_provider, providers, deadline, flight_renderer)
+    if not COALESCE_REQUESTS:
+        return await work(renderer)
+    try:
+        # The first caller's saved provider, language and deadline are used for the shared request
+        return await single_flight.run(ResponseCache.make_key(model_name, messages), renderer, work,
+                                       deadline.remaining())
+    except (TimeoutError, asyncio.TimeoutError):
+        result.errors.append(f"Deadline of {deadline.seconds:g}s exceeded")
+        return record_completion(result)
+
+async def fetch_completion(model_name: str, messages: list, lang: str, saved_provider: Optional[str],
+                           providers: List[g4f.Provider.BaseProvider], deadline: Deadline,
+                           renderer: Optional[StreamRenderer] = None) -> Completion:
+    """Ask the providers in turn, or race them, until one answers or the deadline passes;
+    stores the answer in the cache"""
+    loop = asyncio.get_running_loop()
+    result = Completion(model_name)
+    scoreboard = get_scoreboard()
+    cache = get_response_cache()
+    provider_errors = result.errors
+    partial = ""  # streamed text of an attempt cut short by the deadline
+
+    # Race the top providers concurrently
+    if RACE_TOP_K > 1:
+        candidates = [provider_classes[saved_provider]] if saved_provider in provider_classes else []
+        candidates += [provider for provider in providers if provider.__name__ != saved_provider]
+        winner, full_response = await race_providers(candidates, model_name, messages, lang, provider_errors,
+                                                     deadline)
+        if winner:
+            metrics.incr('total_api_calls')
+            if renderer:
+                # Racing waits for whole answers, so the winner is shown at once
+                renderer.feed(full_response[:15000])
+            if cache:
+                await loop.run_in_executor(None, cache.put, model_name, messages, full_response[:15000])
+            result.provider, result.text = winner, full_response[:15000]  # Limit response size
+            return record_completion(result)
+        providers = candidates
+    else:
+        # Try saved provider first
+        if (saved_provider and saved_provider in provider_classes and
+                scoreboard.allow(saved_provider, model_name)):
+            try:
+                provider = provider_classes[saved_provider]
+                logger.info(f"Trying saved provider: {saved_provider}")
+                full_response = await attempt_provider(provider, model_name, messages, deadline,
+                                                       renderer.feed if renderer else None)
+                if full_response and full_response.strip():
+                    metrics.incr('total_api_calls')
+                    if cache:
+                        await loop.run_in_executor(None, cache.put, model_name, messages, full_response[:15000])
+                    result.provider, result.text = saved_provider, full_response[:15000]  # Limit response size
+                    return record_completion(result)
+                else:
+                    raise ValueError(tr('no_response_error', lang))
+            except DeadlineExceeded as e:
+                partial = e.partial
+                logger.warning(f"Deadline exceeded while waiting for {saved_provider}")
+            except (TimeoutError, asyncio.TimeoutError):
+                error_msg = f"{saved_provider}: {tr('timeout_error', lang)}"
+                provider_errors.append(error_msg)
+                logger.warning(f"Saved provider timeout: {error_msg}")
+            except Exception as e:
+                error_msg = f"{saved_provider}: {str(e)[:100]}"
+                provider_errors.append(error_msg)
+                logger.warning(f"Saved provider error: {error_msg}")
+
+        # Try all available providers
+        for provider in providers:
+            provider_name = provider.__name__
+            if deadline.expired:
+                break
+            if provider_name == saved_provider:
+                continue
+            if not scoreboard.allow(provider_name, model_name):
+                logger.info(f"Skipping provider with open circuit: {provider_name}")
+                continue
+            if renderer:
+                renderer.reset()
+            try:
+                logger.info(f"Trying provider: {provider_name}")
+                full_response = await attempt_provider(provider, model_name, messages, deadline,
+                                                       renderer.feed if renderer else None)
+                if full_response and full_response.strip():
+                    metrics.incr('total_api_calls')
+                    if cache:
+                        await loop.run_in_executor(None, cache.put, model_name, messages, full_response)
+                    result.provider, result.text = provider_name, full_response
+                    return record_completion(result)
+                else:
+                    raise ValueError(tr('no_response_error', lang))
+            except DeadlineExceeded as e:
+                partial = e.partial
+                logger.warning(f"Deadline exceeded while waiting for {provider_name}")
+                break
+            except (TimeoutError, asyncio.TimeoutError):
+                error_msg = f"{provider_name}: {tr('timeout_error', lang)}"
+                provider_errors.append(error_msg)
+                logger.warning(f"Provider timeout: {error_msg}")
+            except Exception as e:
+                error_msg = f"{provider_name}: {str(e)[:100]}"
+                provider_errors.append(error_msg)
+                logger.warning(f"Provider error: {error_msg}")
+
+        if deadline.expired:
+            provider_errors.append(f"Deadline of {deadline.seconds:g}s exceeded")
+            if partial.strip():
+                # The reply streamed so far is better than none; the caller has already shown it
+                logger.warning(f"Returning a partial reply of {len(partial)} characters")
+                result.text, result.partial = partial, True
+                return record_completion(result)
+
+    if renderer:
+        renderer.reset()
+    result.tried = len(providers)
+    return record_completion(result)
 
-    # Error handling
+def record_completion(result: Completion) -> Completion:
+    """Count a finished completion and, when answered, the attempts it took"""
+    if result.cached:
+        perf.count('completions_total', model=result.model, outcome='cached')
+    elif result.partial:
+        perf.count('completions_total', model=result.model, outcome='partial')
+    elif result.text is not None:
+        perf.count('completions_total', model=result.model, outcome='ok')
+        # Every failed attempt left an error
+        perf.observe('reply_attempts', len(result.errors) + 1, model=result.model)
+    else:
+        perf.count('completions_total', model=result.model, outcome='failed')
+    return result
+
+def format_generation_error(result: Completion, lang: str = 'en') -> str:
+    """Error report shown when no provider answered"""
     error_details = [
         f"[red]❌ {tr('gen_error', lang)}[/]",
-        f"[yellow]Tried {len(providers)} providers[/]",
-        f"[dim]Model: {model_name}[/]"
+        f"[yellow]Tried {result.tried} providers[/]",
+        f"[dim]Model: {result.model}[/]"
     ]
-    if provider_errors:
+    if result.errors:
         error_details.append("\n[bold]Recent errors:[/]")
-        for error in provider_errors[-3:]:
+        for error in result.errors[-3:]:
             error_details.append(f"  - {error}")
     error_details.append("\n[blue]Suggestions:")
     error_details.append("  1. Try again later")
@@ -692,28 +3885,515 @@ def generate_response(user_id: str, chat_id: str, messages: list) -> str:
     error_details.append("  3. Check /status for system info[/]")
     return "\n".join(error_details)
 
-def process_model_thinking(response_text: str, lang: str = 'en') -> str:
-    """Process and visualize model thinking patterns"""
-    thinking_patterns = [
-        (r'<thinking>(.*?)</thinking>', 1, "dim"),
-        (r'\[reasoning\](.*?)\[/reasoning\]', 2, "cyan"),
-        (r'<analysis>(.*?)</analysis>', 3, "bright_white")
-    ]
-    console.print(f"\n[bold yellow]🧠 {tr('thinking', lang)}[/]")
-    for pattern, depth, style in thinking_patterns:
-        matches = re.findall(pattern, response_text, re.DOTALL)
-        for thought in matches:
-            if isinstance(thought, tuple):
-                thought = thought[0]
-            thought = thought.strip()
-            if depth == 1:
-                console.print(f"[{style}]└─○ {thought}[/]")
-            elif depth == 2:
-                console.print(f"[{style}]   └─▶ {thought}[/]")
-            elif depth == 3:
-                console.print(f"[{style}]      └─★ {thought}[/]")
-            response_text = re.sub(pattern, '', response_text, flags=re.DOTALL)
-    return response_text.strip()
+async def generate_response_async(user_id: str, chat_id: str, messages: list,
+                                  renderer: Optional[StreamRenderer] = None) -> str:
+    """Enhanced response generator with provider fallback, bounded by the user's deadline.
+    With a renderer, replies are streamed into it as they arrive."""
+    loop = asyncio.get_running_loop()
+    user_models = load_user_models()
+    model_name = user_models.get(user_id, 'gpt-4o')
+    deadline = Deadline.for_request(user_id, model_name)
+    lang = get_user_lang(user_id)
+    user_chats = get_user_chats(user_id)
+    with user_locks(user_id):
+        chat_data = user_chats["chats"].get(chat_id, {})
+    saved_provider = chat_data.get("provider")
+    result = await complete_async(model_name, messages, lang, saved_provider, renderer, (user_id, chat_id), deadline)
+    if result.provider and result.provider != saved_provider:
+        # Save successful provider
+        await loop.run_in_executor(None, remember_chat_provider, user_id, chat_id, result.provider)
+    if result.text is not None:
+        return result.text
+    return format_generation_error(result, lang)
+
+def is_error_response(text: str) -> bool:
+    """Whether text is the error report of generate_response"""
+    return text.startswith("[red]❌")
+
+async def send_message_async(user_id: str, chat_id: str, content: str,
+                             renderer: Optional[StreamRenderer] = None) -> str:
+    """Add a user message to a chat, generate the reply and save both.
+    Turns in one chat run one at a time; different chats run concurrently."""
+    loop = asyncio.get_running_loop()
+    user_id = str(user_id)
+    async with turn_locks((user_id, chat_id)):
+        started = time.perf_counter()
+        touch_chat(user_id, chat_id)
+        history = await loop.run_in_executor(
+            None, append_chat_messages, user_id, chat_id, [{"role": "user", "content": content}]
+        )
+        try:
+            response_text = await generate_response_async(user_id, chat_id, history, renderer)
+            if response_text and not is_error_response(response_text):
+                append_chat_messages(user_id, chat_id, [{"role": "assistant", "content": response_text}])
+        finally:
+            save_user_chats(load_user_chats())
+            perf.observe('turn_seconds', time.perf_counter() - started)
+    return response_text
+
+class AsyncRunner:
+    """Event loop on a background thread, running the async core for synchronous callers"""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name="async-core", daemon=True)
+        self._thread.start()
+
+    def submit(self, coro) -> Future:
+        """Schedule a coroutine; returns a concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro, cancel_timeout: Optional[float] = None) -> Any:
+        """Run a coroutine to completion, cancelling it if the caller is interrupted.
+        With cancel_timeout, an interrupted caller waits up to that long for the cancelled
+        coroutine to finish its cleanup."""
+        finished = threading.Event()
+        if cancel_timeout is not None:
+            async def tracked() -> Any:
+                try:
+                    return await coro
+                finally:
+                    finished.set()
+            future = self.submit(tracked())
+        else:
+            future = self.submit(coro)
+        try:
+            return future.result()
+        except KeyboardInterrupt:
+            future.cancel()
+            if cancel_timeout is not None and not finished.wait(cancel_timeout):
+                logger.warning(f"Cancelled task still running after {cancel_timeout:g}s")
+            raise
+
+async_runner: Optional[AsyncRunner] = None
+
+def get_async_runner() -> AsyncRunner:
+    """Get the background event loop, starting it on first use"""
+    global async_runner
+    with cache_lock:
+        if async_runner is None:
+            async_runner = AsyncRunner()
+        return async_runner
+
+def generate_response(user_id: str, chat_id: str, messages: list,
+                      renderer: Optional[StreamRenderer] = None) -> str:
+    """Synchronous facade over generate_response_async"""
+    return get_async_runner().run(generate_response_async(user_id, chat_id, messages, renderer))
+
+def send_message(user_id: str, chat_id: str, content: str, renderer: Optional[StreamRenderer] = None) -> str:
+    """Synchronous facade over send_message_async"""
+    return get_async_runner().run(send_message_async(user_id, chat_id, content, renderer))
+
+def load_completed_ids(output_path: str) -> Set[str]:
+    """Ids that already have a successful result in a batch output file"""
+    completed = set()
+    if not os.path.exists(output_path):
+        return completed
+    with open(output_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # Torn last line of an interrupted run
+            if record.get("error") is None and "id" in record:
+                completed.add(str(record["id"]))
+    return completed
+
+async def run_batch_async(input_path: str, output_path: str, concurrency: int = BATCH_CONCURRENCY,
+                          default_model: str = 'gpt-4o') -> Dict[str, int]:
+    """Run a JSONL file of {id, model, messages} records through provider fallback.
+
+    Results are appended to output_path as JSONL as they finish, in completion
+    order. Ids with a successful result there are skipped, so an interrupted
+    run can be resumed; failed ids are retried and their new result appended.
+    """
+    completed = load_completed_ids(output_path)
+    counts = {"done": 0, "failed": 0, "skipped": 0}
+    records: "asyncio.Queue[Optional[Tuple[Any, dict]]]" = asyncio.Queue(maxsize=concurrency * 2)
+
+    def write_result(result: dict) -> None:
+        out.write(json.dumps(result, ensure_ascii=False) + "\n")
+        out.flush()
+
+    async def worker() -> None:
+        while True:
+            item = await records.get()
+            if item is None:
+                return
+            record_id, record = item
+            model_name = record.get("model") or default_model
+            result = {"id": record_id, "model": model_name, "provider": None,
+                      "latency": None, "response": None, "error": None}
+            started = time.monotonic()
+            try:
+                messages = record.get("messages")
+                if not isinstance(messages, list) or not messages:
+                    raise ValueError("record has no messages")
+                completion = await complete_async(model_name, messages)
+                result["provider"] = completion.provider
+                result["response"] = completion.text
+                if completion.text is None:
+                    result["error"] = "; ".join(completion.errors[-3:]) or "no provider answered"
+            except Exception as e:
+                result["error"] = str(e)[:200]
+            result["latency"] = round(time.monotonic() - started, 3)
+            counts["failed" if result["error"] else "done"] += 1
+            write_result(result)
+
+    with open(output_path, 'a', encoding='utf-8') as out:
+        workers = [asyncio.ensure_future(worker()) for _ in range(max(1, concurrency))]
+        try:
+            with open(input_path, 'r', encoding='utf-8') as f:
+                for line_no, line in enumerate(f, 1):
+                    if not line.strip():
+                        continue
+                    try:
+                        record = json.loads(line)
+                        if not isinstance(record, dict):
+                            raise ValueError("record is not an object")
+                    except ValueError as e:
+                        counts["failed"] += 1
+                        write_result({"id": f"line-{line_no}", "model": None, "provider": None,
+                                      "latency": None, "response": None, "error": f"invalid record: {e}"})
+                        continue
+                    record_id = record.get("id", f"line-{line_no}")
+                    if str(record_id) in completed:
+                        counts["skipped"] += 1
+                        continue
+                    await records.put((record_id, record))
+            for _ in workers:
+                await records.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+    return counts
+
+def run_batch(input_path: str, output_path: str, concurrency: int = BATCH_CONCURRENCY,
+              default_model: str = 'gpt-4o') -> None:
+    """Batch mode entry point"""
+    started = time.monotonic()
+    counts = get_async_runner().run(run_batch_async(input_path, output_path, concurrency, default_model))
+    get_scoreboard().save(force=True)
+    save_metrics()
+    get_writer().close()
+    console.print(Panel(
+        f"[green]Done:[/] {counts['done']}\n"
+        f"[red]Failed:[/] {counts['failed']}\n"
+        f"[dim]Skipped (already done):[/] {counts['skipped']}\n"
+        f"[bold]Time:[/] {time.monotonic() - started:.1f}s\n"
+        f"[bold]Output:[/] {output_path}",
+        title="[cyan]Batch[/]",
+        border_style="cyan",
+        padding=(0, 2),
+        width=60
+    ))
+
+class StreamInterrupted(Exception):
+    """A provider failed after part of its reply was already sent"""
+
+class ChunkSink:
+    """Stand-in for StreamRenderer that queues streamed chunks for an HTTP response.
+    Sent text cannot be taken back, so fallback to another provider after it is an error."""
+
+    def __init__(self):
+        self.queue: "asyncio.Queue[Optional[str]]" = asyncio.Queue()
+        self.started = False
+
+    def feed(self, chunk: str) -> None:
+        if chunk:
+            self.started = True
+            self.queue.put_nowait(chunk)
+
+    def reset(self) -> None:
+        if self.started:
+            raise StreamInterrupted("provider failed mid-stream")
+
+def load_api_keys() -> Dict[str, str]:
+    """API key to user id map for server mode"""
+    keys_file = os.path.join(CONFIG_DIR, API_KEYS_FILE)
+    try:
+        if os.path.exists(keys_file):
+            with open(keys_file, 'r', encoding='utf-8') as f:
+                return {str(key): str(user_id) for key, user_id in json.load(f).items()}
+    except Exception as e:
+        logger.error(f"API keys load error: {e}")
+    return {}
+
+def completion_chunk(completion_id: str, model_name: str, delta: dict,
+                     finish_reason: Optional[str] = None) -> dict:
+    return {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model_name,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+    }
+
+def completion_body(completion_id: str, model_name: str, messages: List[dict], text: str,
+                    provider_name: Optional[str], finish_reason: str = "stop") -> dict:
+    prompt_tokens = sum(message_tokens(m) for m in messages)
+    completion_tokens = estimate_tokens(text)
+    return {
+        "id": completion_id,
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model_name,
+        "provider": provider_name,
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": finish_reason}],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens
+        }
+    }
+
+def create_server_app(api_keys: Dict[str, str]) -> Any:
+    """aiohttp application with the OpenAI-compatible and chat management endpoints"""
+    from aiohttp import web
+
+    def error_response(status: int, message: str, error_type: str = "invalid_request_error") -> Any:
+        return web.json_response({"error": {"message": message, "type": error_type, "code": status}}, status=status)
+
+    @web.middleware
+    async def authenticate(request, handler):
+        if api_keys:
+            key = request.headers.get("Authorization", "").removeprefix("Bearer ").strip()
+            if key not in api_keys:
+                return error_response(401, "Invalid API key", "authentication_error")
+            request["user_id"] = api_keys[key]
+        else:
+            request["user_id"] = "api"
+        return await handler(request)
+
+    async def read_json(request) -> dict:
+        try:
+            body = await request.json()
+        except Exception:
+            raise web.HTTPBadRequest(text=json.dumps({"error": {"message": "Body must be JSON"}}),
+                                     content_type="application/json")
+        if not isinstance(body, dict):
+            raise web.HTTPBadRequest(text=json.dumps({"error": {"message": "Body must be a JSON object"}}),
+                                     content_type="application/json")
+        return body
+
+    def message_error(messages: Any) -> Optional[str]:
+        """Why messages is not a usable conversation, or None if it is"""
+        if not isinstance(messages, list) or not messages:
+            return "messages must be a non-empty list"
+        for idx, msg in enumerate(messages):
+            if not isinstance(msg, dict):
+                return f"messages[{idx}] must be an object"
+            if not isinstance(msg.get("role"), str) or not msg["role"]:
+                return f"messages[{idx}].role must be a non-empty string"
+            if not isinstance(msg.get("content"), str):
+                return f"messages[{idx}].content must be a string"
+        return None
+
+    async def stream_reply(request, model_name: str, produce: Callable[[ChunkSink], Any]) -> Any:
+        """Send the reply of produce(sink) as server-sent events"""
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await response.prepare(request)
+
+        async def send(payload: Any) -> None:
+            data = payload if isinstance(payload, str) else json.dumps(payload, ensure_ascii=False)
+            await response.write(f"data: {data}\n\n".encode('utf-8'))
+
+        sink = ChunkSink()
+        task = asyncio.ensure_future(produce(sink))
+        task.add_done_callback(lambda _: sink.queue.put_nowait(None))
+        try:
+            await send(completion_chunk(completion_id, model_name, {"role": "assistant"}))
+            while True:
+                chunk = await sink.queue.get()
+                if chunk is None:
+                    break
+                await send(completion_chunk(completion_id, model_name, {"content": chunk}))
+            error = None
+            try:
+                text = task.result()
+                if text is None:
+                    error = "No provider answered"
+            except Exception as e:
+                error = str(e)[:200]
+            if error:
+                await send({"error": {"message": error, "type": "provider_error", "code": 502}})
+            else:
+                await send(completion_chunk(completion_id, model_name, {}, "stop"))
+            await send("[DONE]")
+        finally:
+            task.cancel()
+        return response
+
+    async def chat_completions(request):
+        body = await read_json(request)
+        messages = body.get("messages")
+        error = message_error(messages)
+        if error:
+            return error_response(400, error)
+        if body.get("model") is not None and (not isinstance(body["model"], str) or not body["model"].strip()):
+            return error_response(400, "model must be a non-empty string")
+        user_id = request["user_id"]
+        model_name = body.get("model") or load_user_models().get(user_id, 'gpt-4o')
+        lang = get_user_lang(user_id)
+        if body.get("stream"):
+            async def produce(sink: ChunkSink) -> Optional[str]:
+                return (await complete_async(model_name, messages, lang, renderer=sink,
+                                             deadline=Deadline.for_request(user_id, model_name))).text
+            return await stream_reply(request, model_name, produce)
+        result = await complete_async(model_name, messages, lang, deadline=Deadline.for_request(user_id, model_name))
+        if result.text is None:
+            return error_response(502, "; ".join(result.errors[-3:]) or "No provider answered", "provider_error")
+        return web.json_response(completion_body(f"chatcmpl-{uuid.uuid4().hex}", model_name, messages,
+                                                 result.text, result.provider,
+                                                 "length" if result.partial else "stop"))
+
+    async def list_models_endpoint(request):
+        models = sorted({model for group in get_supported_models().values() for model in group})
+        return web.json_response({
+            "object": "list",
+            "data": [{"id": model, "object": "model", "owned_by": "g4f"} for model in models]
+        })
+
+    async def list_chats_endpoint(request):
+        chat_list, active_id = chat_overview(request["user_id"])
+        return web.json_response({
+            "active": active_id,
+            "data": [dict(meta, id=chat_id) for chat_id, meta in chat_list.items()]
+        })
+
+    async def create_chat_endpoint(request):
+        chat_id = create_chat(request["user_id"])
+        return web.json_response({"id": chat_id}, status=201)
+
+    def find_chat(request) -> Tuple[str, str]:
+        user_id, chat_id = request["user_id"], request.match_info["chat_id"]
+        if (chat_id not in load_user_chats().get(user_id, {}).get("chats", {}) and
+                not get_chat_archive().contains(user_id, chat_id)):
+            raise web.HTTPNotFound(text=json.dumps({"error": {"message": "Chat not found"}}),
+                                   content_type="application/json")
+        return user_id, chat_id
+
+    async def get_chat_endpoint(request):
+        user_id, chat_id = find_chat(request)
+        loop = asyncio.get_running_loop()
+        # Archived chats are read from the archive without restoring them
+        chat = await loop.run_in_executor(None, export_chat, user_id, chat_id)
+        if chat is None:
+            return error_response(404, "Chat not found")
+        return web.json_response(chat)
+
+    async def delete_chat_endpoint(request):
+        user_id, chat_id = find_chat(request)
+        await asyncio.get_running_loop().run_in_executor(None, remove_chat, user_id, chat_id)
+        return web.json_response({"id": chat_id, "deleted": True})
+
+    async def chat_message_endpoint(request):
+        user_id, chat_id = find_chat(request)
+        body = await read_json(request)
+        content = body.get("content")
+        if not isinstance(content, str) or not content.strip():
+            return error_response(400, "content must be a non-empty string")
+        if get_chat_archive().contains(user_id, chat_id):
+            await asyncio.get_running_loop().run_in_executor(None, restore_chat, user_id, chat_id)
+        model_name = load_user_models().get(user_id, 'gpt-4o')
+        if body.get("stream"):
+            async def produce(sink: ChunkSink) -> Optional[str]:
+                text = await send_message_async(user_id, chat_id, content, sink)
+                return None if is_error_response(text) else text
+            return await stream_reply(request, model_name, produce)
+        text = await send_message_async(user_id, chat_id, content)
+        if is_error_response(text):
+            return error_response(502, "No provider answered", "provider_error")
+        return web.json_response({"id": chat_id, "role": "assistant", "content": text})
+
+    async def search_endpoint(request):
+        query = request.query.get("q", "")
+        if not query.strip():
+            return error_response(400, "q must be a non-empty query")
+        try:
+            limit = min(100, max(1, int(request.query.get("limit", SEARCH_RESULTS))))
+        except ValueError:
+            return error_response(400, "limit must be a number")
+        loop = asyncio.get_running_loop()
+        results = await loop.run_in_executor(None, search_messages, request["user_id"], query, limit)
+        for result in results:
+            result["snippet"] = result["snippet"].replace(SEARCH_MARK_START, "**").replace(SEARCH_MARK_END, "**")
+        return web.json_response({"object": "list", "data": results})
+
+    async def metrics_endpoint(request):
+        gauges = {name: value for name, value in metrics.snapshot().items() if name != 'last_activity'}
+        gauges['pending_writes'] = get_writer().pending
+        return web.Response(text=perf.render_prometheus(gauges),
+                            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    app = web.Application(middlewares=[authenticate])
+    app.router.add_post("/v1/chat/completions", chat_completions)
+    app.router.add_get("/v1/models", list_models_endpoint)
+    app.router.add_get("/v1/chats", list_chats_endpoint)
+    app.router.add_post("/v1/chats", create_chat_endpoint)
+    app.router.add_get("/v1/chats/{chat_id}", get_chat_endpoint)
+    app.router.add_delete("/v1/chats/{chat_id}", delete_chat_endpoint)
+    app.router.add_post("/v1/chats/{chat_id}/messages", chat_message_endpoint)
+    app.router.add_get("/v1/search", search_endpoint)
+    app.router.add_get("/metrics", metrics_endpoint)
+    return app
+
+async def serve_async(host: str, port: int) -> None:
+    """Run the HTTP server on the async core until cancelled"""
+    from aiohttp import web
+    api_keys = load_api_keys()
+    if not api_keys:
+        logger.warning(f"No {API_KEYS_FILE}; every request is served as user 'api' without authentication")
+    load_user_chats()
+    init_providers()
+    runner = web.AppRunner(create_server_app(api_keys))
+    await runner.setup()
+    site = web.TCPSite(runner, host, port, shutdown_timeout=SERVER_SHUTDOWN_TIMEOUT)
+    await site.start()
+    logger.info(f"Serving on http://{host}:{port} for {len(set(api_keys.values()))} users")
+    start_chat_archiver()
+    console.print(f"[green]Serving on http://{host}:{port}[/] [dim](Ctrl+C to stop)[/]")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+def serve(host: str = SERVER_HOST, port: int = SERVER_PORT) -> None:
+    """Server mode entry point"""
+    try:
+        import aiohttp  # noqa: F401 - installed with g4f
+    except ImportError:
+        console.print("[red]❌ Server mode needs aiohttp: pip install aiohttp[/]")
+        return
+    import signal
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+    # Shut down cleanly, flushing pending writes, when a service manager stops us
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        # In-flight requests finish before persistence is closed below
+        get_async_runner().run(serve_async(host, port), cancel_timeout=SERVER_SHUTDOWN_TIMEOUT + 5)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        get_scoreboard().save(force=True)
+        save_metrics()
+        get_writer().close()
+        close_search_index()
+        get_chat_store().close()
+
+def process_model_thinking(response: Union[str, List[Segment]], lang: str = 'en') -> List[Segment]:
+    """Process and visualize model thinking patterns; returns the other segments"""
+    segments = as_segments(response)
+    thoughts = [segment for segment in segments if segment.kind == "thinking"]
+    if thoughts:
+        console.print(f"\n[bold yellow]🧠 {tr('thinking', lang)}[/]")
+    for segment in thoughts:
+        style = THINKING_STYLES.get(segment.extra, "dim")
+        console.print(Text(THINKING_PREFIXES.get(segment.extra, "") + segment.content.strip(), style=style))
+    return [segment for segment in segments if segment.kind != "thinking"]
 
 def show_help(user_id: str) -> None:
     """Show help menu"""
@@ -730,13 +4410,17 @@ def show_help(user_id: str) -> None:
         f"  [bold]/usechat[/]  - {tr('switch_chat', lang)}\n"
         f"  [bold]/delchat[/]  - {tr('delete_chat', lang)}\n"
         f"  [bold]/chats[/]    - {tr('list_chats', lang)}\n"
+        f"  [bold]/search[/]   - {tr('search', lang)}\n"
+        f"  [bold]/export[/]   - {tr('export', lang)}\n"
         f"  [bold]/setmodel[/] - {tr('set_model', lang)}\n"
         f"  [bold]/mymodel[/]  - {tr('current_model', lang)}\n"
+        f"  [bold]/deadline[/] - {tr('deadline', lang)}\n"
         f"  [bold]/models[/]   - {tr('list_models', lang)}\n"
         f"  [bold]/providers[/]- {tr('list_providers', lang)}\n"
         f"  [bold]/status[/]   - {tr('system_status', lang)}\n"
         f"  [bold]/lang[/]     - {tr('lang', lang)} (en/ru)\n"
         f"  [bold]/stats[/]    - {tr('stats', lang)}\n"
+        f"  [bold]/perf[/]     - {tr('perf', lang)}\n"
         f"  [bold]/exit[/]     - {tr('exit', lang)}\n"
         f"  [bold]/help[/]     - {tr('help', lang)}\n"
         f"[bold cyan]{tr('start_chat', lang)}[/]"
@@ -773,13 +4457,11 @@ def set_model(user_id: str, model_name: str) -> bool:
         console.print(f"[red]❌ {tr('model_error', lang)}[/]")
         return False
 
-def new_chat(user_id: str) -> str:
-    """Create new chat"""
-    lang = get_user_lang(user_id)
+def create_chat(user_id: str) -> str:
+    """Create a chat with the system message for the user's model and make it active"""
     user_id = str(user_id)
     chats = load_user_chats()
-    user_chats = chats.get(user_id, {})
-    chat_list = user_chats.get("chats", {})
+    user_chats = get_user_chats(user_id)
     chat_id = str(uuid.uuid4())[:8]
     # Get current model
     user_models = load_user_models()
@@ -796,30 +4478,47 @@ def new_chat(user_id: str) -> str:
         )
     else:
         system_msg = "You are a helpful AI assistant. Provide clear, concise responses."
-    chat_list[chat_id] = {
-        "history": [{"role": "system", "content": system_msg}],
-        "provider": None,
-        "created": time.time()
-    }
-    user_chats["chats"] = chat_list
-    user_chats["active"] = chat_id
-    chats[user_id] = user_chats
+    history = [{"role": "system", "content": system_msg}]
+    with user_locks(user_id):
+        user_chats["chats"][chat_id] = {
+            "history": history,
+            "provider": None,
+            "created": time.time()
+        }
+        user_chats["active"] = chat_id
+    history_lru.track((user_id, chat_id), history_size(history))
+    touch_chat(user_id, chat_id)
+    metrics.incr('active_chats')
+    metrics.incr('total_messages')
     save_user_chats(chats)
-    stats['active_chats'] += 1
+    return chat_id
+
+def new_chat(user_id: str) -> str:
+    """Create new chat"""
+    lang = get_user_lang(user_id)
+    chat_id = create_chat(user_id)
     console.print(f"[green]🆕 {tr('chat_created', lang)}: [bold]{chat_id}[/][/]")
     return chat_id
 
 def use_chat(user_id: str, chat_id: str) -> bool:
-    """Switch to chat"""
+    """Switch to chat, restoring it from the archive if needed"""
     lang = get_user_lang(user_id)
     try:
         user_id = str(user_id)
-        chats = load_user_chats()
-        user_chats = chats.get(user_id, {})
-        if chat_id in user_chats.get("chats", {}):
-            user_chats["active"] = chat_id
-            chats[user_id] = user_chats
-            save_user_chats(chats)
+        user_chats = get_user_chats(user_id)
+        with user_locks(user_id):
+            archived = chat_id not in user_chats["chats"]
+        if archived and restore_chat(user_id, chat_id):
+            console.print(f"[dim]📦 {tr('chat_restored', lang)}[/]")
+        with user_locks(user_id):
+            found = chat_id in user_chats["chats"]
+            if found:
+                user_chats["active"] = chat_id
+        if found:
+            save_user_chats(load_user_chats())
+            touch_chat(user_id, chat_id)
+            # Load the history now rather than on the first message
+            get_chat_history(user_id, chat_id)
             console.print(f"[green]✅ {tr('chat_switched', lang)}: [bold]{chat_id}[/][/]")
             return True
         else:
@@ -829,22 +4528,45 @@ def use_chat(user_id: str, chat_id: str) -> bool:
         console.print(f"[red]❌ {tr('chat_not_found', lang)}[/]")
         return False
 
+def remove_chat(user_id: str, chat_id: str) -> bool:
+    """Delete a chat, archived or not; False if it does not exist"""
+    user_id = str(user_id)
+    user_chats = get_user_chats(user_id)
+    with user_locks(user_id):
+        chat_list = user_chats["chats"]
+        found = chat_id in chat_list
+        if found:
+            chat_data = chat_list.pop(chat_id)
+            if user_chats.get("active") == chat_id:
+                user_chats["active"] = next(iter(chat_list.keys()), None) if chat_list else None
+    if not found:
+        archive = get_chat_archive()
+        meta = archive.list_chat_meta(user_id).get(chat_id)
+        if meta is None:
+            return False
+        archive.remove(user_id, chat_id)
+        touch_chat(user_id, chat_id, forget=True)
+        metrics.incr('active_chats', -1)
+        metrics.incr('total_messages', -meta["messages"])
+        save_metrics()
+        return True
+    chat_locks.discard((user_id, chat_id))
+    forget_history((user_id, chat_id))
+    touch_chat(user_id, chat_id, forget=True)
+    if "history" in chat_data:
+        messages = len(chat_data["history"])
+    else:
+        messages = get_chat_store().list_chat_meta(user_id).get(chat_id, {}).get("messages", 0)
+    metrics.incr('active_chats', -1)
+    metrics.incr('total_messages', -messages)
+    save_user_chats(load_user_chats())
+    return True
+
 def del_chat(user_id: str, chat_id: str) -> bool:
     """Delete chat"""
     lang = get_user_lang(user_id)
     try:
-        user_id = str(user_id)
-        chats = load_user_chats()
-        user_chats = chats.get(user_id, {})
-        chat_list = user_chats.get("chats", {})
-        if chat_id in chat_list:
-            del chat_list[chat_id]
-            if user_chats.get("active") == chat_id:
-                user_chats["active"] = next(iter(chat_list.keys()), None) if chat_list else None
-            user_chats["chats"] = chat_list
-            chats[user_id] = user_chats
-            save_user_chats(chats)
-            stats['active_chats'] = max(0, stats['active_chats'] - 1)
+        if remove_chat(user_id, chat_id):
             console.print(f"[yellow]🗑️ {tr('chat_deleted', lang)}: [bold]{chat_id}[/][/]")
             return True
         else:
@@ -854,21 +4576,82 @@ def del_chat(user_id: str, chat_id: str) -> bool:
         console.print(f"[red]❌ {tr('chat_not_found', lang)}[/]")
         return False
 
+def save_chat_export(user_id: str, chat_id: str) -> Optional[str]:
+    """Write a chat, hot or archived, to chat_config/exports; returns the file path"""
+    lang = get_user_lang(user_id)
+    chat = export_chat(user_id, chat_id)
+    if chat is None:
+        console.print(f"[red]❌ {tr('chat_not_found', lang)}[/]")
+        return None
+    export_dir = os.path.join(CONFIG_DIR, "exports")
+    os.makedirs(export_dir, exist_ok=True)
+    path = os.path.join(export_dir, f"chat_{chat_id}.json")
+    atomic_write_json(path, chat)
+    console.print(f"[green]💾 {tr('chat_exported', lang)}: [link=file://{os.path.abspath(path)}]{path}[/][/]")
+    return path
+
+def chat_overview(user_id: str) -> Tuple[Dict[str, dict], Optional[str]]:
+    """Metadata of a user's chats in creation order, archived ones included, and the active chat id"""
+    user_id = str(user_id)
+    user_chats = get_user_chats(user_id)
+    with user_locks(user_id):
+        chat_list = dict(user_chats["chats"])
+        active_id = user_chats.get("active")
+    overview = {}
+    stored = None
+    for cid, chat_data in chat_list.items():
+        if "history" in chat_data:
+            messages = len(chat_data["history"])
+        else:
+            # Histories that were never loaded are counted by the store
+            if stored is None:
+                stored = get_chat_store().list_chat_meta(user_id)
+            messages = stored.get(cid, {}).get("messages", 0)
+        overview[cid] = {"messages": messages, "provider": chat_data.get("provider"),
+                         "created": chat_data.get("created"), "archived": False}
+    for cid, meta in get_chat_archive().list_chat_meta(user_id).items():
+        if cid not in overview:
+            overview[cid] = {"messages": meta["messages"], "provider": meta["provider"],
+                             "created": meta["created"], "archived": True}
+    overview = dict(sorted(overview.items(), key=lambda item: item[1]["created"] or 0))
+    return overview, active_id
+
+def show_search(user_id: str, query: str) -> None:
+    """Show the messages best matching query across the user's chats"""
+    from rich.markup import escape
+    lang = get_user_lang(user_id)
+    try:
+        results = search_messages(user_id, query)
+        if not results:
+            console.print(f"[yellow]{tr('search_empty', lang)}[/]")
+            return
+        lines = []
+        for result in results:
+            snippet = escape(" ".join(result["snippet"].split()))
+            snippet = snippet.replace(SEARCH_MARK_START, "[bold yellow]").replace(SEARCH_MARK_END, "[/]")
+            lines.append(f"[bold]{result['chat_id']}[/] [dim]#{result['ordinal']} {result['role']}[/]\n  {snippet}")
+        console.print(Panel(
+            "\n".join(lines),
+            title=f"[bold cyan]{tr('search_title', lang)}: {escape(query)}[/]",
+            border_style="blue",
+            padding=(0, 2),
+            width=100
+        ))
+    except Exception as e:
+        logger.error(f"Search error: {e}")
+        console.print(f"[red]❌ {tr('gen_error', lang)}[/]")
+
 def list_chats(user_id: str) -> None:
     """List user chats"""
     lang = get_user_lang(user_id)
-    user_id = str(user_id)
-    chats = load_user_chats()
-    user_chats = chats.get(user_id, {})
-    chat_list = user_chats.get("chats", {})
-    active_id = user_chats.get("active")
+    chat_list, active_id = chat_overview(user_id)
     if not chat_list:
         console.print(f"[yellow]{tr('no_chats', lang)}[/]")
         return
     panel_text = ""
-    for cid, data in chat_list.items():
-        mark = "🟢" if cid == active_id else "⚪"
-        msg_count = len(data.get("history", [])) - 1  # Exclude system message
+    for cid, meta in chat_list.items():
+        mark = "🟢" if cid == active_id else "📦" if meta["archived"] else "⚪"
+        msg_count = meta["messages"] - 1  # Exclude system message
         panel_text += f"[bold]{mark} {cid}[/] - {msg_count} msgs\n"
     console.print(Panel(
         panel_text.strip(),
@@ -878,6 +4661,29 @@ def list_chats(user_id: str) -> None:
         width=60
     ))
 
+def set_deadline(user_id: str, value: Optional[str]) -> bool:
+    """Set the user's reply time limit in seconds, or "off" for the model default; shows it without a value"""
+    lang = get_user_lang(user_id)
+    user_id = str(user_id)
+    if value is not None:
+        if value.lower() == 'off':
+            save_user_deadline(user_id, None)
+        else:
+            try:
+                seconds = float(value)
+            except ValueError:
+                seconds = -1.0
+            if not DEADLINE_LIMITS[0] <= seconds <= DEADLINE_LIMITS[1]:
+                console.print(f"[red]❌ {tr('deadline_invalid', lang).format(*DEADLINE_LIMITS)}[/]")
+                return False
+            save_user_deadline(user_id, seconds)
+    model_name = load_user_models().get(user_id, 'gpt-4o')
+    source = (tr('deadline_user', lang) if user_id in load_user_deadlines()
+              else f"{tr('deadline_model', lang)} {model_name}")
+    console.print(f"[green]⏱️ {tr('deadline_current', lang)}: [bold]{deadline_seconds(user_id, model_name):g}s[/] "
+                  f"[dim]({source})[/][/]")
+    return True
+
 def show_model(user_id: str) -> None:
     """Show current model"""
     lang = get_user_lang(user_id)
@@ -901,18 +4707,22 @@ def list_models(user_id: str) -> None:
     g4f_version = getattr(g4f, 'version', 'unknown')
     try:
         models_dict = get_supported_models()
+        providers = init_providers()
+        index = get_model_index()
         panel_text = ""
         for provider, models in models_dict.items():
             panel_text += f"\n[bold underline]{provider}:[/]\n"
             for model in sorted(models):
+                count = index.provider_count(model, providers)
+                count_text = f" [dim]({count})[/]" if count else " [red](0)[/]"
                 if provider == "Reasoning Specialists": # Updated category name
-                    panel_text += f"  - [bright_cyan]{model} ⚙️[/]\n"
+                    panel_text += f"  - [bright_cyan]{model} ⚙️[/]{count_text}\n"
                 else:
-                    panel_text += f"  - {model}\n"
+                    panel_text += f"  - {model}{count_text}\n"
         console.print(Panel(
             panel_text.strip(),
             title=f"[cyan]{tr('available_models', lang)} (g4f v{G4F_VERSION})[/]",
-            subtitle="⚙️ = Specialized Model",
+            subtitle=f"⚙️ = Specialized Model, {tr('provider_counts', lang)}",
             border_style="magenta",
             padding=(0, 2),
             width=80
@@ -925,8 +4735,14 @@ def list_providers(user_id: str) -> None:
     """List active providers"""
     lang = get_user_lang(user_id)
     try:
-        providers = init_providers()
-        panel_text = "\n".join([f"- [bold]{provider.__name__}[/]" for provider in providers])
+        model_name = load_user_models().get(str(user_id), 'gpt-4o')
+        scoreboard = get_scoreboard()
+        providers = scoreboard.order(init_providers(), model_name)
+        panel_text = "\n".join([
+            f"- [bold]{provider.__name__}[/] [dim]({scoreboard.describe(provider.__name__, model_name)}; "
+            f"{provider_limiter.describe(provider.__name__)})[/]"
+            for provider in providers
+        ])
         console.print(Panel(
             f"{panel_text}\n[bold yellow]{tr('total_providers', lang)}: {len(providers)}[/]",
             title=f"[cyan]{tr('providers_title', lang)}[/]",
@@ -942,22 +4758,29 @@ def system_status(user_id: str) -> None:
     """Show system status"""
     lang = get_user_lang(user_id)
     try:
+        # Copy, so counters updated by other threads stay consistent while printing
+        current = metrics.snapshot()
         models_dict = get_supported_models()
         total_models = sum(len(m) for m in models_dict.values())
         providers = init_providers()
         user_models = load_user_models()
         current_model = user_models.get(str(user_id), 'gpt-4o')
-        last_active = time.strftime(tr('time_format', lang), time.localtime(stats['last_activity']))
+        last_active = time.strftime(tr('time_format', lang), time.localtime(current['last_activity']))
         api_type = tr('using_client_api', lang) if USE_CLIENT_API else tr('using_legacy_api', lang)
         console.print(Panel(
             f"[bold]{tr('current_model', lang)}:[/] {current_model}\n"
             f"[bold]{tr('available_models', lang)}:[/] {total_models}\n"
             f"[bold]{tr('active_providers', lang)}:[/] {len(providers)}\n"
-            f"[bold]{tr('active_chats', lang)}:[/] {stats['active_chats']}\n"
-            f"[bold]{tr('total_messages', lang)}:[/] {stats['total_messages']}\n"
-            f"[bold]{tr('saved_blocks', lang)}:[/] {stats['saved_code_blocks']}\n"
-            f"[bold]{tr('api_calls', lang)}:[/] {stats['total_api_calls']}\n"
+            f"[bold]{tr('active_chats', lang)}:[/] {current['active_chats']}\n"
+            f"[bold]{tr('total_messages', lang)}:[/] {current['total_messages']}\n"
+            f"[bold]{tr('saved_blocks', lang)}:[/] {current['saved_code_blocks']}\n"
+            f"[bold]{tr('api_calls', lang)}:[/] {current['total_api_calls']}\n"
+            f"[bold]Client pool:[/] {len(client_pool)} ({client_pool.hits} reused, {client_pool.misses} created)\n"
+            f"[bold]{tr('history_cache', lang)}:[/] {len(history_lru)} "
+            f"({history_lru.total / 1048576:.1f} / {history_lru.max_bytes / 1048576:.0f} MB, "
+            f"{history_lru.loads} loaded, {history_lru.evictions} evicted)\n"
             f"[bold]{tr('last_activity', lang)}:[/] {last_active}\n"
+            f"[bold]Startup:[/] {startup_report()}\n"
             f"[bold]System:[/] {sys.platform}\n"
             f"[bold]Python:[/] {sys.version.split()[0]}\n"
             f"[bold]API:[/] {api_type}",
@@ -970,16 +4793,41 @@ def system_status(user_id: str) -> None:
         logger.error(f"Status error: {e}")
         console.print(f"[red]❌ {tr('gen_error', lang)}[/]")
 
-def show_stats(user_id: str) -> None:
-    """Show usage statistics"""
+def show_stats(user_id: str, verify: bool = False) -> None:
+    """Show usage statistics; with verify, recount chats and messages from the store first"""
     lang = get_user_lang(user_id)
     try:
-        last_active = time.strftime(tr('time_format', lang), time.localtime(stats['last_activity']))
+        if verify:
+            flush_writes()
+            drift = metrics.recount(get_chat_store(), get_chat_archive().totals())
+            if drift:
+                save_metrics()
+                details = ", ".join(f"{name} {counted:g} → {stored:g}" for name, (counted, stored) in drift.items())
+                console.print(f"[yellow]⚠️ {tr('stats_corrected', lang)}: {details}[/]")
+            else:
+                console.print(f"[green]✅ {tr('stats_verified', lang)}[/]")
+        # Copy, so counters updated by other threads stay consistent while printing
+        current = metrics.snapshot()
+        last_active = time.strftime(tr('time_format', lang), time.localtime(current['last_activity']))
+        cache = get_response_cache()
+        cache_line = ""
+        if cache:
+            cache_line = (
+                f"[bold]{tr('response_cache', lang)}:[/] "
+                f"{cache.memory_hits + cache.disk_hits} {tr('cache_hits', lang)} "
+                f"({cache.memory_hits} mem / {cache.disk_hits} disk), {cache.misses} {tr('cache_misses', lang)}\n"
+            )
+        if COALESCE_REQUESTS and single_flight.coalesced:
+            cache_line += (
+                f"[bold]{tr('coalesced', lang)}:[/] {single_flight.coalesced} {tr('coalesced_joined', lang)}, "
+                f"{single_flight.started} {tr('coalesced_upstream', lang)}\n"
+            )
         console.print(Panel(
-            f"[bold]{tr('total_messages', lang)}:[/] {stats['total_messages']}\n"
-            f"[bold]{tr('saved_blocks', lang)}:[/] {stats['saved_code_blocks']}\n"
-            f"[bold]{tr('active_chats', lang)}:[/] {stats['active_chats']}\n"
-            f"[bold]{tr('api_calls', lang)}:[/] {stats['total_api_calls']}\n"
+            f"[bold]{tr('total_messages', lang)}:[/] {current['total_messages']}\n"
+            f"[bold]{tr('saved_blocks', lang)}:[/] {current['saved_code_blocks']}\n"
+            f"[bold]{tr('active_chats', lang)}:[/] {current['active_chats']}\n"
+            f"[bold]{tr('api_calls', lang)}:[/] {current['total_api_calls']}\n"
+            f"{cache_line}"
             f"[bold]{tr('last_activity', lang)}:[/] {last_active}",
             title=f"[cyan]{tr('stats_title', lang)}[/]",
             border_style="blue",
@@ -990,17 +4838,76 @@ def show_stats(user_id: str) -> None:
         logger.error(f"Stats error: {e}")
         console.print(f"[red]❌ {tr('gen_error', lang)}[/]")
 
+def format_seconds(value: Optional[float]) -> str:
+    if value is None:
+        return "-"
+    return f"{value * 1000:.0f}ms" if value < 1 else f"{value:.1f}s"
+
+def show_perf(user_id: str) -> None:
+    """Show latency histograms and error counts per provider and model"""
+    from rich.table import Table
+    lang = get_user_lang(user_id)
+    try:
+        latency = {dict(key)["provider"] + "|" + dict(key)["model"]: value
+                   for key, value in perf.series('provider_latency_seconds').items()}
+        ttfb = {dict(key)["provider"] + "|" + dict(key)["model"]: value
+                for key, value in perf.series('provider_ttfb_seconds').items()}
+        errors: Dict[str, Dict[str, float]] = {}
+        for key, count in perf.series('provider_errors_total').items():
+            labels = dict(key)
+            errors.setdefault(f"{labels['provider']}|{labels['model']}", {})[labels['kind']] = count
+        table = Table(title=f"[cyan]{tr('perf_title', lang)}[/]", border_style="magenta", width=100)
+        for column in ("Provider", "Model", "OK", "p50", "p95", "TTFB p50", "Errors"):
+            table.add_column(column, justify="left" if column in ("Provider", "Model", "Errors") else "right")
+        for name in sorted(set(latency) | set(errors)):
+            provider_name, model_name = name.split("|", 1)
+            histogram = latency.get(name)
+            table.add_row(
+                provider_name,
+                model_name,
+                str(histogram.count if histogram else 0),
+                format_seconds(histogram.quantile(0.5) if histogram else None),
+                format_seconds(histogram.quantile(0.95) if histogram else None),
+                format_seconds(ttfb[name].quantile(0.5) if name in ttfb else None),
+                ", ".join(f"{kind} {count:g}" for kind, count in sorted(errors.get(name, {}).items())) or "-"
+            )
+        if not table.row_count:
+            console.print(f"[yellow]{tr('perf_empty', lang)}[/]")
+            return
+        console.print(table)
+
+        def summary(metric: str, label: Optional[str], seconds: bool = True) -> str:
+            parts = []
+            for key, histogram in sorted(perf.series(metric).items()):
+                name = dict(key).get(label, "") if label else ""
+                low, high = histogram.quantile(0.5), histogram.quantile(0.95)
+                values = (f"p50 {format_seconds(low)}, p95 {format_seconds(high)}" if seconds
+                          else f"mean {histogram.sum / histogram.count:.2f}, p95 {high:.1f}")
+                parts.append(f"{name + ' ' if name else ''}{values} (n={histogram.count})")
+            return "; ".join(parts) or "-"
+        console.print(
+            f"[bold]{tr('perf_turns', lang)}:[/] {summary('turn_seconds', None)}\n"
+            f"[bold]{tr('perf_attempts', lang)}:[/] {summary('reply_attempts', 'model', seconds=False)}\n"
+            f"[bold]{tr('perf_persistence', lang)}:[/] {summary('persist_seconds', 'target')}\n"
+            f"[bold]{tr('perf_postprocess', lang)}:[/] {summary('postprocess_seconds', 'step')}"
+        )
+    except Exception as e:
+        logger.error(f"Perf error: {e}")
+        console.print(f"[red]❌ {tr('gen_error', lang)}[/]")
+
 def chat_loop() -> None:
     """Main chat loop"""
     user_id = "1"  # Single user for console version
     lang = get_user_lang(user_id)
     os.makedirs(os.path.join(CONFIG_DIR, "saved_code"), exist_ok=True)
     # Initialize chats
-    chats = load_user_chats()
-    user_chats = chats.setdefault(user_id, {})
-    active_id = user_chats.get("active")
-    if not active_id or active_id not in user_chats.get("chats", {}):
+    user_chats = get_user_chats(user_id)
+    with user_locks(user_id):
+        active_id = user_chats.get("active")
+        found = active_id in user_chats["chats"]
+    if not active_id or not found:
         active_id = new_chat(user_id)
+    mark_startup("chats")
     # Welcome message
     g4f_version = getattr(g4f, 'version', 'unknown')
     api_type = tr('using_client_api', lang) if USE_CLIENT_API else tr('using_legacy_api', lang)
@@ -1015,7 +4922,11 @@ def chat_loop() -> None:
         width=80
     ))
     show_help(user_id)
+    mark_startup("ui")
     init_providers()
+    mark_startup("providers")
+    logger.info(f"Startup: {startup_report()}")
+    start_chat_archiver()
     # Main interaction loop
     while True:
         try:
@@ -1023,9 +4934,7 @@ def chat_loop() -> None:
             user_input = input().strip()
             if not user_input:
                 continue
-            # Update stats
-            stats['total_messages'] += 1
-            stats['last_activity'] = time.time()
+            metrics.set('last_activity', time.time())
             # Command handling
             if user_input.startswith('/'):
                 cmd_parts = user_input.split(maxsplit=1)
@@ -1033,6 +4942,11 @@ def chat_loop() -> None:
                 arg = cmd_parts[1] if len(cmd_parts) > 1 else None
                 if cmd == '/exit':
                     console.print(f"[bold yellow]{tr('exit_confirmation', lang)}[/]")
+                    get_scoreboard().save(force=True)
+                    save_metrics()
+                    get_writer().close()
+                    close_search_index()
+                    get_chat_store().close()
                     break
                 elif cmd == '/help':
                     show_help(user_id)
@@ -1051,6 +4965,16 @@ def chat_loop() -> None:
                         console.print(f"[red]❌ Usage: /delchat <chat_id>[/]")
                 elif cmd == '/chats':
                     list_chats(user_id)
+                elif cmd == '/search':
+                    if arg:
+                        show_search(user_id, arg)
+                    else:
+                        console.print(f"[red]❌ Usage: /search <query>[/]")
+                elif cmd == '/export':
+                    if arg:
+                        save_chat_export(user_id, arg)
+                    else:
+                        console.print(f"[red]❌ Usage: /export <chat_id>[/]")
                 elif cmd == '/setmodel':
                     if arg:
                         set_model(user_id, arg)
@@ -1058,6 +4982,8 @@ def chat_loop() -> None:
                         console.print(f"[red]❌ Usage: /setmodel <model_name>[/]")
                 elif cmd == '/mymodel':
                     show_model(user_id)
+                elif cmd == '/deadline':
+                    set_deadline(user_id, arg)
                 elif cmd == '/models':
                     list_models(user_id)
                 elif cmd == '/providers':
@@ -1073,53 +4999,89 @@ def chat_loop() -> None:
                         console.print(f"[yellow]Current language: {lang}[/]")
                         console.print(f"[red]❌ {tr('invalid_lang', lang)}[/]")
                 elif cmd == '/stats':
-                    show_stats(user_id)
+                    show_stats(user_id, arg == 'verify')
+                elif cmd == '/perf':
+                    show_perf(user_id)
                 else:
                     console.print(f"[red]❌ {tr('unknown_command', lang)}. /help {tr('help', lang).lower()}[/]")
                 continue
-            # Process user message
-            all_chats = load_user_chats()
-            user_chats = all_chats.setdefault(user_id, {})
-            chat_data = user_chats.setdefault("chats", {}).setdefault(active_id, {})
-            history = chat_data.setdefault("history", [])
-            # Add user message to history
-            history.append({"role": "user", "content": user_input})
-            # Generate response with progress indicator
+            # Process user message; send_message records both sides of the turn
             response_text = ""
-            with Progress(
-                SpinnerColumn(),
-                TextColumn(f"[bold blue]{tr('generating', lang)}"),
-                transient=True,
-                console=console
-            ) as progress:
-                task = progress.add_task(tr('generating', lang), total=None)
+            if STREAM_OUTPUT:
+                # Stream the reply into a live view
+                renderer = StreamRenderer(lang)
+                console.print(f"\n[bold cyan]🤖 {tr('ai_prompt', lang)}:[/]")
                 try:
-                    response_text = generate_response(user_id, active_id, history)
-                    # Add to history if valid response
-                    if response_text and not response_text.startswith("❌"):
-                        history.append({"role": "assistant", "content": response_text})
-                    # Process thinking patterns
-                    response_text = process_model_thinking(response_text, lang)
-                    # Save code blocks
-                    response_text = save_code_blocks(response_text, active_id, lang)
-                    # Display response with syntax highlighting
-                    console.print(f"\n[bold cyan]🤖 {tr('ai_prompt', lang)}:[/]")
-                    try:
-                        highlighted = highlight_code(response_text)
-                        console.print(highlighted)
-                    except:
+                    with Live(renderer, console=console, refresh_per_second=8, vertical_overflow="visible"):
+                        response_text = send_message(user_id, active_id, user_input, renderer)
+                        renderer.finish()
+                    if renderer.has_output:
+                        # Already displayed; only save the code blocks
+                        with perf.timer('postprocess_seconds', step='save_code'):
+                            save_code_blocks(renderer.segments, active_id, lang)
+                    else:
                         console.print(response_text)
                 except Exception as e:
                     logger.error(f"Generation error: {e}")
                     console.print(f"\n[red]⚠️ {tr('gen_error', lang)}[/]")
-                progress.update(task, completed=100)
-            # Save updated chat history
-            save_user_chats(all_chats)
+            else:
+                # Generate response with progress indicator
+                from rich.progress import Progress, SpinnerColumn, TextColumn
+                with Progress(
+                    SpinnerColumn(),
+                    TextColumn(f"[bold blue]{tr('generating', lang)}"),
+                    transient=True,
+                    console=console
+                ) as progress:
+                    task = progress.add_task(tr('generating', lang), total=None)
+                    try:
+                        response_text = send_message(user_id, active_id, user_input)
+                        # Split the reply once; each step consumes the segments
+                        with perf.timer('postprocess_seconds', step='tokenize'):
+                            segments = tokenize_response(response_text)
+                        # Process thinking patterns
+                        with perf.timer('postprocess_seconds', step='thinking'):
+                            segments = process_model_thinking(segments, lang)
+                        # Save code blocks
+                        with perf.timer('postprocess_seconds', step='save_code'):
+                            segments = save_code_blocks(segments, active_id, lang)
+                        # Display response with syntax highlighting
+                        console.print(f"\n[bold cyan]🤖 {tr('ai_prompt', lang)}:[/]")
+                        try:
+                            with perf.timer('postprocess_seconds', step='highlight'):
+                                highlighted = highlight_code(segments)
+                            console.print(highlighted.strip())
+                        except:
+                            console.print("".join(segment.content for segment in segments).strip())
+                    except Exception as e:
+                        logger.error(f"Generation error: {e}")
+                        console.print(f"\n[red]⚠️ {tr('gen_error', lang)}[/]")
+                    progress.update(task, completed=100)
         except KeyboardInterrupt:
             console.print(f"\n[bold yellow]{tr('exit', lang)}: /exit[/]")
         except Exception as e:
             logger.error(f"Main loop error: {e}")
             console.print(f"[red]⚠️ {tr('main_error', lang)}[/]")
 
+def main(argv: Optional[List[str]] = None) -> None:
+    """Command line entry point: the interactive chat, batch mode with --batch or the server with --serve"""
+    import argparse
+    parser = argparse.ArgumentParser(description="AI Chat Console")
+    parser.add_argument('--batch', metavar='INPUT', help="run a JSONL file of {id, model, messages} records")
+    parser.add_argument('--output', metavar='OUTPUT', help="JSONL results file (default: INPUT.results.jsonl)")
+    parser.add_argument('--concurrency', type=int, default=BATCH_CONCURRENCY, help="prompts in flight at once")
+    parser.add_argument('--model', default='gpt-4o', help="model for records without one")
+    parser.add_argument('--serve', action='store_true', help="run the OpenAI-compatible HTTP server")
+    parser.add_argument('--host', default=SERVER_HOST, help="server address")
+    parser.add_argument('--port', type=int, default=SERVER_PORT, help="server port")
+    args = parser.parse_args(argv)
+    if args.serve:
+        serve(args.host, args.port)
+    elif args.batch:
+        output_path = args.output or f"{os.path.splitext(args.batch)[0]}.results.jsonl"
+        run_batch(args.batch, output_path, args.concurrency, args.model)
+    else:
+        chat_loop()
+
 if __name__ == '__main__':
-    chat_loop()
\ No newline at end of file
+    main()
\ No newline at end of file
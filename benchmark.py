@@ -0,0 +1,465 @@
+"""Offline benchmarks for G4FChat.
+
+Everything runs against stub providers in a temporary directory, so no
+network access is needed and existing chats are never touched. Results are
+written as JSON; --compare prints the change against an earlier run.
+
+    python benchmark.py --output bench.json
+    python benchmark.py --quick --compare bench.json
+    python benchmark.py --stress 200 --threads 8
+"""
+import os
+import io
+import sys
+import json
+import time
+import math
+import random
+import asyncio
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from typing import Dict, List, Optional, Any, Callable
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+BENCH_USER = "bench"
+BENCH_MODEL = "gpt-4o"
+
+def build_payload(size: int, seed: int = 0) -> str:
+    """Deterministic model reply of about size characters with text, thinking and code blocks"""
+    rng = random.Random(seed)
+    words = ["provider", "latency", "stream", "token", "chat", "model", "cache", "render", "async", "store"]
+    parts = []
+    length = 0
+    block = 0
+    while length < size:
+        kind = block % 4
+        if kind == 0:
+            part = " ".join(rng.choice(words) for _ in range(60)) + "\n"
+        elif kind == 1:
+            part = "<thinking>" + " ".join(rng.choice(words) for _ in range(20)) + "</thinking>\n"
+        elif kind == 2:
+            body = "\n".join(f"    value_{i} = compute({i}, '{rng.choice(words)}')" for i in range(8))
+            part = f"```python\ndef step_{block}():\n{body}\n    return value_0\n```\n"
+        else:
+            part = "```js\n" + "\n".join(f"const {w}{i} = {i};" for i, w in enumerate(words)) + "\n```\n"
+        parts.append(part)
+        length += len(part)
+        block += 1
+    return "".join(parts)[:size]
+
+def make_stub_provider(name: str, latency: float = 0.05, failure_rate: float = 0.0, chunks: int = 8,
+                       payload_chars: int = 2000, seed: int = 0, models: tuple = (BENCH_MODEL,),
+                       capacity: int = 0) -> type:
+    """g4f provider class that answers after latency seconds, streaming a fixed payload in chunks.
+    Failures are drawn from a seeded generator, so every run fails on the same requests.
+    With a capacity, requests beyond that many in flight are rejected with a 429 error."""
+    from g4f.providers.base_provider import AsyncGeneratorProvider
+    rng = random.Random(seed)
+    payload = build_payload(payload_chars, seed)
+    size = max(1, math.ceil(len(payload) / max(1, chunks)))
+
+    async def create_async_generator(cls, model: str, messages: list, proxy: Optional[str] = None, **kwargs):
+        cls.calls += 1
+        if capacity and cls.in_flight >= capacity:
+            cls.rejected += 1
+            raise RuntimeError(f"{name}: 429 Too Many Requests")
+        failed = rng.random() < failure_rate
+        cls.in_flight += 1
+        try:
+            await asyncio.sleep(latency)
+            if failed:
+                raise RuntimeError(f"{name}: injected failure")
+            for start in range(0, len(payload), size):
+                yield payload[start:start + size]
+                await asyncio.sleep(0)
+        finally:
+            cls.in_flight -= 1
+
+    return type(name, (AsyncGeneratorProvider,), {
+        "__module__": __name__,
+        "working": True,
+        "supports_stream": True,
+        "default_model": models[0],
+        "models": list(models),
+        "calls": 0,
+        "in_flight": 0,
+        "rejected": 0,
+        "create_async_generator": classmethod(create_async_generator)
+    })
+
+class Bench:
+    """Imports G4FChat inside a scratch directory and swaps in stub providers"""
+
+    def __init__(self, workdir: str, seed: int):
+        self.workdir = workdir
+        self.seed = seed
+        os.chdir(workdir)
+        sys.path.insert(0, REPO_DIR)
+        import g4f.debug
+        g4f.debug.version_check = False  # Stay offline
+        import G4FChat
+        from rich.console import Console
+        self.app = G4FChat
+        self.app.console = Console(file=io.StringIO(), width=120)
+
+    def use_providers(self, providers: List[type], rate: float = 1e9) -> None:
+        """Replace the provider list, scoreboard, model index and provider limits.
+        The stubs are not rate limited unless a rate (requests per second) is given."""
+        app = self.app
+        app.provider_limiter = app.ProviderLimiter(rate, max(app.PROVIDER_BURST, int(min(rate, 1e6))),
+                                                   app.PROVIDER_CONCURRENCY_START, app.PROVIDER_CONCURRENCY_MAX)
+        app.active_providers = list(providers)
+        app.provider_classes = {provider.__name__: provider for provider in providers}
+        app.provider_scoreboard = None
+        app.model_index = None
+        scores = os.path.join(app.CONFIG_DIR, app.PROVIDER_SCORES_FILE)
+        if os.path.exists(scores):
+            os.remove(scores)
+
+    def use_store(self, backend: str, name: str) -> None:
+        """Start over with an empty chat store of the given backend"""
+        app = self.app
+        app.flush_writes()
+        app.close_search_index()
+        if app.chat_store is not None:
+            app.chat_store.close()
+        app.CONFIG_DIR = os.path.join(self.workdir, name)
+        os.makedirs(app.CONFIG_DIR, exist_ok=True)
+        app.CHAT_STORE_BACKEND = backend
+        app.chat_store = None
+        app.chat_archive = None
+        app.chat_activity = None
+        app.user_chats_cache = None
+        app.metrics = app.Metrics()
+        app.load_user_chats()
+
+def percentile(samples: List[float], fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+def summarize(samples: List[float], offset: float = 0.0) -> Dict[str, float]:
+    """Latency summary in milliseconds; offset (seconds) is subtracted to show overhead"""
+    return {
+        "p50_ms": round((percentile(samples, 0.5) - offset) * 1000, 3),
+        "p95_ms": round((percentile(samples, 0.95) - offset) * 1000, 3),
+        "mean_ms": round((sum(samples) / len(samples) - offset) * 1000, 3),
+        "samples": len(samples)
+    }
+
+def bench_turns(bench: Bench, turns: int) -> Dict[str, Dict[str, Any]]:
+    """End-to-end turn latency through send_message, minus the stub's own latency"""
+    app = bench.app
+    results = {}
+    latency = 0.02
+    bench.use_store('journal', 'turns')
+    for stream in (False, True):
+        bench.use_providers([make_stub_provider("StubFast", latency, seed=bench.seed)])
+        chat_id = app.create_chat(BENCH_USER)
+        samples = []
+        for i in range(turns):
+            renderer = app.StreamRenderer() if stream else None
+            started = time.perf_counter()
+            app.send_message(BENCH_USER, chat_id, f"prompt {i}", renderer)
+            if renderer:
+                renderer.finish()
+            samples.append(time.perf_counter() - started)
+        results[f"turn.{'stream' if stream else 'whole'}"] = dict(summarize(samples, latency), stub_latency_ms=latency * 1000)
+
+    # A dead provider listed first: the circuit breaker should stop paying for it
+    failing = make_stub_provider("StubDead", latency, failure_rate=1.0, seed=bench.seed)
+    good = make_stub_provider("StubGood", latency, seed=bench.seed)
+    bench.use_providers([failing, good])
+    chat_id = app.create_chat(BENCH_USER)
+    samples = []
+    for i in range(turns):
+        started = time.perf_counter()
+        app.send_message(BENCH_USER, chat_id, f"prompt {i}")
+        samples.append(time.perf_counter() - started)
+    results["turn.fallback"] = dict(summarize(samples), dead_provider_calls=failing.calls)
+
+    # Many chats at once on the async core; distinct prompts, so none are coalesced
+    bench.use_providers([make_stub_provider("StubShared", latency, seed=bench.seed)])
+    chats = [app.create_chat(f"{BENCH_USER}-{n}") for n in range(16)]
+
+    async def burst() -> None:
+        await asyncio.gather(*[
+            app.send_message_async(f"{BENCH_USER}-{n}", chat_id, f"prompt {n}.{i}")
+            for n, chat_id in enumerate(chats) for i in range(max(1, turns // 8))
+        ])
+    started = time.perf_counter()
+    app.get_async_runner().run(burst())
+    elapsed = time.perf_counter() - started
+    total = len(chats) * max(1, turns // 8)
+    results["turn.concurrent"] = {"turns": total, "chats": len(chats), "turns_per_s": round(total / elapsed, 1)}
+
+    # The same burst against a provider that rejects more than 3 requests at once, with a backup
+    limited = make_stub_provider("StubLimited", latency, seed=bench.seed, capacity=3)
+    backup = make_stub_provider("StubBackup", latency * 5, seed=bench.seed)
+    bench.use_providers([limited, backup])
+    started = time.perf_counter()
+    app.get_async_runner().run(burst())
+    elapsed = time.perf_counter() - started
+    results["turn.throttled"] = {"turns": total, "turns_per_s": round(total / elapsed, 1),
+                                 "rejected_429": limited.rejected, "backup_calls": backup.calls}
+    return results
+
+def bench_persistence(bench: Bench, chat_counts: List[int], history_lengths: List[int],
+                      repeats: int) -> Dict[str, Dict[str, Any]]:
+    """Cost of saving one new message, and of reloading, against store size"""
+    app = bench.app
+    results = {}
+    for backend in ('journal', 'sqlite'):
+        for chats in chat_counts:
+            for history in history_lengths:
+                bench.use_store(backend, f"store-{backend}-{chats}-{history}")
+                chat_ids = [app.create_chat(BENCH_USER) for _ in range(chats)]
+                filler = [{"role": "user" if i % 2 == 0 else "assistant", "content": f"message {i} " * 10}
+                          for i in range(history)]
+                for chat_id in chat_ids:
+                    app.append_chat_messages(BENCH_USER, chat_id, filler)
+                app.save_user_chats(app.load_user_chats())
+                started = time.perf_counter()
+                app.flush_writes()
+                initial = time.perf_counter() - started
+                save_samples, flush_samples = [], []
+                for i in range(repeats):
+                    app.append_chat_messages(BENCH_USER, chat_ids[i % chats], [{"role": "user", "content": f"new {i}"}])
+                    started = time.perf_counter()
+                    app.save_user_chats(app.load_user_chats())
+                    save_samples.append(time.perf_counter() - started)
+                    started = time.perf_counter()
+                    app.flush_writes()
+                    flush_samples.append(time.perf_counter() - started)
+                started = time.perf_counter()
+                store = app.CHAT_STORES[backend]()
+                store.load()
+                store.load_history(BENCH_USER, chat_ids[0])
+                reload = time.perf_counter() - started
+                store.close()
+                results[f"persist.{backend}.{chats}x{history}"] = {
+                    "initial_write_ms": round(initial * 1000, 3),
+                    "save_call_ms": summarize(save_samples)["mean_ms"],
+                    "flush_ms": summarize(flush_samples)["mean_ms"],
+                    "reload_ms": round(reload * 1000, 3)
+                }
+    return results
+
+def bench_postprocess(bench: Bench, repeats: int) -> Dict[str, Dict[str, Any]]:
+    """Throughput of reply tokenizing, thinking display, highlighting and live rendering"""
+    from rich.console import Console
+    app = bench.app
+    payload = build_payload(15000, bench.seed)
+    sink = Console(file=io.StringIO(), width=120)
+    steps: Dict[str, Callable[[], Any]] = {
+        "tokenize": lambda: app.tokenize_response(payload),
+        "thinking": lambda: app.process_model_thinking(app.tokenize_response(payload)),
+        "highlight": lambda: app.highlight_code(app.tokenize_response(payload)),
+    }
+
+    def stream_render() -> None:
+        renderer = app.StreamRenderer()
+        for start in range(0, len(payload), 64):
+            renderer.feed(payload[start:start + 64])
+            if start % 2048 == 0:
+                sink.print(renderer)
+        renderer.finish()
+        sink.print(renderer)
+    steps["stream_render"] = stream_render
+
+    results = {}
+    for name, step in steps.items():
+        step()  # Warm caches such as lexers
+        samples = []
+        for _ in range(repeats):
+            started = time.perf_counter()
+            step()
+            samples.append(time.perf_counter() - started)
+        mean = sum(samples) / len(samples)
+        results[f"postprocess.{name}"] = dict(summarize(samples), chars=len(payload),
+                                              chars_per_s=round(len(payload) / mean))
+    return results
+
+def bench_startup(runs: int) -> Dict[str, Dict[str, Any]]:
+    """Wall time to import the app, find providers and load chats, in a fresh process and directory"""
+    script = ("import g4f.debug; g4f.debug.version_check = False\n"
+              "import G4FChat\n"
+              "G4FChat.init_providers(); G4FChat.load_user_chats()\n"
+              "print(G4FChat.startup_report())")
+    env = dict(os.environ, PYTHONPATH=REPO_DIR + os.pathsep + os.environ.get("PYTHONPATH", ""))
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="g4fchat-startup-") as workdir:
+        samples = []
+        for _ in range(runs):
+            started = time.perf_counter()
+            subprocess.run([sys.executable, "-c", script], cwd=workdir, env=env, check=True,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            samples.append(time.perf_counter() - started)
+    # The first run builds the provider registry cache, later runs reuse it
+    results["startup.cold"] = {"wall_ms": round(samples[0] * 1000, 1)}
+    if len(samples) > 1:
+        results["startup.warm"] = summarize(samples[1:])
+    return results
+
+def stress_chats(bench: Bench, backend: str, threads: int = 8, turns: int = 200) -> bool:
+    """Concurrency check: threads append to a shared chat and their own chats while
+    chats are created, deleted, listed and saved. Every message must survive in memory
+    and in a freshly opened store."""
+    app = bench.app
+    bench.use_store(backend, f"stress-{backend}")
+    user_id = "stress"
+    shared = app.create_chat(user_id)
+    own_chats: Dict[int, str] = {}
+    errors: List[str] = []
+
+    def worker(n: int) -> None:
+        try:
+            own_user = f"{user_id}-{n}"
+            own_chats[n] = app.create_chat(own_user)
+            for i in range(turns):
+                for uid, cid in ((user_id, shared), (own_user, own_chats[n])):
+                    app.append_chat_messages(uid, cid, [
+                        {"role": "user", "content": f"{n}:{i}"},
+                        {"role": "assistant", "content": f"{n}:{i}:reply"}
+                    ])
+                if i % 10 == 0:
+                    app.remove_chat(user_id, app.create_chat(user_id))
+                    app.chat_overview(user_id)
+                if i % 5 == 0:
+                    app.save_user_chats(app.load_user_chats())
+        except Exception as e:
+            errors.append(f"thread {n}: {e}")
+
+    started = time.monotonic()
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    app.save_user_chats(app.load_user_chats())
+    app.flush_writes()
+    elapsed = time.monotonic() - started
+
+    expected = {(user_id, shared): {f"{n}:{i}" for n in range(threads) for i in range(turns)}}
+    for n, chat_id in own_chats.items():
+        expected[(f"{user_id}-{n}", chat_id)] = {f"{n}:{i}" for i in range(turns)}
+    reopened = app.CHAT_STORES[backend]()
+    reopened.load()
+    for (uid, cid), prompts in expected.items():
+        for source, history in (("memory", app.get_chat_history(uid, cid)),
+                                ("store", reopened.load_history(uid, cid))):
+            seen = [msg["content"] for msg in history if msg["role"] == "user"]
+            if len(history) != 1 + 2 * len(prompts) or set(seen) != prompts:
+                errors.append(f"{source} {uid}/{cid}: {len(history)} messages, expected {1 + 2 * len(prompts)}")
+    if list(reopened.list_chat_meta(user_id)) != [shared]:
+        errors.append(f"store has chats {list(reopened.list_chat_meta(user_id))} for {user_id}, expected [{shared}]")
+    counters = reopened.load_counters() or {}
+    reopened.close()
+    for name, (counted, stored) in app.metrics.recount(app.get_chat_store(), app.get_chat_archive().totals()).items():
+        errors.append(f"counter {name} is {counted:g}, store has {stored:g}")
+    if counters.get('total_messages') != app.metrics.snapshot()['total_messages']:
+        errors.append(f"persisted total_messages {counters.get('total_messages')} is out of date")
+
+    messages = sum(len(prompts) * 2 for prompts in expected.values())
+    print(f"stress {backend}: {threads} threads, {turns} turns, {messages} messages in {elapsed:.2f}s", file=sys.stderr)
+    for error in errors[:10]:
+        print(f"  {error}", file=sys.stderr)
+    return not errors
+
+def stress(turns: int, threads: int, seed: int) -> bool:
+    """Run stress_chats against every chat store backend"""
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="g4fchat-stress-") as workdir:
+        bench = Bench(workdir, seed)
+        try:
+            return all([stress_chats(bench, backend, threads, turns) for backend in bench.app.CHAT_STORES])
+        finally:
+            bench.app.get_writer().close()
+            bench.app.close_search_index()
+            if bench.app.chat_store is not None:
+                bench.app.chat_store.close()
+            os.chdir(cwd)
+
+def compare(results: Dict[str, Dict[str, Any]], baseline_path: str) -> None:
+    """Print metrics that changed against a previous results file"""
+    from rich.console import Console
+    from rich.table import Table
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)["results"]
+    table = Table(title=f"Against {baseline_path}")
+    for column in ("benchmark", "metric", "before", "after", "change"):
+        table.add_column(column, justify="right" if column in ("before", "after", "change") else "left")
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            before = baseline.get(name, {}).get(metric)
+            if not isinstance(value, (int, float)) or not isinstance(before, (int, float)) or metric in ("samples", "chars"):
+                continue
+            change = f"{(value - before) / before * 100:+.1f}%" if before else "-"
+            table.add_row(name, metric, f"{before:g}", f"{value:g}", change)
+    Console().print(table)
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Offline G4FChat benchmarks")
+    parser.add_argument('--output', help="write results as JSON to this file (default: stdout)")
+    parser.add_argument('--compare', metavar='BASELINE', help="print changes against an earlier results file")
+    parser.add_argument('--quick', action='store_true', help="smaller workloads for a fast check")
+    parser.add_argument('--seed', type=int, default=0, help="seed for payloads and injected failures")
+    parser.add_argument('--only', help="comma-separated groups: turns, persistence, postprocess, startup")
+    parser.add_argument('--stress', type=int, metavar='TURNS', help="instead of benchmarking, check that no "
+                                                                  "message is lost under concurrent use")
+    parser.add_argument('--threads', type=int, default=8, help="threads for --stress")
+    args = parser.parse_args(argv)
+    if args.stress:
+        sys.exit(0 if stress(args.stress, args.threads, args.seed) else 1)
+    groups = set((args.only or "turns,persistence,postprocess,startup").split(","))
+    output_path = os.path.abspath(args.output) if args.output else None
+    baseline_path = os.path.abspath(args.compare) if args.compare else None
+
+    results: Dict[str, Dict[str, Any]] = {}
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="g4fchat-bench-") as workdir:
+        bench = Bench(workdir, args.seed)
+        try:
+            if "turns" in groups:
+                results.update(bench_turns(bench, 10 if args.quick else 50))
+            if "persistence" in groups:
+                results.update(bench_persistence(
+                    bench,
+                    [10, 100] if args.quick else [10, 100, 1000],
+                    [10] if args.quick else [10, 100],
+                    5 if args.quick else 20
+                ))
+            if "postprocess" in groups:
+                results.update(bench_postprocess(bench, 5 if args.quick else 20))
+            if "startup" in groups:
+                results.update(bench_startup(2 if args.quick else 4))
+        finally:
+            bench.app.get_writer().close()
+            if bench.app.chat_store is not None:
+                bench.app.chat_store.close()
+            os.chdir(cwd)
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": sys.platform,
+            "g4f": bench.app.G4F_VERSION,
+            "seed": args.seed,
+            "quick": args.quick
+        },
+        "results": results
+    }
+    text = json.dumps(report, indent=2)
+    if output_path:
+        with open(output_path, 'w', encoding='utf-8') as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if baseline_path:
+        compare(results, baseline_path)
+
+if __name__ == '__main__':
+    main()